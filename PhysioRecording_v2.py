@@ -144,6 +144,49 @@ Programming:
       -There are occasionally errors with the configuration and having to restart, error is analog on digital channel.  We should properly configure the labjack explicitly
       with the analog connections based on its hardware connections in the init function.
 
+    10/16/26:
+    - Added a Stream acquisition mode (General frame). The U3 clocks the scans in hardware at the Stream Rate and the
+      blocks are averaged down to one row per Sample Period, with timestamps from the device scan count instead of time.sleep().
+      Use this for sample periods below ~0.1s. Start with --simulate to test with a simulated U3 without the hardware.
+    - The gui shows the newest row every DisplayPeriod (0.1s, in SARecorder.ini) instead of every row, so fast sampling
+      does not back up the display. The log file still gets every row.
+    - The displayed rows are also plotted, one lane per channel sweeping over PlotWindow seconds (WaveformPanel), and the
+      log window keeps only the last LogWindowLines lines. Older Rows pages back through the log file on disk, Live returns.
+    - Feedback sampling is timed on absolute deadlines of a monotonic clock (SampleScheduler) with a Catch-up policy
+      for when it falls behind. The jitter/latency histograms are shown in the gui and written at the end of the log.
+    - ScanTime (seconds since the scan started) and Rep (repetition index) columns after the status columns. The scan start
+      is estimated from the PV polls and the repetitions from PVM_RepetitionTime, or with TriggerChannel set in
+      SARecorder.ini (FIO number of the scanner TTL trigger) from the trigger edges.
+    - Per channel sample rates: ChannelDecimate in SARecorder.ini (e.g. 1,1,1,1,10,1,1) reads a channel only every Nth
+      sample in feedback mode (the log holds the last value), or averages it over N rows in stream mode.
+    - The AIN conversion (SettlingProfiles Quick/Normal/Long) is set per channel with ChannelSettling in SARecorder.ini
+      instead of always Long. --calibratesettling measures the read time and noise of each profile on the connected U3
+      and recommends the fastest one with a noise below SettlingNoiseLimit (--save writes it to SARecorder.ini).
+    - Additional LabJack U3s ([Device.<name>] sections in SARecorder.ini, by serial number) are sampled by their own
+      processes and merged into the log by time, after the channels of the main device (SerialNumber in [Main]).
+    - The capture process has a heartbeat (samples, time of the newest sample, state); the gui shows the samples/s and lag,
+      and restarts the capture process on a new log segment (<log>_seg<N>.txt, same header) if it exits or stalls for
+      WatchdogTimeout seconds. The outage is written to both segments as a comment line.
+    - If the LabJack fails during a recording (USB error, reset), the capture process opens it again and continues the log
+      after a '# device error ...' comment line, for up to ReconnectTimeout seconds. --simulatefaults tests this.
+    - --replay <log> plays a recorded text or binary log through a simulated LabJack (ReplayU3), --speed <factor> replays
+      it and runs the fake scanner (--fakepv, or --fakepvscript <file> for other SCANNING/RECO/Idle steps) faster.
+    - The device is opened through DeviceBackends (DeviceBackend in SARecorder.ini: U3, Simulated or Replay). The simulated
+      U3 has a waveform per metric (temperature drift, respiration sine, Iso steps, pump TTL), latency, noise and
+      faults set in the [Simulation] section, also used by --benchmark.
+    - The U3 lines are configured explicitly from ChannelConfig (FIOAnalog/EIOAnalog) instead of the power up defaults,
+      and the configuration is checked before each recording. The configuration and calibration data are cached in
+      ~/SARecorderU3.json, so the device only has to be verified when it is opened again.
+    - The trigger edges are counted by a U3 counter on the TriggerChannel (FIO4 or higher); in stream mode the edges of
+      the trigger and of the digital lines (ControlLine, PumpStat) are timed at the scan rate. All edges are written to
+      PhysioRecordingLog*_events.txt.
+    - The changes of the scan status and the custom values are also in PhysioRecordingLog*_events.txt (with the row Count).
+      With CompactLog = True in SARecorder.ini they are left out of the rows of the text log, --expand <log> writes the
+      log with the columns filled in again (<log>_expanded.txt).
+    - --selftest checks the conversion table against convertCalibratedVoltagetoValue for every channel option metric,
+      the calibration, simulation and device examples of SARecorder.ini, the reconnect after simulated device faults,
+      the status from the fake scanner and the event log.
+
     TODO:
     - add timer and alert for monitoring by hand.
     - add module to control the stimulator to replace the old pc laptop and provide more options for experimental control (loops, variable timing, etc).
@@ -158,10 +201,23 @@ import sys
 import time
 import datetime
 import string
+import math
+import threading
+import struct
+import json
+import bisect
+import hashlib
+import copy
+import collections
+import signal
+try:
+    import Queue as queue #python 2
+except ImportError:
+    import queue
 
 
 #modules that will need to get checked and will be installed if not available.
-modList = ['PySimpleGUI27','configparser','inputs','typing']
+modList = ['PySimpleGUI27','configparser','inputs','typing','numpy']
 for mm in modList:
     try:
         print(mm)
@@ -192,17 +248,49 @@ else:
 
 import PySimpleGUI27 as sg
 from configparser import ConfigParser
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Array, Value
 #import BrukerMRI as bruker #no need to read PV parameters in this program.
 import u3 #LabPython U3 function
+import numpy as np
+
+try:
+    monotonicTime = time.monotonic
+except AttributeError:
+    # python 2 has no monotonic clock, use clock_gettime(CLOCK_MONOTONIC) on linux (the console), otherwise the wall clock
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        if not sys.platform.startswith('linux'):
+            raise OSError("CLOCK_MONOTONIC is only used on linux")
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonicTime():
+            now = timespec() #one per call, it is called from several threads
+            if clock_gettime(1, ctypes.byref(now)) != 0: #1 is CLOCK_MONOTONIC
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return now.tv_sec + now.tv_nsec * 1e-9
+        monotonicTime()
+    except:
+        monotonicTime = time.time
 
 #Static values/configuration that are set before starting the recording processes
 class ConfigParam:
     def __init__(self):
         self.homedir = os.path.expanduser('~')
         self.configfile = os.path.join(self.homedir,'SARecorder.ini')
+        self.calibrationfile = os.path.join(self.homedir,'SARecorderCalibration.ini') #optional, see loadCalibrationRegistry
+        self.u3cachefile = os.path.join(self.homedir,'SARecorderU3.json') #configuration and calibration of the U3, see loadU3Cache
+        self.U3Configuration = {} #line configuration the U3 is expected to have (read back after configuring it)
+        self.CalibrationRules = {} #conversion rules per metric (built-in ConversionRules plus the [Calibration.*] sections)
         self.deviceU3 = None
         self.isU3 = False
+        self.DeviceSerial = '' #serial number of the U3 to open, the first one found if empty (SerialNumber in SARecorder.ini)
+        self.ExtraDevices = [] #additional U3s recorded into the same log, from the [Device.*] sections (see loadExtraDevices)
         #Defaults and config to connection mapping
         self.SamplePeriod = 1.0  #seconds, appropriate for slow rates
         self.SelectedChannelMetrics = ['T1Temp','PRespRate','None','None','Iso','None','None'] #defaults
@@ -213,12 +301,22 @@ class ConfigParam:
         self.currentChannelPositiveList = []
         self.currentChannelConfigList = []
         self.currentChannelDecimateList = []
+        self.ChannelDecimate = [1, 1, 1, 1, 1, 1, 1] #each channel is read every Nth sample (ChannelDecimate in SARecorder.ini, see ChannelReadPlan)
+        self.currentChannelSettlingList = []
+        self.ChannelSettling = ['Long', 'Long', 'Long', 'Long', 'Long', 'Long', 'Long'] #AIN conversion of each channel (see SettlingProfiles)
+        self.SettlingNoiseLimit = 0.002 #V rms, the fastest profile below this is recommended by --calibratesettling
         self.RateOptionsList = ['T1Temp','PRespRate','ECGRate','BP1Rate','BP1Mean','BP2Rate','BP2Mean','BP2Systol','BP2Diastol','BP3Rate','BP3Mean','BPCardRate','PRespPeriod','None']
         self.PoetOptionsList = ['Iso','O2','CO2','Other','None']
         self.GRASSOptionsList = ['ControlLine','None']
         self.HAPumpOptionsList = ['PumpStat','None']
         self.LogWindow = None
+        self.ConfigWarnings = [] #problems with the settings in SARecorder.ini not shown in the log window yet (see configWarning)
         self.LogHeaderWindow = None
+        self.LogWindowLines = 500 #lines kept in the gui log window (see BoundedLogWindow), the file has all rows
+        self.Waveforms = None #WaveformPanel of the gui
+        self.PlotWindow = 60.0 #seconds across the waveform plots
+        self.PlotHistory = 600.0 #seconds of displayed rows kept for the plots
+        self.PlotFrameRate = 5.0 #maximum redraws of the plots per second
         self.CustomEnabledFlag = False
         self.CustomEnabled1 = False
         self.CustomLabel1 = ''
@@ -228,6 +326,38 @@ class ConfigParam:
         self.CustomLabel3 = ''
         self.windowX = None
         self.windowY = None
+        #Acquisition engine. Feedback polls the U3 once per sample (getFeedback), Stream uses the hardware clocked
+        #stream mode of the U3 at StreamScanFrequency and averages the scans down to one row per SamplePeriod.
+        self.AcquisitionMode = 'Feedback'
+        self.AcquisitionModeList = ['Feedback','Stream']
+        self.StreamScanFrequency = 500.0 #Hz, scans per second of all selected channels in stream mode
+        self.StreamResolution = 3 #U3 stream resolution index (0-3), 3 is the fastest/noisiest
+        self.DeviceBackend = 'U3' #one of DeviceBackends: 'U3', 'Simulated' (--simulate) or 'Replay' (--replay <log>)
+        self.ConfigDeviceBackend = 'U3' #DeviceBackend as set in SARecorder.ini, saved back instead of a command line override
+        self.Simulation = dict(SimulationDefaults) #settings of the SimulatedU3, from the [Simulation] section (see loadSimulationSettings)
+        self.ReplayLog = '' #text or binary log replayed by the ReplayU3 device instead of the hardware (--replay <log>)
+        self.ReplaySpeed = 1.0 #time factor of the replay and of the fake scanner (--speed <factor>)
+        self.PVPollPeriod = 0.5 #seconds between pvcmd polls in the PVMonitor thread
+        self.BinaryLog = False #also write the binary log (PhysioRecordingLog*.bin) next to the text log
+        self.CompactLog = False #status and custom values only in the event log when they change, not in every row (see expandCompactLog)
+        #The log rows are collected in memory and written when either limit is reached (see BatchedLogWriter)
+        self.FlushInterval = 1.0 #seconds, maximum age of a row before it is written to the file
+        self.FlushBytes = 65536 #bytes, maximum size of the rows kept in memory
+        self.FsyncPolicy = 'None' #'None', 'Flush' (fsync every write to the file), 'Close' (fsync when the recording stops)
+        self.DisplayPeriod = 0.1 #seconds between rows sent to the gui, the file gets every row
+        self.CatchUpPolicy = 'Burst' #when sampling falls behind: 'Burst', 'Skip' or 'Mark' the missed samples (see SampleScheduler)
+        self.CatchUpPolicyList = ['Burst','Skip','Mark']
+        self.TimingWindow = None #gui element for the sampling jitter/latency of the recording
+        #After a device error the capture process opens the U3 again (see reconnectU3), the recording ends with the
+        #error if that does not succeed within ReconnectTimeout.
+        self.ReconnectTimeout = 30.0 #seconds
+        self.ReconnectBackoff = 0.05 #seconds to the first retry, doubled up to 1 s
+        #The gui restarts the capture process on a new log segment if it has exited or shows no sign of life for
+        #WatchdogTimeout seconds (plus the time it may need for a sample, see superviseCaptureProcess).
+        self.WatchdogTimeout = 10.0 #seconds
+        self.CaptureWindow = None #gui element for the samples/s and lag of the capture process
+        self.TriggerChannel = 'None' #FIO line with the scanner TTL trigger (e.g. 5 for FIO5), see openandConfigureU3
+        self.TriggerCounter = False #the trigger edges are counted by Counter0 of the U3 (set when the device is configured)
 
 #Dynamic values that change during recording (PV status) or can be altered during the scan (custom values).
 class RecordingParam:
@@ -252,29 +382,73 @@ class RecordingParam:
         self.fileHandle = None
         self.ParentToCaptureQueue = None
         self.CaptureToParentQueue = None
+        self.StatusSlot = None #SharedStatusSlot with the scan status and custom values for the capture process
+        self.Heartbeat = None #CaptureHeartbeat of the capture process
+        self.logBasePath = '' #log path of the first segment, restarts continue in <name>_seg<N>.txt
+        self.captureLogPath = '' #log file the capture process is writing, also between scans when logPath is cleared
+        self.logSegment = 1
+        self.HeartbeatRateSamples = 0 #sample count and time of the last samples/s update in the gui
+        self.HeartbeatRateTime = 0.0
+        self.LastRestartTime = 0.0 #monotonicTime() of the last restart by the watchdog
         self.CustomValue1 = ''
         self.CustomValue2 = ''
         self.CustomValue3 = ''
+        self.psid = ''
+        self.PVService = None #PVStatusService, caches the pvcmd values of the current scan
+        self.PVMonitor = None #PVMonitor thread polling the PVService
+        self.PVEventQueue = None #transition events from the PVMonitor for the gui loop
+        self.PVStatusSeq = 0 #sequence number of the last PV poll handled by the gui loop
+        self.ScanStartTime = 0.0 #monotonicTime() estimate of the start of the current SCANNING, 0 if not scanning
+        self.RepetitionTime = 0.0 #seconds per repetition (PVM_RepetitionTime) of the current scan, 0 if unknown
+        self.UseFakePV = False #use FakePVcmd instead of pvcmd (started with --fakepv)
 
 
 # Start of Main program (called as sole function from __main__() at end of file)
 def main():
     #setup and open the gui and start loopinginternalRecordingStatus = False
     # These could be tweaked for performance.
-    pvmonInterval = 4 #only check on PV every this many loops, lower means more checks, but may introduce too much overhead
+    # PV is polled in its own thread (PVMonitor) every param.PVPollPeriod seconds, independent of the gui loop.
     guitimeout = 100 #ms for polling gui, longer makes it more responsive.
 
     #First get defaults and check status of PV or LabJack connections/communications.
     param = ConfigParam()
     statusparam = RecordingParam()
 
-    checkPVconfig()
+    # --simulate uses a simulated LabJack so the acquisition can be run without the hardware.
+    if '--simulate' in sys.argv:
+        param.DeviceBackend = 'Simulated'
+    # --simulatefaults also makes the simulated LabJack fail every 20 s for a moment, to test the reconnect.
+    if '--simulatefaults' in sys.argv:
+        SimulatedU3.faultPeriod = 20.0
+    # --replay <log> plays the channels of a recorded log (text or binary) through a simulated LabJack,
+    # --speed <factor> runs the replay and the fake scanner faster (or slower) than real time.
+    if '--replay' in sys.argv:
+        param.DeviceBackend = 'Replay'
+        param.ReplayLog = sys.argv[sys.argv.index('--replay') + 1]
+    if '--speed' in sys.argv:
+        param.ReplaySpeed = float(sys.argv[sys.argv.index('--speed') + 1])
+    # --fakepv answers the pvcmd calls from a scripted fake scanner so the program can run off-console,
+    # --fakepvscript <file> with the steps of the script from the file (see loadFakePVScript).
+    statusparam.UseFakePV = ('--fakepv' in sys.argv) or ('--fakepvscript' in sys.argv)
+
+    if statusparam.UseFakePV == True:
+        script = None
+        if '--fakepvscript' in sys.argv:
+            script = loadFakePVScript(sys.argv[sys.argv.index('--fakepvscript') + 1])
+        statusparam.PVService = PVStatusService(FakePVcmd(script, speed=param.ReplaySpeed))
+    else:
+        checkPVconfig()
+        statusparam.PVService = PVStatusService()
     param = getSARecorderConfig(param)
 
     #start the user interface.
     window = guisetup(param)
-    param.LogWindow = window['-LOGWINDOW-']
+    param.LogWindow = BoundedLogWindow(window['-LOGWINDOW-'], param.LogWindowLines)
+    param.Waveforms = WaveformPanel(window['-WAVEFORMS-'], WaveformCanvasSize, param.PlotWindow, param.PlotHistory,
+                                    param.DisplayPeriod, param.PlotFrameRate)
     param.LogHeaderWindow = window['-LOGHEADERWINDOW-']
+    param.TimingWindow = window['-TIMING-']
+    param.CaptureWindow = window['-CAPTURE-']
 
     param = openandConfigureU3(param)
     if param.isU3==False:
@@ -283,20 +457,35 @@ def main():
     else:
         window['-LJSTATUS-'].update('Connected', text_color = 'green')
 
+    # Paravision is monitored in a background thread so the pvcmd calls never block the gui.
+    statusparam.PVMonitor = PVMonitor(statusparam.PVService, param.homedir, param.PVPollPeriod)
+    statusparam.PVEventQueue = statusparam.PVMonitor.subscribe()
+    statusparam.PVMonitor.start()
+
 
     # Create an event loop
-    loopInterval = 0
     while True:
 
         wincurrLoc = window.CurrentLocation()
         param.windowX = wincurrLoc[0]
         param.windowY = wincurrLoc[1]
 
-        #The pvcmd commands to paravision have a lot of overhead, so do them less frequently than
-        # doing a window read.
-        loopInterval = loopInterval + 1
-        if (loopInterval % pvmonInterval) == 0:
-            statusparam = MonitorPVstatus(param, statusparam)
+        # settings of SARecorder.ini that were not used, from the start or the last time it was loaded
+        showConfigWarnings(param)
+
+        #The pvcmd commands to paravision run in the PVMonitor thread. Show the transitions and act on
+        # the newest status as soon as a poll has finished.
+        while True:
+            try:
+                pvevent = statusparam.PVEventQueue.get(block=False)
+            except queue.Empty:
+                break
+            if pvevent['event'] != 'StatusChanged':
+                param.LogWindow.update("PV: " + pvevent['event'] + " E" + pvevent['status']['expno'] + "\n", append=True)
+        pvseq, pvstatus = statusparam.PVMonitor.latest()
+        if pvseq != statusparam.PVStatusSeq:
+            statusparam.PVStatusSeq = pvseq
+            statusparam = MonitorPVstatus(param, statusparam, pvstatus)
 
         # if monitoring PV while recording, update the scan status
         if statusparam.internalRecordingStatus == True or statusparam.internalRunMonitor == True:
@@ -308,12 +497,8 @@ def main():
                 statusparam.logPath = ''
 
             if statusparam.captureProcessStarted == True:
-                if statusparam.captureProcess.is_alive():
-                    try:
-                        captureout = statusparam.CaptureToParentQueue.get(block=False)
-                        param.LogWindow.update(captureout, append=True)
-                    except:
-                        pass
+                drainCaptureQueue(param, statusparam)
+                statusparam = superviseCaptureProcess(param, statusparam)
 
 
         if statusparam.recordingstatus in ('Recording','Monitoring'):
@@ -332,12 +517,12 @@ def main():
         # End program if user closes window or
         # presses the Quit button
         if event == "Quit" or event == None: #sg.WIN_CLOSED is supposed to work, but doesn't. WIN_CLOSED is None anyway, so this does work.
+            statusparam.PVMonitor.stop()
             try:
                 setSARecorderConfig(values, param) #this will fail if the window is closed, but not 'Quit'
-                statusparam.captureProcess.terminate()
-                statusparam.fileHandle.close()
             except:
                 pass
+            StopCaptureProcess(param, statusparam)
             break
 
         # Record button to start or stop PV recording
@@ -366,13 +551,7 @@ def main():
                 window['-RECORD-'].update('Per Scan Recording', button_color=('black','green'))
                 window['-UPDATE-'].update(disabled=False)
                 window['-RUNMONITOR-'].update(disabled=False)
-                try:
-                    statusparam.fileHandle.close()
-                    statusparam.captureProcess.terminate()
-                    statusparam.CaptureToParentQueue.close()
-                    statusparam.PaptureToCarentQueue.close()
-                except:
-                    pass
+                StopCaptureProcess(param, statusparam)
                 statusparam.newscan = 1
                 param.LogWindow.update('Stop Recording\n',append=True)
 
@@ -468,6 +647,12 @@ def main():
             window["-CUSTOMENABLED1-"].update(disabled=False)
             window["-CUSTOMLABEL1-"].update(disabled=False)
 
+        # Older rows of the current log file in the log window, until Live
+        if event == "-SCROLLBACK-":
+            param.LogWindow.older(statusparam.captureLogPath)
+        if event == "-LIVE-":
+            param.LogWindow.live()
+
 
         # custom values were updated with button during the recording.
         #Note, without the button, chnages were immediate with half-typed values being used/passed.
@@ -480,15 +665,9 @@ def main():
             statusparam.CustomValue3 = values["-CUSTOMVALUE3-"]
 
             if param.CustomEnabled1 == True:
-                customstring = statusparam.CustomValue1.replace(" ","")
-                if param.CustomEnabled2 == True:
-                    customstring = customstring + "," + statusparam.CustomValue2.replace(" ","")
-                    if param.CustomEnabled3 == True:
-                        customstring = customstring + "," + statusparam.CustomValue3.replace(" ","")
-
                 if statusparam.captureProcessStarted == True:
                     if statusparam.captureProcess.is_alive():
-                        statusparam.ParentToCaptureQueue.put(customstring)
+                        updateStatusSlot(param, statusparam)
         # except:
         #     pass
 
@@ -498,6 +677,66 @@ def main():
 """
 Get/Set Configuration
 """
+# The examples in the comments have ; comments at the end of the lines, which are not part of the values.
+ConfigCommentPrefixes = (';', '#')
+
+
+# Reports a setting of SARecorder.ini (or SARecorderCalibration.ini) that is not used. It is printed and shown in the
+# gui log window (showConfigWarnings), since a setting that falls back to its default can e.g. miscalibrate a channel.
+def configWarning(param, message):
+    print(message)
+    param.ConfigWarnings.append(message)
+
+
+def showConfigWarnings(param):
+    if param.LogWindow is None:
+        return
+    for message in param.ConfigWarnings:
+        param.LogWindow.update(message + "\n", append=True)
+    param.ConfigWarnings = []
+
+
+# Value of an option of SARecorder.ini converted with convert (e.g. float, int or configBool, raising ValueError if
+# the text is not valid), or default if the option is not there (an older config file). An invalid value, or one that
+# is not in choices, is reported (configWarning) and the default is used, so it does not affect the other options.
+def configOption(param, options, key, default, convert=str, choices=None):
+    if not key in options:
+        return default
+    try:
+        value = convert(options[key].strip())
+        if choices is not None and not value in choices:
+            raise ValueError("not one of " + ", ".join(choices))
+    except ValueError:
+        configWarning(param, "Invalid " + key + " = " + options[key] + " in " + param.configfile + " (" + str(sys.exc_info()[1]) + "), using " + str(default))
+        return default
+    return value
+
+
+def configBool(value):
+    if not value in ('True', 'False'):
+        raise ValueError("not True or False")
+    return value == 'True'
+
+
+# FIO number of the trigger input or 'None'
+def configTriggerChannel(value):
+    if value == 'None':
+        return value
+    return str(int(value))
+
+
+def configDecimateList(value):
+    return [max(1, int(n)) for n in value.split(',')]
+
+
+def configSettlingList(value):
+    profiles = [n.strip() for n in value.split(',')]
+    for profile in profiles:
+        if not profile in SettlingProfiles:
+            raise ValueError("unknown settling profile " + profile)
+    return profiles
+
+
 def getSARecorderConfig(param):
     config = ConfigParser()
     try:
@@ -519,27 +758,68 @@ def getSARecorderConfig(param):
             param.CustomEnabled3 = config['Main']['CUSTOMENABLED3'] == 'True'
             param.windowX = float(config['Main']['WINDOWX'])
             param.windowY = float(config['Main']['WINDOWY'])
-
         #else: these will stay as defaults
     except:
         pass
 
+    # newer options, each on its own: the default if it is not in an older config file or not valid (reported)
+    if config.has_section('Main'):
+        options = config['Main']
+        param.AcquisitionMode = configOption(param, options, 'AcquisitionMode', param.AcquisitionMode, choices=param.AcquisitionModeList)
+        param.StreamScanFrequency = configOption(param, options, 'StreamScanFrequency', param.StreamScanFrequency, float)
+        param.PVPollPeriod = configOption(param, options, 'PVPollPeriod', param.PVPollPeriod, float)
+        param.BinaryLog = configOption(param, options, 'BinaryLog', param.BinaryLog, configBool)
+        param.FlushInterval = configOption(param, options, 'FlushInterval', param.FlushInterval, float)
+        param.FlushBytes = configOption(param, options, 'FlushBytes', param.FlushBytes, int)
+        param.FsyncPolicy = configOption(param, options, 'FsyncPolicy', param.FsyncPolicy, choices=['None', 'Flush', 'Close'])
+        param.CompactLog = configOption(param, options, 'CompactLog', param.CompactLog, configBool)
+        param.DisplayPeriod = configOption(param, options, 'DisplayPeriod', param.DisplayPeriod, float)
+        param.LogWindowLines = configOption(param, options, 'LogWindowLines', param.LogWindowLines, int)
+        param.PlotWindow = configOption(param, options, 'PlotWindow', param.PlotWindow, float)
+        param.PlotHistory = configOption(param, options, 'PlotHistory', param.PlotHistory, float)
+        param.PlotFrameRate = configOption(param, options, 'PlotFrameRate', param.PlotFrameRate, float)
+        param.CatchUpPolicy = configOption(param, options, 'CatchUpPolicy', param.CatchUpPolicy, choices=param.CatchUpPolicyList)
+        param.TriggerChannel = configOption(param, options, 'TriggerChannel', param.TriggerChannel, configTriggerChannel)
+        param.WatchdogTimeout = configOption(param, options, 'WatchdogTimeout', param.WatchdogTimeout, float)
+        param.DeviceSerial = configOption(param, options, 'SerialNumber', param.DeviceSerial)
+        param.ConfigDeviceBackend = configOption(param, options, 'DeviceBackend', param.ConfigDeviceBackend, choices=sorted(DeviceBackends))
+        if param.DeviceBackend == 'U3': #not when selected on the command line
+            param.DeviceBackend = param.ConfigDeviceBackend
+        param.ChannelDecimate = configOption(param, options, 'ChannelDecimate', param.ChannelDecimate, configDecimateList)
+        param.ChannelSettling = configOption(param, options, 'ChannelSettling', param.ChannelSettling, configSettlingList)
+        param.SettlingNoiseLimit = configOption(param, options, 'SettlingNoiseLimit', param.SettlingNoiseLimit, float)
+
+    param = loadCalibrationRegistry(param)
+    param = loadExtraDevices(param)
+    param = loadSimulationSettings(param)
+
     #remove any value from recording with None setting for the current channel set
     param.currentChannelMetricList = []
     param.currentChannelConfigList = []
     param.currentChannelPositiveList = []
+    param.currentChannelDecimateList = []
+    param.currentChannelSettlingList = []
     for i in range(len(param.SelectedChannelMetrics)):
         if not param.SelectedChannelMetrics[i] == 'None':
             param.currentChannelMetricList.append(param.SelectedChannelMetrics[i])
             param.currentChannelConfigList.append(param.ChannelConfig[i])
             param.currentChannelPositiveList.append(param.ChannelPositive[i])
+            param.currentChannelDecimateList.append(param.ChannelDecimate[i] if i < len(param.ChannelDecimate) else 1)
+            param.currentChannelSettlingList.append(param.ChannelSettling[i] if i < len(param.ChannelSettling) else 'Long')
 
     return param
 
 
 def setSARecorderConfig(values, param):
     parser = ConfigParser()
-    parser['Main'] = {}
+    # keep the other sections (calibration) and the Main keys the gui does not set (as saveChannelSettling)
+    try:
+        if os.path.exists(param.configfile):
+            parser.read(param.configfile)
+    except:
+        pass
+    if not parser.has_section('Main'):
+        parser['Main'] = {}
     parser['Main']['DAC1'] = values['-DAC1-'][0]
     parser['Main']['DAC2'] = values['-DAC2-'][0]
     parser['Main']['DAC3'] = values['-DAC3-'][0]
@@ -558,6 +838,27 @@ def setSARecorderConfig(values, param):
     parser['Main']['CUSTOMENABLED3'] = str(values['-CUSTOMENABLED3-'])
     parser['Main']['WINDOWX'] = str(param.windowX)
     parser['Main']['WINDOWY'] = str(param.windowY)
+    parser['Main']['AcquisitionMode'] = values['-ACQMODE-']
+    parser['Main']['StreamScanFrequency'] = values['-STREAMFREQ-']
+    parser['Main']['PVPollPeriod'] = str(param.PVPollPeriod)
+    parser['Main']['BinaryLog'] = str(values['-BINARYLOG-'])
+    parser['Main']['FlushInterval'] = str(param.FlushInterval)
+    parser['Main']['FlushBytes'] = str(param.FlushBytes)
+    parser['Main']['FsyncPolicy'] = param.FsyncPolicy
+    parser['Main']['CompactLog'] = str(param.CompactLog)
+    parser['Main']['DisplayPeriod'] = str(param.DisplayPeriod)
+    parser['Main']['LogWindowLines'] = str(param.LogWindowLines)
+    parser['Main']['PlotWindow'] = str(param.PlotWindow)
+    parser['Main']['PlotHistory'] = str(param.PlotHistory)
+    parser['Main']['PlotFrameRate'] = str(param.PlotFrameRate)
+    parser['Main']['CatchUpPolicy'] = values['-CATCHUP-']
+    parser['Main']['TriggerChannel'] = str(param.TriggerChannel)
+    parser['Main']['WatchdogTimeout'] = str(param.WatchdogTimeout)
+    parser['Main']['SerialNumber'] = str(param.DeviceSerial)
+    parser['Main']['DeviceBackend'] = param.ConfigDeviceBackend
+    parser['Main']['ChannelDecimate'] = ",".join([str(n) for n in param.ChannelDecimate])
+    parser['Main']['ChannelSettling'] = ",".join(param.ChannelSettling)
+    parser['Main']['SettlingNoiseLimit'] = str(param.SettlingNoiseLimit)
     with open(param.configfile, "w") as fp:
         parser.write(fp)
 
@@ -567,7 +868,11 @@ Functions for the GUI monitoring window
 """
 def guisetup(param):
 
-    layoutTop = [[sg.Text("Sample Period (sec)",size=[20,1]), sg.Input(size=(10, 1), background_color='white', enable_events=True, default_text=str(param.SamplePeriod), key="-SamplePeriod-")]]
+    layoutTop = [[sg.Text("Sample Period (sec)",size=[20,1]), sg.Input(size=(10, 1), background_color='white', enable_events=True, default_text=str(param.SamplePeriod), key="-SamplePeriod-"),
+                  sg.Text("Acquisition",size=[12,1]), sg.Combo(values=param.AcquisitionModeList, default_value=param.AcquisitionMode, size=(10, 1), readonly=True, key="-ACQMODE-"),
+                  sg.Text("Stream Rate (Hz)",size=[16,1]), sg.Input(size=(10, 1), background_color='white', enable_events=True, default_text=str(param.StreamScanFrequency), key="-STREAMFREQ-"),
+                  sg.Checkbox("Binary Log", default=param.BinaryLog, key="-BINARYLOG-"),
+                  sg.Text("Catch-up",size=[9,1]), sg.Combo(values=param.CatchUpPolicyList, default_value=param.CatchUpPolicy, size=(7, 1), readonly=True, key="-CATCHUP-")]]
 
     #two rows, labels and selectors.
     layoutChannels = [[sg.Text('DAC1 (PC-SAM)',size=[14,1], justification='center'),
@@ -609,9 +914,14 @@ def guisetup(param):
                 [sg.Text("Recording Status:", size=[16,1]), sg.Text("IDLE", size=[80,1], key="-STATUS-", text_color='black', background_color='white')],
                 [sg.Text("Paravision Status:", size=[16,1]), sg.Text("IDLE", size=[80,1], key='-PVSTATUS-', text_color='black', background_color='white')],
                 [sg.Text("Data Path:", size=[16,1]), sg.Text("None", size=[80,1], key='-LOGPATH-', text_color='black', background_color='white')],
+                [sg.Text("Sample Timing:", size=[16,1]), sg.Text("", size=[80,1], key='-TIMING-', text_color='black', background_color='white')],
+                [sg.Text("Capture:", size=[16,1]), sg.Text("", size=[80,1], key='-CAPTURE-', text_color='black', background_color='white')],
+                [sg.Graph(canvas_size=WaveformCanvasSize, graph_bottom_left=(0, 0), graph_top_right=WaveformCanvasSize,
+                          background_color='white', key='-WAVEFORMS-')],
                 [sg.Text(" ", size=[140,1], key='-EMPTY-', font='courier 10')],
                 [sg.Text(" ", size=[140,1], key='-LOGHEADERWINDOW-', font='courier 10 bold')],
-                [sg.Multiline(default_text='', size=[140,14], key='-LOGWINDOW-', autoscroll=True, text_color='black', background_color='white',font='courier 10')]
+                [sg.Multiline(default_text='', size=[140,14], key='-LOGWINDOW-', autoscroll=True, text_color='black', background_color='white',font='courier 10')],
+                [sg.Button("Older Rows", key='-SCROLLBACK-', size=[14,1]), sg.Button("Live", key='-LIVE-', size=[14,1])]
                  ]
     layoutActions = [
                 #[sg.Text("Low Volt LJ Inputs (FIO)"),sg.Listbox(values=['True','False'], default_values=[useFIOinputs,], enable_events=True, size=(10, 4), key="-useFIOinputs-")],
@@ -629,13 +939,214 @@ def guisetup(param):
 
     return window
 
+WaveformCanvasSize = (1100, 280) #pixels
+
+
+# The gui log window (an sg.Multiline) keeps only the last maxLines lines, so a long recording does not slow down
+# the Tk text widget. The oldest lines are deleted in chunks of a tenth of maxLines.
+# The same lines are kept in a deque (bounded too) to show them again after the scrollback: older() replaces the view
+# with the maxLines rows before it read from the log file on disk, one page further back at each call; live() returns
+# to the recent lines. The rows that arrive during the scrollback are only added to the deque.
+class BoundedLogWindow:
+    def __init__(self, element, maxLines):
+        self.element = element
+        self.maxLines = max(10, maxLines)
+        self.lines = 0
+        self.recent = collections.deque(maxlen=self.maxLines)
+        self.scrollbackPath = None
+        self.scrollbackOffset = None #file offset of the first row shown in the scrollback
+
+    def update(self, value, append=False):
+        if not append:
+            self.recent.clear()
+        for line in value.splitlines(True):
+            if len(self.recent) > 0 and not self.recent[-1].endswith('\n'):
+                self.recent[-1] = self.recent[-1] + line
+            else:
+                self.recent.append(line)
+        if self.scrollbackOffset is not None:
+            return
+        self.element.update(value, append=append)
+        if not append:
+            self.lines = value.count('\n')
+            return
+        self.lines = self.lines + value.count('\n')
+        if self.lines > self.maxLines + self.maxLines // 10:
+            excess = self.lines - self.maxLines
+            self.element.TKText.delete('1.0', '%d.0' % (excess + 1))
+            self.lines = self.maxLines
+
+    def older(self, path):
+        if not path or not os.path.exists(path):
+            return
+        if self.scrollbackOffset is None or path != self.scrollbackPath:
+            # start before the rows of the file that are also in the live view
+            rows, end = readLinesBefore(path, os.path.getsize(path), self.maxLines)
+        else:
+            end = self.scrollbackOffset
+        rows, start = readLinesBefore(path, end, self.maxLines)
+        if len(rows) == 0:
+            return #at the start of the file
+        self.scrollbackPath = path
+        self.scrollbackOffset = start
+        self.element.update("".join(rows) + "--- rows from " + os.path.basename(path) + ", Live to return ---\n")
+
+    def live(self):
+        if self.scrollbackOffset is None:
+            return
+        self.scrollbackOffset = None
+        self.element.update("".join(self.recent))
+        self.lines = len(self.recent)
+
+
+# The last n complete lines of a file before the byte offset end (at the start of a line), read backwards in blocks,
+# so the earlier part of a large log is not read. Returns (lines, offset of the first line).
+def readLinesBefore(path, end, n, blockSize=65536):
+    with open(path, 'rb') as fh:
+        start = end
+        data = b''
+        while start > 0 and data.count(b'\n') <= n:
+            step = min(blockSize, start)
+            start = start - step
+            fh.seek(start)
+            data = fh.read(step) + data
+    lines = data.splitlines(True)
+    if start > 0 and len(lines) > 0:
+        start = start + len(lines[0]) #partial line
+        lines = lines[1:]
+    if len(lines) > n:
+        start = start + sum([len(line) for line in lines[:-n]])
+        lines = lines[-n:]
+    return [line.decode('utf-8', 'replace') for line in lines], start
+
+
+# Live plots of the displayed rows, one lane per channel on an sg.Graph, sweeping from left to right over
+# plotWindow seconds like a patient monitor. The rows (one every DisplayPeriod) are kept in numpy ring buffers for
+# the last plotHistory seconds. Each redraw (at most frameRate per second) only draws the lines from the new rows and
+# deletes the lines one sweep old just ahead of them, so the cost does not grow with the history. The lanes are
+# scaled to the values; a value outside of the scale redraws the sweep from the buffers with a new scale.
+class WaveformPanel:
+    def __init__(self, graph, canvasSize, plotWindow, plotHistory, displayPeriod, frameRate):
+        self.graph = graph
+        self.width, self.height = canvasSize
+        self.plotWindow = plotWindow
+        self.capacity = max(2, int(plotHistory / max(displayPeriod, 0.001)))
+        self.framePeriod = 1.0 / frameRate
+        self.pixelsPerSecond = self.width / plotWindow
+        self.gapSeconds = 0.03 * plotWindow #blank space ahead of the sweep
+        self.reset([])
+
+    # new recording with these channel names
+    def reset(self, names):
+        self.names = list(names)
+        self.nChannels = len(self.names)
+        self.times = np.zeros(self.capacity)
+        self.values = np.zeros((self.capacity, self.nChannels))
+        self.count = 0 #rows added
+        self.drawn = 0 #rows drawn
+        self.startTime = None
+        self.lastPoint = None #(x pixel, y pixels) of the last drawn row
+        self.figures = collections.deque() #(row time, figure ids) in drawing order
+        self.scaleMin = np.full(self.nChannels, np.inf)
+        self.scaleMax = np.full(self.nChannels, -np.inf)
+        self.nextFrameTime = 0.0
+        self.rescale = True
+
+    def add(self, t, values):
+        if len(values) != self.nChannels:
+            return
+        index = self.count % self.capacity
+        self.times[index] = t
+        self.values[index] = values
+        self.count = self.count + 1
+        if self.startTime is None:
+            self.startTime = t
+        finite = np.isfinite(self.values[index])
+        if (finite & ((self.values[index] < self.scaleMin) | (self.values[index] > self.scaleMax))).any():
+            self.rescale = True
+
+    # rows first to count - 1 (oldest first), at most the capacity
+    def rows(self, first):
+        first = max(first, self.count - self.capacity)
+        indices = np.arange(first, self.count) % self.capacity
+        return self.times[indices], self.values[indices]
+
+    def pixels(self, t, values):
+        x = ((t - self.startTime) % self.plotWindow) * self.pixelsPerSecond
+        laneHeight = float(self.height) / max(1, self.nChannels)
+        lanes = (self.nChannels - 1 - np.arange(self.nChannels)) * laneHeight
+        ys = lanes + 4 + (values - self.scaleMin) / (self.scaleMax - self.scaleMin) * (laneHeight - 8)
+        return int(x), ys
+
+    def draw(self):
+        if self.count == self.drawn or self.nChannels == 0 or monotonicTime() < self.nextFrameTime:
+            return
+        self.nextFrameTime = monotonicTime() + self.framePeriod
+        if self.rescale:
+            self.redraw()
+            return
+        self.drawRows(self.drawn)
+
+    # new scale from the rows of the last sweep and draw them again
+    def redraw(self):
+        self.rescale = False
+        times, values = self.rows(0)
+        visible = times > times[-1] - self.plotWindow
+        for i in range(self.nChannels):
+            column = values[visible, i]
+            column = column[np.isfinite(column)]
+            if len(column) == 0:
+                self.scaleMin[i], self.scaleMax[i] = 0.0, 1.0
+                continue
+            low, high = column.min(), column.max()
+            margin = max(0.1 * (high - low), 0.05 * abs(high), 0.1)
+            self.scaleMin[i], self.scaleMax[i] = low - margin, high + margin
+        self.graph.Erase()
+        self.figures.clear()
+        laneHeight = float(self.height) / self.nChannels
+        for i in range(self.nChannels):
+            top = self.height - i * laneHeight
+            self.graph.DrawLine((0, top - laneHeight), (self.width, top - laneHeight), color='lightgray')
+            self.graph.DrawText("%s  %.4g - %.4g" % (self.names[i], self.scaleMin[i], self.scaleMax[i]), (120, top - 8),
+                                 color='gray', font='courier 8')
+        self.lastPoint = None
+        self.drawRows(self.count - len(times) + np.argmax(visible))
+
+    def drawRows(self, first):
+        times, values = self.rows(first)
+        self.drawn = self.count
+        for n in range(len(times)):
+            x, ys = self.pixels(times[n], values[n])
+            if self.lastPoint is not None and x == self.lastPoint[0]:
+                continue #one point per pixel column
+            if self.lastPoint is not None and x > self.lastPoint[0]:
+                ids = [self.graph.DrawLine((self.lastPoint[0], self.lastPoint[1][i]), (x, ys[i]), color='blue')
+                       for i in range(self.nChannels) if np.isfinite(ys[i]) and np.isfinite(self.lastPoint[1][i])]
+                self.figures.append((times[n], ids))
+            self.lastPoint = (x, ys)
+            # the lines of the last sweep just ahead of this point
+            while len(self.figures) > 0 and self.figures[0][0] < times[n] - self.plotWindow + self.gapSeconds:
+                for figure in self.figures.popleft()[1]:
+                    self.graph.DeleteFigure(figure)
+
+
 """
 Functions for checking on Paravision status or other features
 """
+# Held around starting a pvcmd process (Popen, in the PVMonitor thread) and around starting the capture process.
+# On python 2.7 a fork while Popen still has both ends of its pipes open would leave the write end of the output pipe
+# open in the capture process, and communicate() would then wait for the capture process to end. After Popen only
+# the parent's ends are open, so communicate() runs without the lock and does not hold up the start of a recording.
+# The capture process does not run pvcmd, so its own worker processes are started without it (the lock is copied
+# into the child in the locked state).
+subprocessLock = threading.Lock()
+
+
 def checkPVconfig():
     # test for pvcmd functionality, returns with command not found if unsuccessful
     cmd="pvcmd -a ParxServer -r ListPs "
-    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with subprocessLock:
+        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     dummyOut, error = process.communicate()
 
     if "command not found"  in dummyOut:
@@ -646,80 +1157,326 @@ def checkPVconfig():
         exit()
 
 
-def MonitorPVstatus(param, statusparam):
+# Runs a single pvcmd call without a shell and returns its output as a string.
+def runPVcmd(args):
+    with subprocessLock:
+        process = subprocess.Popen(["pvcmd"] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, error = process.communicate()
+    if not isinstance(out, str):
+        out = out.decode('utf-8', 'replace')
+    return out
+
+
+# Parses the output of 'pvcmd -a ParxServer -r ListPs' in python instead of the grep/awk pipelines.
+# Returns the first DSET PATH (the dataset of the GUI creator) and the PSID of the scan started from the
+# 'pipeMaster' parent (the nearest PSID line within 3 lines before pipeMaster, as with grep -B 3), or '' if none.
+def parseListPs(listPsOut):
+    dsetpath = ''
+    psid = ''
+    lines = listPsOut.splitlines()
+    for line in lines:
+        if 'DSET PATH' in line:
+            fields = line.split()
+            if len(fields) > 2:
+                dsetpath = fields[2]
+                break
+    for i in range(len(lines)):
+        if 'pipeMaster' in lines[i]:
+            for line in reversed(lines[max(0, i - 3):i + 1]):
+                fields = line.split()
+                if 'PSID' in line and len(fields) > 1:
+                    psid = fields[1]
+                    break
+            if psid != '':
+                break
+    return dsetpath, psid
+
+
+# Paravision status with one ListPs call per poll.
+# Values that do not change during a scan (EXPNO path, study UID, ACQ_scan_type) are cached for the PSID
+# and only queried again when the PSID changes. The scan status (SCANNING/RECO/ADJUST) still has to be asked
+# of JPingo, but only while a scan is active, so a poll is 1 call when idle and 2 calls while scanning.
+# runCommand can be replaced with a FakePVcmd to run off-console.
+class PVStatusService:
+    def __init__(self, runCommand=runPVcmd):
+        self.runCommand = runCommand
+        self.cachedPSID = ''
+        self.expnopath = ''
+        self.expno = '0'
+        self.subjectpath = ''
+        self.studyRegID = ''
+        self.experimentstatus = 'Idle'
+        self.repetitionTime = 0.0
+
+    def queryScan(self, psid):
+        # The EXPNO path, study and scan type are fixed for a PSID.
+        expnopath = self.runCommand(["-a", "ParxServer", "-r", "DsetGetPath", "-psid", psid, "-path", "EXPNO"])
+        expnopath = expnopath.strip().split('pdata')[0] #if pdata exists remove everything after
+        expnopath = expnopath.rstrip('/')
+        pathlist = expnopath.rsplit('/', 1)
+        self.expno = pathlist[1]
+        self.subjectpath = pathlist[0] #now get the main subject path
+        self.expnopath = expnopath
+
+        self.studyRegID = self.runCommand(["-a", "ParxServer", "-r", "ParamGetValue", "-psid", psid, "-param", "SUBJECT_study_instance_uid"]).strip()
+        self.experimentstatus = self.queryScanType(psid)
+        try:
+            self.repetitionTime = float(self.runCommand(["-a", "ParxServer", "-r", "ParamGetValue", "-psid", psid, "-param", "PVM_RepetitionTime"]).strip()) / 1000.0
+        except ValueError:
+            self.repetitionTime = 0.0 #not a scan with repetitions
+        self.cachedPSID = psid
+
+    def queryScanType(self, psid):
+        experimentstatus = self.runCommand(["-a", "ParxServer", "-r", "ParamGetValue", "-psid", psid, "-param", "ACQ_scan_type"])
+        experimentstatus = experimentstatus.strip().split("_")[0] #Scan or Setup
+        if not (experimentstatus in ["Scan","Setup"]):
+            experimentstatus = 'Idle'
+        return experimentstatus
+
+    def invalidate(self):
+        self.cachedPSID = ''
+
+    # Returns a dict with studypath, datapath, psid, expno, experimentstatus, scanstatus and reptime (seconds)
+    def poll(self, homedir):
+        status = {'psid': '', 'expno': '0', 'experimentstatus': 'Idle', 'scanstatus': 'Idle', 'reptime': 0.0}
+        try:
+            listPsOut = self.runCommand(["-a", "ParxServer", "-r", "ListPs"])
+        except:
+            listPsOut = ''
+        dsetpath, psid = parseListPs(listPsOut)
+
+        #this gets the data path associated with the GUI creator
+        status['studypath'] = dsetpath.split('pdata')[0]
+        status['datapath'] = status['studypath'].rstrip('/') #remove the trailing slash
+        status['datapath'] = status['datapath'].rsplit('/',1)[0] #remove the last expno
+        if status['datapath'] == "":
+            status['datapath'] = homedir
+            status['studypath'] = homedir
+
+        if psid == '':
+            self.invalidate()
+            return status
+
+        status['psid'] = psid
+        try:
+            if psid != self.cachedPSID:
+                self.queryScan(psid)
+            elif self.experimentstatus == 'Setup':
+                # a setup can be continued as the scan on the same PSID, so keep checking until it is the Scan
+                self.experimentstatus = self.queryScanType(psid)
+            status['datapath'] = self.subjectpath
+            status['expno'] = self.expno
+            status['experimentstatus'] = self.experimentstatus
+            status['reptime'] = self.repetitionTime
+
+            scanstatus = self.runCommand(["-a", "JPingo", "-r", "DSetServer.GetScanStatus", "-registration", self.studyRegID, "-expno", self.expno]).strip()
+            if scanstatus in ["SCANNING","RECO","ADJUST"]:
+                status['scanstatus'] = scanstatus
+        except:
+            self.invalidate()
+            status['expno'] = '0'
+            status['scanstatus'] = "Idle"
+            status['experimentstatus'] = "Idle"
+            status['error'] = True
+        return status
+
+
+# Off-console stand-in for pvcmd (started with --fakepv). It is called like runPVcmd and answers the
+# ListPs/DsetGetPath/ParamGetValue/GetScanStatus calls from a script of
+# (duration sec, ACQ_scan_type or None when idle, scan status) steps that repeats. Each step with a
+# scan type is a new scan with its own PSID and EXPNO.
+class FakePVcmd:
+    def __init__(self, script=None, studypath='/tmp/FakePVData/20260101_Fake.1', speed=1.0):
+        if script is None:
+            script = [(10.0, None, 'Idle'),
+                      (5.0, 'Setup_Experiment', 'ADJUST'),
+                      (30.0, 'Scan_Experiment', 'SCANNING'),
+                      (5.0, 'Scan_Experiment', 'RECO'),
+                      (10.0, None, 'Idle')]
+        self.script = script
+        self.studypath = studypath
+        self.speed = speed #the script runs this many times faster than real time
+        self.startTime = time.time()
+        self.calls = 0
+        if not os.path.isdir(studypath):
+            os.makedirs(studypath) #the logs are written here
+
+    def currentStep(self):
+        # index of the step in the (repeating) script and the number of times it has been repeated
+        cycle = sum([step[0] for step in self.script])
+        elapsed = (time.time() - self.startTime) * self.speed
+        repeat = int(elapsed // cycle)
+        elapsed = elapsed - repeat * cycle
+        for i in range(len(self.script)):
+            if elapsed < self.script[i][0]:
+                return i, repeat
+            elapsed = elapsed - self.script[i][0]
+        return len(self.script) - 1, repeat
+
+    def currentScan(self):
+        # PSID and EXPNO of the current step; consecutive steps with a scan type are the same scan
+        # (e.g. SCANNING then RECO), a Setup followed by Scan is also the same scan.
+        i, repeat = self.currentStep()
+        if self.script[i][1] is None:
+            return '', '0', None, 'Idle'
+        first = i
+        while first > 0 and self.script[first - 1][1] is not None:
+            first = first - 1
+        scanNumber = repeat * len(self.script) + first + 1
+        return str(1000 + scanNumber), str(scanNumber), self.script[i][1], self.script[i][2]
+
+    def __call__(self, args):
+        self.calls = self.calls + 1
+        psid, expno, scantype, scanstatus = self.currentScan()
+        if 'ListPs' in args:
+            out = "PSID 1 Program ParaVisionGUI\n  DSET PATH " + self.studypath + "/1/pdata/1\n"
+            if psid != '':
+                out = out + "PSID " + psid + " Program ScanProcess\n  Parent pipeMaster\n"
+            return out
+        if 'DsetGetPath' in args:
+            return self.studypath + "/" + expno + "/pdata/1"
+        if 'ParamGetValue' in args:
+            if 'ACQ_scan_type' in args:
+                return str(scantype)
+            if 'PVM_RepetitionTime' in args:
+                return str(2000.0 / self.speed) #ms
+            return "1.2.3.4." + os.path.basename(self.studypath)
+        if 'DSetServer.GetScanStatus' in args:
+            return scanstatus
+        return ''
+
+
+# Steps of a FakePVcmd script from a text file, one per line: seconds, scan type (or None when idle), scan status
+#     10, None, Idle
+#     5, Setup_Experiment, ADJUST
+#     30, Scan_Experiment, SCANNING
+#     5, Scan_Experiment, RECO
+# The script repeats. Empty lines and lines starting with # are skipped.
+def loadFakePVScript(path):
+    script = []
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            duration, scantype, scanstatus = [field.strip() for field in line.split(',')]
+            script.append((float(duration), None if scantype == 'None' else scantype, scanstatus))
+    return script
+
+
+# Polls the PVStatusService in a background thread every pollPeriod seconds.
+# Each poll result is kept as the latest status (with a sequence number), and transitions are published as
+# events to the subscribed queues:
+#   ScanStarted   a scan (PSID) appeared
+#   ExpnoChanged  the active scan changed to another EXPNO without going idle
+#   SetupToScan   the same scan changed from Setup to Scan experiment
+#   ScanStopped   the scan went away
+#   StatusChanged any other change, e.g. SCANNING to RECO
+# Each event is a dict with 'event', 'time' (monotonic time of the poll that detected it) and 'status'.
+class PVMonitor:
+    def __init__(self, service, homedir, pollPeriod):
+        self.service = service
+        self.homedir = homedir
+        self.pollPeriod = pollPeriod
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.status = None
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='PVMonitor')
+        self.thread.daemon = True
+
+    def subscribe(self, eventQueue=None):
+        # any object with put() works, e.g. a multiprocessing Queue to a child process
+        if eventQueue is None:
+            eventQueue = queue.Queue()
+        self.subscribers.append(eventQueue)
+        return eventQueue
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def latest(self):
+        with self.lock:
+            return self.seq, self.status
+
+    # The status also has the monotonicTime() of the start of this poll ('polltime') and of the previous one
+    # ('prevpolltime'), a change of the status happened between the two.
+    def run(self):
+        prev = None
+        prevpolltime = 0.0
+        while not self.stopEvent.is_set():
+            polltime = monotonicTime()
+            status = self.service.poll(self.homedir)
+            status['polltime'] = polltime
+            status['prevpolltime'] = prevpolltime
+            prevpolltime = polltime
+            eventname = classifyPVTransition(prev, status)
+            with self.lock:
+                self.seq = self.seq + 1
+                self.status = status
+            if eventname is not None:
+                pvevent = {'event': eventname, 'time': polltime, 'status': status}
+                for subscriber in self.subscribers:
+                    try:
+                        subscriber.put(pvevent)
+                    except:
+                        pass
+            prev = status
+            self.stopEvent.wait(max(0.0, self.pollPeriod - (monotonicTime() - polltime)))
+
+
+# Name of the transition between two PV polls, or None if nothing changed.
+def classifyPVTransition(prev, status):
+    keys = ['psid', 'expno', 'experimentstatus', 'scanstatus', 'datapath']
+    if prev is None:
+        return 'StatusChanged'
+    if [prev.get(k) for k in keys] == [status.get(k) for k in keys]:
+        return None
+    if prev['psid'] == '' and status['psid'] != '':
+        return 'ScanStarted'
+    if prev['psid'] != '' and status['psid'] == '':
+        return 'ScanStopped'
+    if prev['expno'] != status['expno']:
+        return 'ExpnoChanged'
+    if prev['experimentstatus'] == 'Setup' and status['experimentstatus'] == 'Scan':
+        return 'SetupToScan'
+    return 'StatusChanged'
+
+
+# Applies the newest PV status (from the PVMonitor) and starts/stops the recording accordingly.
+def MonitorPVstatus(param, statusparam, pvstatus):
 
     #if statusparam.internalRunMonitor == True:
     #    return statusparam
 
-    try:
-        #this gets the data path associated with the GUI creator
-        cmd="pvcmd -a ParxServer -r ListPs | grep 'DSET PATH' | awk '{printf(\"%s\", $3)}'"
-        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        dsetpath, error = process.communicate()
-	    #print(dsetpath)
-        statusparam.studypath = dsetpath.split('pdata')[0]
-        statusparam.datapath = statusparam.studypath.rstrip('/') #remove the trailing slash
-        statusparam.datapath = statusparam.datapath.rsplit('/',1)[0] #remove the last expno 
-
-        if (statusparam.datapath == None) or (statusparam.datapath == ""):
-            statusparam.datapath = param.homedir
-            statusparam.studypath = param.homedir
-
-        #cmd="pvcmd -a ParxServer -r DsetGetPath -psid " + gui_psid + " -path STUDY"
-        #process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        #statusparam.studypath, error = process.communicate()
-        # print(statusparam.studypath)
-    except:
-        statusparam.studypath = param.homedir
-        statusparam.datapath = statusparam.studypath
-
-    #this gets the scan that is currently running since it was started from the 'pipemaster' parent
-    cmd="pvcmd -a ParxServer -r ListPs | grep -B 3 'pipeMaster' | grep -m 1 PSID | awk '{printf(\"%s\", $2)}'"
-    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    statusparam.psid, error = process.communicate()
-    #print(statusparam.psid)
+    # One ListPs (plus the scan status while a scan is active) per poll, see PVStatusService.
+    statusparam.studypath = pvstatus['studypath']
+    statusparam.datapath = pvstatus['datapath']
+    statusparam.psid = pvstatus['psid']
+    statusparam.expno = pvstatus['expno']
+    statusparam.experimentstatus = pvstatus['experimentstatus']
+    # Scan timing for the ScanTime/Rep columns: the scan started between the previous poll and this one, the middle
+    # of the two is the best estimate (the capture process refines it with the trigger edges if there are any).
+    if pvstatus['scanstatus'] == 'SCANNING':
+        if statusparam.scanstatus != 'SCANNING' or statusparam.ScanStartTime == 0.0:
+            polltime = pvstatus.get('polltime', monotonicTime())
+            prevpolltime = pvstatus.get('prevpolltime', 0.0)
+            if prevpolltime > 0.0:
+                statusparam.ScanStartTime = (prevpolltime + polltime) / 2.0
+            else:
+                statusparam.ScanStartTime = polltime
+        statusparam.RepetitionTime = pvstatus.get('reptime', 0.0)
+    else:
+        statusparam.ScanStartTime = 0.0
+    statusparam.scanstatus = pvstatus['scanstatus']
+    if pvstatus.get('error', False):
+        return statusparam
 
     if len(statusparam.psid)>0:
-        try:
-            #print "Scan Active, PSID: "+psid
-            cmd="pvcmd -a ParxServer -r DsetGetPath -psid "+statusparam.psid+" -path EXPNO"
-            process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            statusparam.datapath, error = process.communicate()
-            statusparam.datapath = statusparam.datapath.split('pdata')[0] #if pdata exists remove everything after
-            statusparam.datapath = statusparam.datapath.rstrip('/')
-            print(statusparam.datapath)
-            pathlist=string.rsplit(statusparam.datapath,'/',1)
-            expno=pathlist[1]
-            statusparam.expno = expno
-            statusparam.datapath = pathlist[0] #now get the main subject path
-
-
-            cmd="pvcmd -a ParxServer -r ParamGetValue -psid "+statusparam.psid+" -param SUBJECT_study_instance_uid"
-            process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            studyRegID, error = process.communicate()
-
-
-            cmd="pvcmd -a ParxServer -r ParamGetValue -psid "+statusparam.psid+" -param ACQ_scan_type"
-            process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            statusparam.experimentstatus, error = process.communicate()
-            # print(statusparam.experimentstatus)
-            statusparam.experimentstatus = statusparam.experimentstatus.split("_")[0] #Scan or Setup
-            if not (statusparam.experimentstatus in ["Scan","Setup"]):
-                 statusparam.experimentstatus = 'Idle'
-            #    return statusparam
-
-            cmd="pvcmd -a JPingo -r DSetServer.GetScanStatus -registration "+studyRegID+" -expno "+expno
-            process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            statusparam.scanstatus, error = process.communicate()
-            if not (statusparam.scanstatus in ["SCANNING","RECO","ADJUST"]):
-                 statusparam.scanstatus = 'Idle'
-            #    return statusparam
-        except:
-            statusparam.expno = '0'
-            statusparam.scanstatus = "Idle"
-            statusparam.experimentstatus = "Idle"
-            return statusparam
-
         if statusparam.internalRunMonitor == True:
             if statusparam.captureProcessStarted == False:
                 StartRecording(param, statusparam)
@@ -733,11 +1490,11 @@ def MonitorPVstatus(param, statusparam):
 
             if statusparam.newscan==1 and (statusparam.scanstatus=="SCANNING" or statusparam.scanstatus == "RECO") and (statusparam.experimentstatus == "Scan"):
                 StartRecording(param, statusparam)
+            elif statusparam.captureProcessStarted == True:
+                # the status and scan timing columns follow the scan (SCANNING, RECO)
+                UpdateRecording(param, statusparam)
 
     else:
-        statusparam.scanstatus = "Idle"
-        statusparam.experimentstatus = "Idle"
-        statusparam.expno = '0'
         if statusparam.internalRecordingStatus == True:
             # print('Recording; Stopping')
             StopRecording(param, statusparam)
@@ -766,6 +1523,10 @@ def FormattedLine(headerList,dataList):
 
 def StartRecording(param, statusparam):
 
+    # a new scan can start before the previous one was seen to stop, finish that recording first
+    if statusparam.captureProcessStarted == True:
+        statusparam = StopCaptureProcess(param, statusparam)
+
     if statusparam.internalRecordingStatus == True:
         dstr=datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
         statusparam.logPath = statusparam.datapath+"/PhysioRecordingLog"+dstr+".txt"
@@ -814,7 +1575,7 @@ def StartRecording(param, statusparam):
     headerList = ["Count", "TimeMS"]
 
     if param.AddExpAndStatus == True:
-        headerList.extend(["ScanStat","ExpStat","Exp"])
+        headerList.extend(["ScanStat","ExpStat","Exp","ScanTime","Rep"])
     # No spaces in custom values allowed.
     if param.CustomEnabledFlag == True:
         headerList.append(param.CustomLabel1.replace(" ", ""))
@@ -823,80 +1584,55 @@ def StartRecording(param, statusparam):
             if param.CustomEnabled3 == True:
                 headerList.append(param.CustomLabel3.replace(" ", "")) 
 
-    headerList.extend(param.currentChannelMetricList)
+    headerList.extend(logChannelMetrics(param))
     headerList.append("Warnings")
     headerOut = FormattedLine(headerList, headerList)
     param.LogHeaderWindow.update(headerOut)
+    if param.Waveforms is not None:
+        param.Waveforms.reset(logChannelMetrics(param))
 
 
-    #start the logger in a separate process
-    statusparam.ParentToCaptureQueue  = Queue()
-    statusparam.CaptureToParentQueue = Queue()
-    p = Process(target=CaptureAndWriteLog, args=(statusparam.fileHandle, param, statusparam.ParentToCaptureQueue, statusparam.CaptureToParentQueue))
+    # the device may have been reset since it was configured
+    if param.isU3 == True:
+        param = checkU3Configuration(param)
+
+    statusparam.logBasePath = statusparam.logPath
+    statusparam.logSegment = 1
+    statusparam = startCaptureProcess(param, statusparam)
     statusparam.recordingstatus = "Recording"
-    statusparam.captureProcess = p
-    statusparam.captureProcess.start()
-    statusparam.captureProcessStarted = True
-    #p.join() # this blocks until the process terminates, which we don't want
     statusparam.prevDset=statusparam.datapath
     statusparam.newscan=0
 
-    #Include experiment number and scan status if continuous logging
-    if param.AddExpAndStatus == True:
-        customstring = statusparam.scanstatus + "," + statusparam.experimentstatus + "," + statusparam.expno
-    else:
-        customstring = ""
+    return statusparam
 
-    # No spaces in custom values allowed.
-    if param.CustomEnabled1 == True:
-        customstring = customstring + "," + statusparam.CustomValue1.replace(" ","")
-        if param.CustomEnabled2 == True:
-            customstring = customstring + "," + statusparam.CustomValue2.replace(" ","")
-            if param.CustomEnabled3 == True:
-                customstring = customstring + "," + statusparam.CustomValue3.replace(" ","")
-        
-    if (param.AddExpAndStatus == True) or (param.CustomEnabled1 == True):    
-        # Overwrite the status in the queue by removing the old one if needed
-        #while not statusparam.ParentToCaptureQueue.empty():
-        #    statusparam.ParentToCaptureQueue.get_nowait()  # Remove the current items to replace it
-	while True:
-	    try:
-        	statusparam.ParentToCaptureQueue.get_nowait()  # Remove the current items to replace it
-	    except: # Queue.Empty:
-		break
-        statusparam.ParentToCaptureQueue.put(customstring)
 
+#start the logger in a separate process, writing to statusparam.fileHandle.
+#segmentNote is a comment line for the log after the header (see RestartCaptureProcess).
+def startCaptureProcess(param, statusparam, segmentNote=None):
+    statusparam.ParentToCaptureQueue  = Queue()
+    statusparam.CaptureToParentQueue = Queue()
+    # the scan status and custom values are in shared memory, written before the start so the first row has them
+    statusparam.StatusSlot = SharedStatusSlot()
+    updateStatusSlot(param, statusparam)
+    statusparam.Heartbeat = CaptureHeartbeat()
+    statusparam.HeartbeatRateSamples = 0
+    statusparam.HeartbeatRateTime = monotonicTime()
+    p = Process(target=CaptureAndWriteLog, args=(statusparam.fileHandle, param, statusparam.ParentToCaptureQueue, statusparam.CaptureToParentQueue,
+                                                 statusparam.StatusSlot, statusparam.Heartbeat, segmentNote))
+    statusparam.captureProcess = p
+    statusparam.captureLogPath = statusparam.fileHandle.name
+    with subprocessLock: #not while Popen is starting a pvcmd process (see subprocessLock)
+        statusparam.captureProcess.start()
+    statusparam.captureProcessStarted = True
+    #p.join() # this blocks until the process terminates, which we don't want
     return statusparam
 
 
 def UpdateRecording(param, statusparam):
     statusparam.recordingstatus = "Recording"
     if statusparam.captureProcess.is_alive()==1:
-        #Include experiment number and scan status if continuous logging
-        if param.AddExpAndStatus == True:
-            customstring = statusparam.scanstatus + "," + statusparam.experimentstatus + "," + statusparam.expno
-        else:
-            customstring = ""
-
-        # No spaces in custom values allowed.
-        if param.CustomEnabled1 == True:
-            customstring = customstring + "," + statusparam.CustomValue1.replace(" ","")
-            if param.CustomEnabled2 == True:
-                customstring = customstring + "," + statusparam.CustomValue2.replace(" ","")
-                if param.CustomEnabled3 == True:
-                    customstring = customstring + "," + statusparam.CustomValue3.replace(" ","")
-            
-        if (param.AddExpAndStatus == True) or (param.CustomEnabled1 == True):   
-            #while not statusparam.ParentToCaptureQueue.empty():
-            #    statusparam.ParentToCaptureQueue.get_nowait()  # Remove the current items to replace it 
-	    # the old while/get_nowait code was throwing errors and halding the program.
-	    # this while/try/except loop seems to be the more preferred option to handle emptying more directly and safely.  Needs to be tested to determine if it works.
-	    while True:
-	        try:
-        	    statusparam.ParentToCaptureQueue.get_nowait()  # Remove the current items to replace it
-	        except:# Queue.empty:
-		    break
-            statusparam.ParentToCaptureQueue.put(customstring)
+        # the capture process picks up the new values with the next sample
+        updateStatusSlot(param, statusparam)
     
     return statusparam
 
@@ -906,12 +1642,79 @@ def StopRecording(param, statusparam):
     statusparam.recordingstatus = "Monitoring"
     statusparam.scanstatus = 'Idle'
     statusparam.experimentstatus = 'Idle'
-    try:
-        if statusparam.captureProcess.is_alive()==1:
+    statusparam = StopCaptureProcess(param, statusparam)
+    statusparam.prevDset=""
+
+    return statusparam
+
+
+# Maximum time the capture process gets to finish after the stop message: the current sample period
+# (or stream block) plus writing the last rows and the trailer.
+def captureStopTimeout(param):
+    timeout = 2.0 + 2.0 * param.SamplePeriod
+    if param.AcquisitionMode == 'Stream':
+        timeout = timeout + 1200.0 / max(1.0, param.StreamScanFrequency) #one streamData() request of 48 packets
+    return timeout
+
+
+# Shows what the capture process has sent for display. Everything waiting is read, but of the data rows
+# (('row', text) messages, see CaptureAndWriteLog) only the newest one before each message is shown.
+# ('timing', text) messages go to the Sample Timing line.
+def drainCaptureQueue(param, statusparam):
+    latestrow = None
+    while True:
+        try:
+            captureout = statusparam.CaptureToParentQueue.get(block=False)
+        except:
+            break
+        if isinstance(captureout, tuple):
+            if captureout[0] == 'timing':
+                if param.TimingWindow is not None:
+                    param.TimingWindow.update(captureout[1])
+            elif captureout[0] == 'plot':
+                if param.Waveforms is not None:
+                    param.Waveforms.add(captureout[1], captureout[2])
+            else:
+                latestrow = captureout[1]
+            continue
+        if latestrow is not None:
+            param.LogWindow.update(latestrow, append=True)
+            latestrow = None
+        param.LogWindow.update(captureout, append=True)
+    if latestrow is not None:
+        param.LogWindow.update(latestrow, append=True)
+    if param.Waveforms is not None:
+        param.Waveforms.draw()
+
+
+# Shutdown handshake with the capture process: the stop message is sent on the control queue, the child
+# writes its last rows and the trailer and exits. The display queue is read while waiting so the child
+# is never blocked on a full queue. terminate() is only used if the child does not exit in time
+# (its SIGTERM handler still flushes the logs). The file and queues are closed after the child is gone.
+def StopCaptureProcess(param, statusparam):
+    proc = statusparam.captureProcess
+    if proc is not None:
+        if proc.is_alive():
+            try:
+                statusparam.ParentToCaptureQueue.put(('stop',))
+            except:
+                pass
+            deadline = monotonicTime() + captureStopTimeout(param)
+            while proc.is_alive() and monotonicTime() < deadline:
+                drainCaptureQueue(param, statusparam)
+                proc.join(0.05)
+            if proc.is_alive():
+                param.LogWindow.update("Capture process did not stop, terminating.\n", append=True)
+                proc.terminate()
+                proc.join(1.0)
+            if proc.is_alive():
+                # stuck (e.g. in a device call), SIGTERM is only handled between samples
+                os.kill(proc.pid, signal.SIGKILL)
+                proc.join(1.0)
+            drainCaptureQueue(param, statusparam)
             param.LogWindow.update("Stopped Logging.\n", append=True)
-            statusparam.captureProcess.terminate()
-    except:
-        pass
+        drainCaptureQueue(param, statusparam)
+    statusparam.captureLogPath = ''
     try:
         if statusparam.fileHandle.closed==0:
             statusparam.fileHandle.close()
@@ -922,40 +1725,350 @@ def StopRecording(param, statusparam):
         statusparam.ParentToCaptureQueue.close()
     except:
         pass
+    statusparam.captureProcess = None
     statusparam.captureProcessStarted = False
-    statusparam.prevDset=""
+    statusparam.StatusSlot = None
+    statusparam.Heartbeat = None
+    if param.CaptureWindow is not None:
+        param.CaptureWindow.update("")
 
     return statusparam
 
 
+# Watchdog of the capture process, called from the gui loop while recording. Shows the samples/s and the lag
+# (age of the newest sample) from the heartbeat once a second, and restarts the capture process if it has exited
+# or its heartbeat is older than WatchdogTimeout plus the time a sample may take (captureStopTimeout).
+# After a restart the next one waits at least WatchdogTimeout, so a persistent error does not restart it continuously.
+def superviseCaptureProcess(param, statusparam):
+    if statusparam.Heartbeat is None:
+        return statusparam
+    samples, lastSampleTime, beatTime, state = statusparam.Heartbeat.read()
+    now = monotonicTime()
+    if now - statusparam.HeartbeatRateTime >= 1.0:
+        rate = (samples - statusparam.HeartbeatRateSamples) / (now - statusparam.HeartbeatRateTime)
+        statusparam.HeartbeatRateSamples = samples
+        statusparam.HeartbeatRateTime = now
+        if param.CaptureWindow is not None:
+            lag = (now - lastSampleTime) if samples > 0 else 0.0
+            text = "{} samples, {:.1f} samples/s, lag {:.2f} s, {}".format(samples, rate, lag, state)
+            if statusparam.logSegment > 1:
+                text = text + ", segment " + str(statusparam.logSegment)
+            param.CaptureWindow.update(text, text_color='black' if state in ('Starting', 'Sampling') else 'red')
+
+    if not statusparam.captureProcess.is_alive():
+        reason = "exited (" + state + ")"
+    elif now - beatTime > param.WatchdogTimeout + captureStopTimeout(param):
+        reason = "stalled for " + str(int(now - beatTime)) + " s"
+    else:
+        return statusparam
+    if now - statusparam.LastRestartTime < param.WatchdogTimeout:
+        return statusparam
+    statusparam.LastRestartTime = now
+    return RestartCaptureProcess(param, statusparam, reason, samples, lastSampleTime if samples > 0 else beatTime)
+
+
+# Stops what is left of the capture process and continues the recording in a new segment of the log,
+# <log>_seg<N>.txt, with the same header. The outage (from the last sample of the old process to the start of the
+# new one) is written to both files as a comment line.
+def RestartCaptureProcess(param, statusparam, reason, samples, lastSampleTime):
+    outageStart = datetime.datetime.now() - datetime.timedelta(seconds=monotonicTime() - lastSampleTime)
+    oldPath = statusparam.captureLogPath
+    param.LogWindow.update("Capture process " + reason + ", restarting.\n", append=True)
+    statusparam = StopCaptureProcess(param, statusparam)
+
+    statusparam.logSegment = statusparam.logSegment + 1
+    statusparam.logPath = os.path.splitext(statusparam.logBasePath)[0] + "_seg" + str(statusparam.logSegment) + ".txt"
+    try:
+        statusparam.fileHandle = open(statusparam.logPath,"w",buffering=0)
+    except:
+        param.LogWindow.update("Could not open logging file\n", append=True)
+        print(statusparam.logPath)
+        return statusparam
+    outage = "capture process " + reason + ", no samples from " + outageStart.isoformat() + " (after " + str(samples) + \
+             " samples) to " + datetime.datetime.now().isoformat()
+    try:
+        with open(oldPath, "a") as fh:
+            fh.write("# " + outage + ", continued in " + os.path.basename(statusparam.logPath) + "\n")
+    except:
+        pass
+    statusparam = startCaptureProcess(param, statusparam, "segment " + str(statusparam.logSegment) + " of " +
+                                      os.path.basename(statusparam.logBasePath) + ", " + outage)
+    param.LogWindow.update("Logging to " + statusparam.logPath + "\n", append=True)
+    return statusparam
+
+
+"""
+Shared status for the capture process
+"""
+# The newest scan status and custom values, in shared memory. The parent overwrites them (updateStatusSlot) and the
+# capture process reads them when the sequence number has changed, without any queue messages or string parsing.
+# Sequence lock: the writer makes the sequence number odd while it writes the fields and even again when done, a reader
+# that sees an odd or changed sequence number reads again, so a half written update is never used.
+# There is one writer (the gui loop of the parent process).
+StatusSlotFields = ['ScanStatus', 'ExpStatus', 'Exp', 'Custom1', 'Custom2', 'Custom3']
+StatusSlotFieldWidth = 32 #bytes per field, longer values are cut
+StatusSlotNumbers = ['ScanStartTime', 'RepetitionTime']
+
+class SharedStatusSlot:
+    def __init__(self):
+        self.sequence = Value('L', 0, lock=False)
+        self.fields = Array('c', len(StatusSlotFields) * StatusSlotFieldWidth, lock=False)
+        self.numbers = Array('d', len(StatusSlotNumbers), lock=False)
+
+    def write(self, values, numbers=None):
+        data = b''.join([value.encode('utf-8')[0:StatusSlotFieldWidth].ljust(StatusSlotFieldWidth, b'\0') for value in values])
+        self.sequence.value = self.sequence.value + 1 #odd: update in progress
+        self.fields[0:len(data)] = data
+        if numbers is not None:
+            self.numbers[0:len(numbers)] = numbers
+        self.sequence.value = self.sequence.value + 1
+
+    # sequence number of the last complete update, to check for a new one without reading the fields
+    def sequenceNumber(self):
+        return self.sequence.value & ~1
+
+    # returns (sequence number, list of the field values, list of the numbers)
+    def read(self):
+        while True:
+            before = self.sequence.value
+            if before & 1:
+                time.sleep(0) #a write is in progress
+                continue
+            data = self.fields.raw
+            numbers = self.numbers[:]
+            if self.sequence.value == before:
+                break
+        values = []
+        for i in range(len(StatusSlotFields)):
+            value = data[i * StatusSlotFieldWidth:(i + 1) * StatusSlotFieldWidth].rstrip(b'\0')
+            values.append(value.decode('utf-8', 'ignore'))
+        return before, values, numbers
+
+
+# Writes the scan status and the custom values of statusparam to the capture process.
+def updateStatusSlot(param, statusparam):
+    if statusparam.StatusSlot is None:
+        return
+    # No spaces or commas in custom values allowed (the log is comma separated).
+    customValues = [statusparam.CustomValue1, statusparam.CustomValue2, statusparam.CustomValue3]
+    customValues = [value.replace(" ", "").replace(",", "") for value in customValues]
+    statusparam.StatusSlot.write([statusparam.scanstatus, statusparam.experimentstatus, statusparam.expno] + customValues,
+                                 [statusparam.ScanStartTime, statusparam.RepetitionTime])
+
+
+# Liveness of the capture process for the gui, in shared memory (only written by the capture process): the number of
+# samples written, the monotonicTime() of the newest sample and of the last sign of life (a sample or a reconnect
+# attempt), and the state. The values are written one at a time without a lock, a read may mix two updates, which
+# does not matter for the display and the watchdog.
+HeartbeatStates = ['Starting', 'Sampling', 'Reconnecting', 'Stopped', 'Error']
+
+class CaptureHeartbeat:
+    def __init__(self):
+        self.values = Array('d', 4, lock=False) #samples, last sample time, beat time, state index
+        self.values[2] = monotonicTime()
+
+    def sample(self, samples, t):
+        self.values[0] = samples
+        self.values[1] = t
+        self.values[2] = t
+        self.values[3] = 1
+
+    def setState(self, state):
+        self.values[2] = monotonicTime()
+        self.values[3] = HeartbeatStates.index(state)
+
+    # returns (samples, last sample time, beat time, state)
+    def read(self):
+        samples, lastSampleTime, beatTime, state = self.values[0:4]
+        return int(samples), lastSampleTime, beatTime, HeartbeatStates[int(state)]
+
+
 """
 Functions for recording of values through the labjack
 """
+# The lines of the U3 are configured explicitly from ChannelConfig: the connected FIO/EIO lines are analog inputs
+# and all others digital (the TriggerChannel is a digital input, see configureTriggerInput). configIO() without
+# arguments only reads the configuration back, which is used to verify the device.
+U3ConfigurationKeys = ['FIOAnalog', 'EIOAnalog', 'EnableCounter0', 'NumberOfTimersEnabled', 'TimerCounterPinOffset']
+
+
+def u3AnalogMasks(param):
+    FIOAnalog = 0
+    EIOAnalog = 0
+    for line in param.ChannelConfig:
+        if line < 8:
+            FIOAnalog = FIOAnalog | (1 << line)
+        elif line < 16:
+            EIOAnalog = EIOAnalog | (1 << (line - 8)) #EIO0 is line 8
+    return FIOAnalog, EIOAnalog
+
+
+def readU3Configuration(device):
+    config = device.configIO()
+    return dict([(key, config.get(key)) for key in U3ConfigurationKeys])
+
+
+def configureU3IO(param):
+    FIOAnalog, EIOAnalog = u3AnalogMasks(param)
+    AnalogConfig = param.deviceU3.configIO(FIOAnalog=FIOAnalog, EIOAnalog=EIOAnalog)
+    param = configureTriggerInput(param, AnalogConfig)
+    param.U3Configuration = readU3Configuration(param.deviceU3)
+    if (param.U3Configuration['FIOAnalog'] & FIOAnalog) != FIOAnalog or (param.U3Configuration['EIOAnalog'] & EIOAnalog) != EIOAnalog:
+        raise IOError("LabJack U3 did not accept the analog configuration " + str(param.U3Configuration))
+    return param
+
+
+# Checks the configuration of the U3 before a recording (a single configIO read, so nothing is checked while
+# sampling), and configures it again if it was changed (e.g. the device was reset).
+def checkU3Configuration(param):
+    try:
+        if readU3Configuration(param.deviceU3) == param.U3Configuration:
+            return param
+        param.LogWindow.update("LabJack configuration changed, configuring it again.\n", append=True)
+        param = configureU3IO(param)
+    except:
+        param.LogWindow.update("LabJack configuration check failed: " + str(sys.exc_info()[1]) + "\n", append=True)
+    return param
+
+
+# The configuration and the calibration constants of the U3 are cached in SARecorderU3.json with a checksum,
+# so opening the device again only has to verify the configuration instead of reading the calibration from the
+# device flash. The cache is only used for the same device (serial number), ChannelConfig and TriggerChannel.
+def u3CacheChecksum(cache):
+    content = dict([(key, cache[key]) for key in cache if key != 'Checksum'])
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def loadU3Cache(param, serialNumber):
+    try:
+        with open(param.u3cachefile) as fh:
+            cache = json.load(fh)
+        if cache.get('Checksum') != u3CacheChecksum(cache):
+            print("LabJack cache " + param.u3cachefile + " is corrupted, not used.")
+            return None
+    except:
+        return None
+    if cache['SerialNumber'] != serialNumber or cache['ChannelConfig'] != list(param.ChannelConfig) or cache['TriggerChannel'] != param.TriggerChannel:
+        return None
+    return cache
+
+
+def saveU3Cache(param, serialNumber):
+    cache = {'SerialNumber': serialNumber, 'ChannelConfig': list(param.ChannelConfig), 'TriggerChannel': param.TriggerChannel,
+             'Configuration': param.U3Configuration, 'TriggerCounter': param.TriggerCounter,
+             'CalibrationData': param.deviceU3.calData}
+    cache['Checksum'] = u3CacheChecksum(cache)
+    try:
+        with open(param.u3cachefile, 'w') as fh:
+            json.dump(cache, fh, indent=1, sort_keys=True)
+    except:
+        print("Could not write the LabJack cache " + param.u3cachefile)
+
+
+# The scanner trigger input (TriggerChannel, a spare FIO not in ChannelConfig) is a digital input with Counter0 of the
+# U3 on it, so no trigger pulse is missed between the feedback samples (the counter counts the falling edges).
+# In stream mode the digital state of the FIO lines (stream channel 193) is also scanned with the analog inputs,
+# which gives the time of each edge to within one scan (1/StreamScanFrequency). If the counter can not be enabled
+# on the line (the U3 counters are on FIO4 or higher), the line is read with BitStateRead instead.
+def configureTriggerInput(param, AnalogConfig):
+    param.TriggerCounter = False
+    triggerChannel = triggerChannelNumber(param)
+    if triggerChannel is None:
+        return param
+    if triggerChannel in param.ChannelPositive:
+        print("TriggerChannel FIO" + str(triggerChannel) + " is connected to an analog input, not used.")
+        param.TriggerChannel = 'None'
+        return param
+    FIOAnalog = AnalogConfig.get('FIOAnalog', 0xFF) & ~(1 << triggerChannel)
+    try:
+        param.deviceU3.configIO(FIOAnalog=FIOAnalog, EnableCounter0=True, NumberOfTimersEnabled=0, TimerCounterPinOffset=triggerChannel)
+        param.TriggerCounter = True
+    except:
+        print("Could not enable the counter on FIO" + str(triggerChannel) + ", reading the trigger line state instead.")
+        param.deviceU3.configIO(FIOAnalog=FIOAnalog)
+    param.deviceU3.getFeedback(u3.BitDirWrite(triggerChannel, 0)) #input
+    return param
+
+
+# Opens the U3 (or the SimulatedU3) and configures it, raises if that fails. Also used by the capture process to
+# open the device again after a device error (see reconnectU3).
+# The device backends, each a function that opens the device of param. The acquisition only uses these calls of
+# the u3.U3 class, which another backend (simulated or a different DAQ) provides in the same way:
+#     configU3()                         dict with SerialNumber and VersionInfo
+#     configIO(**kwargs), getCalibrationData(), close()
+#     getFeedback(commands)              u3.AIN (raw 16 bit value), u3.BitStateRead, u3.BitDirWrite, u3.Counter0
+#     binaryToCalibratedAnalogVoltage(bits, isLowVoltage, channelNumber=...)
+#     streamConfig(...), streamStart(), streamData() (dicts of AIN<n> lists), streamStop()
+# Errors are raised as exceptions, the acquisition then reconnects by opening the backend again.
+def openHardwareU3(param):
+    if param.DeviceSerial != '':
+        device = u3.U3(firstFound=False, serial=int(param.DeviceSerial))
+    else:
+        device = u3.U3()  # Opens first found U3 over USB; this does an auto open
+    if not isinstance(device, u3.U3):
+        return None
+    return device
+
+
+def openSimulatedU3(param):
+    return SimulatedU3(zip(param.currentChannelPositiveList, param.currentChannelMetricList), param.Simulation,
+                       param.CalibrationRules)
+
+
+def openReplayU3(param):
+    return ReplayU3(param.ReplayLog, param.currentChannelPositiveList, param.currentChannelMetricList,
+                    param.CalibrationRules, param.ReplaySpeed)
+
+
+DeviceBackends = {'U3': openHardwareU3, 'Simulated': openSimulatedU3, 'Replay': openReplayU3}
+
+
+def openU3Device(param):
+    if not param.DeviceBackend in DeviceBackends:
+        raise ValueError("Unknown device backend " + str(param.DeviceBackend))
+    param.deviceU3 = DeviceBackends[param.DeviceBackend](param)
+    if param.deviceU3 is None:
+        raise IOError("No LabJack U3 found")
+
+    deviceConfig = param.deviceU3.configU3()
+    serialNumber = deviceConfig.get('SerialNumber')
+    cache = loadU3Cache(param, serialNumber)
+
+    # Configure the connected FIO and EIO lines as analog inputs (see configureU3IO), unless the device
+    # still has the configuration of the cache.
+    if cache is not None and readU3Configuration(param.deviceU3) == cache['Configuration']:
+        param.U3Configuration = cache['Configuration']
+        param.TriggerCounter = cache['TriggerCounter']
+        print("LabJack U3 configuration verified.")
+    else:
+        param = configureU3IO(param)
+    print(param.U3Configuration)
+
+    # Check if the U3 is an HV
+    if deviceConfig['VersionInfo'] & 18 == 18:
+        param.isHV = True
+        param.lowVoltage = False
+    else:
+        param.isHV = False
+        param.lowVoltage = True
+
+    # the calibration constants are read from the device flash only if not cached
+    if cache is not None:
+        param.deviceU3.calData = cache['CalibrationData']
+    else:
+        param.deviceU3.getCalibrationData()
+    print(param.deviceU3.calData)
+    saveU3Cache(param, serialNumber)
+    return param
+
+
 def openandConfigureU3(param):
     print("Trying to open LabJack U3 device.\n")
     param.isU3 = False
     try:
-        param.deviceU3 = u3.U3()  # Opens first found U3 over USB; this does an auto open
-
-        if isinstance(param.deviceU3, u3.U3):
-            # Configure all FIO and EIO lines to analog inputs.
-            #AnalogConfig = param.deviceU3.configIO(FIOAnalog=0xFF, EIOAnalog=0xFF)
-            AnalogConfig = param.deviceU3.configIO()
-            print(AnalogConfig)
-            param.isU3 = True
-
-            # Check if the U3 is an HV
-            if param.deviceU3.configU3()['VersionInfo'] & 18 == 18:
-                param.isHV = True
-                param.lowVoltage = False
-            else:
-                param.isHV = False
-                param.lowVoltage = True
-
-            param.deviceU3.getCalibrationData()
-            print(param.deviceU3.calData)
-		
-            print("LabJack U3 device Enabled.\n")
+        param = openU3Device(param)
+        param.isU3 = True
+        print("LabJack U3 device Enabled.\n")
     except:
         print("LabJack U3 device failed to enable.\n")
         param.isU3 = False
@@ -986,53 +2099,935 @@ def openandConfigureU3(param):
     return param
 
 
+class SimulatedU3:
+    # Stand-in for u3.U3 when the program is started with --simulate (the 'Simulated' backend).
+    # Only the calls used by this program are provided. channels is a list of (positive channel, metric): the inputs of
+    # the metrics in settings['Waveforms'] follow their waveform (see simulatedWaveformValue), converted to voltages
+    # with the calibration rules; the other analog inputs return a slow sine wave (in the 0-2.4V range of the low
+    # voltage inputs) so the feedback and stream paths can be tested without hardware.
+    # settings (SimulationDefaults) also has the time each getFeedback call takes (Latency, plus LatencyPerCommand for
+    # each command in it) and the scale of the noise.
+    # With faultPeriod set, the device fails at the end of every faultPeriod seconds for faultDuration seconds:
+    # the calls raise and it can not be opened, like an unplugged device. It is back with the power up configuration.
+    faultPeriod = 0.0
+    faultDuration = 0.5
+    faultEpoch = None
+
+    def __init__(self, channels=(), settings=None, ruleSet=None):
+        if SimulatedU3.faultEpoch is None:
+            SimulatedU3.faultEpoch = time.time()
+        if settings is None:
+            settings = SimulationDefaults
+        if settings['FaultPeriod'] > 0:
+            self.faultPeriod = settings['FaultPeriod']
+            self.faultDuration = settings['FaultDuration']
+        self.checkFault()
+        self.latency = settings['Latency']
+        self.latencyPerCommand = settings['LatencyPerCommand']
+        self.noiseScale = settings['NoiseScale']
+        # per channel: (waveform kind, arguments, value to voltage function)
+        self.waveforms = {}
+        for channel, metric in channels:
+            if metric in settings['Waveforms']:
+                kind, args = settings['Waveforms'][metric]
+                self.waveforms[channel] = (kind, args, voltageFunction(metric, ruleSet))
+        self.calData = {}
+        self.startTime = time.time()
+        self.streamChannels = []
+        self.streamScanFrequency = 0.0
+        self.streamScansPerRequest = 0
+        self.streamStarted = False
+        self.streamScanIndex = 0
+        self.streamStartTime = 0.0
+        self.ioConfig = {'FIOAnalog': 0x0F, 'EIOAnalog': 0, 'EnableCounter0': False, 'NumberOfTimersEnabled': 0,
+                         'TimerCounterPinOffset': 4} #power up defaults
+
+    def checkFault(self):
+        if self.faultPeriod > 0 and (time.time() - self.faultEpoch) % self.faultPeriod >= self.faultPeriod - self.faultDuration:
+            raise IOError("Simulated LabJack U3 fault")
+
+    def close(self):
+        self.streamStarted = False
+
+    def configIO(self, **kwargs):
+        self.checkFault()
+        for key in kwargs:
+            if kwargs[key] is not None:
+                self.ioConfig[key] = kwargs[key]
+        return dict(self.ioConfig)
+
+    def configU3(self):
+        return {'VersionInfo': 0, 'SerialNumber': 0}
+
+    def getCalibrationData(self):
+        return self.calData
+
+    def simulatedVoltage(self, channel, t):
+        if channel in self.waveforms:
+            kind, args, toVoltage = self.waveforms[channel]
+            return toVoltage(simulatedWaveformValue(kind, args, t))
+        # a different frequency per channel so they are distinguishable on screen
+        return 1.2 + 1.0 * math.sin(2.0 * math.pi * 0.1 * (channel + 1) * t)
+
+    # scanner trigger: a 50 ms TTL pulse every triggerPeriod seconds on all digital lines, counted by Counter0
+    triggerPeriod = 2.0
+    triggerWidth = 0.05
+
+    def simulatedTrigger(self, t):
+        return 1 if (t % self.triggerPeriod) < self.triggerWidth else 0
+
+    def simulatedCounter(self, t):
+        # falling edges (the end of each pulse) up to t
+        if t < self.triggerWidth:
+            return 0
+        return int((t - self.triggerWidth) // self.triggerPeriod) + 1
+
+    # rms noise (V) of the AIN readings per (QuickSample, LongSettling), for the --calibratesettling tests
+    settlingNoise = {(True, False): 0.0015, (True, True): 0.0015, (False, False): 0.0005, (False, True): 0.0003}
+
+    def getFeedback(self, commandlist):
+        self.checkFault()
+        if not isinstance(commandlist, list):
+            commandlist = [commandlist]
+        if self.latency > 0 or self.latencyPerCommand > 0:
+            time.sleep(self.latency + self.latencyPerCommand * len(commandlist)) #USB round trip and conversions
+        t = time.time() - self.startTime
+        results = []
+        for cmd in commandlist:
+            if isinstance(cmd, u3.AIN):
+                noise = self.settlingNoise[(cmd.quickSample, cmd.longSettling)] * self.noiseScale
+                voltage = self.simulatedVoltage(cmd.positiveChannel, t) + np.random.normal(0.0, noise)
+                results.append(int(voltage / 2.44 * 65535))
+            elif isinstance(cmd, u3.BitStateRead):
+                results.append(self.simulatedTrigger(t))
+            elif isinstance(cmd, u3.Counter0):
+                results.append(self.simulatedCounter(t))
+            else:
+                results.append(None)
+        return results
+
+    def binaryToCalibratedAnalogVoltage(self, bits, isLowVoltage=True, isSingleEnded=True, isSpecialSetting=False, channelNumber=0):
+        return bits / 65535.0 * 2.44
+
+    def streamConfig(self, NumChannels=1, PChannels=None, NChannels=None, Resolution=3, ScanFrequency=None, SamplesPerPacket=25):
+        self.streamChannels = list(PChannels)[0:NumChannels]
+        self.streamScanFrequency = float(ScanFrequency)
+        # same number of samples per streamData() request as the real device (48 packets of SamplesPerPacket)
+        self.streamScansPerRequest = max(1, (48 * SamplesPerPacket) // NumChannels)
+
+    def streamStart(self):
+        self.streamStarted = True
+        self.streamScanIndex = 0
+        self.streamStartTime = time.time()
+
+    def streamData(self, convert=True):
+        while self.streamStarted:
+            # wait until the device would have clocked this block of scans
+            blockEndTime = self.streamStartTime + (self.streamScanIndex + self.streamScansPerRequest) / self.streamScanFrequency
+            delay = blockEndTime - time.time()
+            while delay > 0:
+                self.checkFault()
+                time.sleep(min(delay, 0.05))
+                delay = blockEndTime - time.time()
+            self.checkFault()
+            block = {'errors': 0, 'missed': 0, 'numPackets': 48, 'firstPacket': 0}
+            for ch in self.streamChannels:
+                if ch == 193:
+                    # digital state of the FIO and EIO lines
+                    block['AIN193'] = [(0xFF * self.simulatedTrigger((self.streamScanIndex + n) / self.streamScanFrequency), 0)
+                                       for n in range(self.streamScansPerRequest)]
+                    continue
+                block['AIN%d' % ch] = [self.simulatedVoltage(ch, (self.streamScanIndex + n) / self.streamScanFrequency) for n in range(self.streamScansPerRequest)]
+                if self.noiseScale > 0:
+                    block['AIN%d' % ch] = list(np.array(block['AIN%d' % ch]) + np.random.normal(0.0, self.settlingNoise[(True, False)] * self.noiseScale, self.streamScansPerRequest))
+            self.streamScanIndex = self.streamScanIndex + self.streamScansPerRequest
+            yield block
+
+    def streamStop(self):
+        self.streamStarted = False
+
+
+# Simulated signal of a metric at t seconds, in the units of the metric:
+#     sine   center, amplitude, period         e.g. the respiration rate
+#     drift  center, amplitude, period         triangle wave, e.g. a slow temperature drift
+#     steps  duration, level, level, ...       each level for duration seconds, repeating, e.g. the Iso setting
+#     ttl    period, duty                      1 for the duty fraction of each period, else 0, e.g. the pump
+def simulatedWaveformValue(kind, args, t):
+    if kind == 'sine':
+        return args[0] + args[1] * math.sin(2.0 * math.pi * t / args[2])
+    if kind == 'drift':
+        return args[0] + args[1] * (4.0 * abs((t / args[2]) % 1.0 - 0.5) - 1.0)
+    if kind == 'steps':
+        return args[1 + int(t // args[0]) % (len(args) - 1)]
+    if kind == 'ttl':
+        return 1.0 if (t % args[0]) < args[1] * args[0] else 0.0
+    raise ValueError("Unknown waveform " + str(kind))
+
+
+SimulationDefaults = {'Latency': 0.0, 'LatencyPerCommand': 0.0, 'NoiseScale': 1.0, 'FaultPeriod': 0.0, 'FaultDuration': 0.5,
+                      'Waveforms': {'T1Temp': ('drift', [36.5, 1.0, 600.0]),
+                                    'PRespRate': ('sine', [60.0, 8.0, 30.0]),
+                                    'PRespPeriod': ('sine', [1000.0, 120.0, 30.0]),
+                                    'ECGRate': ('sine', [400.0, 20.0, 45.0]),
+                                    'BP1Mean': ('sine', [80.0, 10.0, 20.0]),
+                                    'Iso': ('steps', [60.0, 1.5, 2.0, 2.5, 2.0]),
+                                    'O2': ('steps', [120.0, 21.0, 30.0]),
+                                    'CO2': ('sine', [4.0, 0.5, 60.0]),
+                                    'ControlLine': ('ttl', [10.0, 0.2]),
+                                    'PumpStat': ('ttl', [30.0, 0.5])}}
+
+
+# Settings of the simulated device from the optional [Simulation] section of SARecorder.ini, e.g.
+#     [Simulation]
+#     Latency = 0.0015               ; seconds per getFeedback call
+#     LatencyPerCommand = 0.0002     ; seconds more for each command in the call
+#     NoiseScale = 2.0               ; times the noise of each settling profile
+#     FaultPeriod = 20               ; fail every 20 s for FaultDuration seconds (0: never)
+#     FaultDuration = 0.5
+#     Waveform.Iso = steps, 30, 1.0, 3.0     ; waveform, arguments (see simulatedWaveformValue)
+# An invalid setting is reported (configWarning) and keeps its default, the other settings are used.
+def loadSimulationSettings(param):
+    settings = dict(SimulationDefaults)
+    settings['Waveforms'] = dict(SimulationDefaults['Waveforms'])
+    config = ConfigParser(inline_comment_prefixes=ConfigCommentPrefixes)
+    try:
+        if os.path.exists(param.configfile):
+            config.read(param.configfile)
+    except:
+        configWarning(param, "Could not read " + param.configfile + ": " + str(sys.exc_info()[1]) + ", using the default simulation.")
+    if config.has_section('Simulation'):
+        options = config['Simulation']
+        for key in ['Latency', 'LatencyPerCommand', 'NoiseScale', 'FaultPeriod', 'FaultDuration']:
+            try:
+                settings[key] = float(options.get(key, str(settings[key])))
+            except ValueError:
+                configWarning(param, "Invalid " + key + " in [Simulation]: " + options[key] + ", using " + str(settings[key]))
+        for key in options:
+            if key.lower().startswith('waveform.'):
+                metric = [m for m in list(ConversionRules.keys()) + param.RateOptionsList + param.PoetOptionsList if m.lower() == key[len('waveform.'):]]
+                try:
+                    fields = [field.strip() for field in options[key].split(',')]
+                    waveform = (fields[0], [float(x) for x in fields[1:]])
+                    simulatedWaveformValue(waveform[0], waveform[1], 0.0) #an unknown waveform or missing arguments raise
+                except:
+                    configWarning(param, "Invalid " + key + " in [Simulation]: " + options[key] + " (" + str(sys.exc_info()[1]) + ")")
+                    continue
+                settings['Waveforms'][metric[0] if metric else key[len('waveform.'):]] = waveform
+    param.Simulation = settings
+    return param
+
+
+# A SimulatedU3 that plays back the channels of a recorded log (PhysioRecordingLog*.txt or .bin) instead of the
+# sine waves, so the whole recording path (sampling, conversion, logging, scan alignment) can be run and load tested
+# on a workstation. The recorded values of each metric are converted back to the voltages of its channel with the
+# inverse of its conversion rule (valueToVoltage); metrics that are not in the log keep the sine wave. The log time
+# runs speed times faster than real time and repeats at the end. With a Rep column the repetitions are replayed as
+# the trigger pulses.
+class ReplayU3(SimulatedU3):
+    def __init__(self, path, positiveList, metricList, ruleSet=None, speed=1.0):
+        SimulatedU3.__init__(self, (), dict(SimulationDefaults, NoiseScale=0.0))
+        self.speed = speed
+        columns = readLogColumns(path, list(metricList) + ['Rep'])
+        self.times = columns['TimeSec'] - columns['TimeSec'][0]
+        self.duration = self.times[-1] + (self.times[-1] / max(1, len(self.times) - 1))
+        self.voltages = {} #positive channel: recorded voltages
+        for channel, metric in zip(positiveList, metricList):
+            if metric in columns:
+                self.voltages[channel] = valueToVoltage(columns[metric], metric, ruleSet)
+        self.repTimes = None
+        if 'Rep' in columns:
+            rep = columns['Rep']
+            starts = np.nonzero((rep[1:] != rep[:-1]) & (rep[1:] >= 0))[0] + 1
+            if len(starts) > 0:
+                self.repTimes = self.times[starts]
+
+    def logTime(self, t):
+        # (repeat of the log, time in the log)
+        t = t * self.speed
+        return int(t // self.duration), t % self.duration
+
+    def simulatedVoltage(self, channel, t):
+        if not channel in self.voltages:
+            return SimulatedU3.simulatedVoltage(self, channel, t)
+        repeat, t = self.logTime(t)
+        return self.voltages[channel][max(0, np.searchsorted(self.times, t, 'right') - 1)]
+
+    def simulatedTrigger(self, t):
+        if self.repTimes is None:
+            return SimulatedU3.simulatedTrigger(self, t)
+        repeat, t = self.logTime(t)
+        i = np.searchsorted(self.repTimes, t, 'right') - 1
+        return 1 if i >= 0 and t - self.repTimes[i] < self.triggerWidth * self.speed else 0
+
+    def simulatedCounter(self, t):
+        if self.repTimes is None:
+            return SimulatedU3.simulatedCounter(self, t)
+        repeat, t = self.logTime(t)
+        return repeat * len(self.repTimes) + int(np.searchsorted(self.repTimes + self.triggerWidth * self.speed, t, 'right'))
+
+
+# The columns in names of a text or binary log (those it has) as float arrays, with 'TimeSec' the time of each row.
+# The text log has the time to 0.1 s only, so its rows are timed by Count and the mean sample period.
+def readLogColumns(path, names):
+    columns = {}
+    if path.endswith('.bin'):
+        header, records = readBinaryLog(path)
+        columns['TimeSec'] = np.array(records['TimeSec'], dtype=np.float64)
+        for name in names:
+            if name in records.dtype.names:
+                columns[name] = np.array(records[name], dtype=np.float64)
+        return columns
+    with open(path) as fh:
+        header = fh.readline().rstrip('\n').split(', ')
+        indices = [(name, header.index(name)) for name in names if name in header]
+        counts = []
+        times = []
+        values = [[] for name, index in indices]
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.split(',')
+            counts.append(int(fields[0]))
+            times.append(float(fields[1]))
+            for n in range(len(indices)):
+                try:
+                    values[n].append(float(fields[indices[n][1]]))
+                except ValueError:
+                    values[n].append(float('nan'))
+    if len(counts) < 2:
+        raise ValueError(path + " has no rows to replay")
+    counts = np.array(counts, dtype=np.float64)
+    period = (times[-1] - times[0]) / (counts[-1] - counts[0])
+    if period <= 0:
+        period = 1.0
+    columns['TimeSec'] = (counts - counts[0]) * period
+    for n in range(len(indices)):
+        columns[indices[n][0]] = np.array(values[n])
+    return columns
+
+
+# valueToVoltage of a single value as a plain function, for the simulated device (called for every reading).
+def voltageFunction(metric, ruleSet=None):
+    if not ruleSet:
+        ruleSet = ConversionRules
+    rule = ruleSet[conversionRuleName(metric, ruleSet)]
+    if rule.get('threshold') is not None:
+        high = rule['threshold'] + 0.5
+        return lambda value: high if value >= 0.5 else 0.0
+    if rule.get('piecewise'):
+        return lambda value: float(valueToVoltage([value], metric, ruleSet)[0])
+    v0, v1 = valueToVoltage([0.0, 1.0], metric, ruleSet)
+    gain, offset = float(v1 - v0), float(v0)
+    return lambda value: value * gain + offset
+
+
+# Voltages that convert to the values (array) of a metric, the inverse of its conversion rule (ChannelConversionTable).
+# Clamping and rounding are not undone; a digital line is 0 V or above its threshold.
+def valueToVoltage(values, metric, ruleSet=None):
+    if not ruleSet:
+        ruleSet = ConversionRules
+    rule = dict(ConversionRuleDefaults)
+    rule.update(ruleSet[conversionRuleName(metric, ruleSet)])
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    if rule['threshold'] is not None:
+        return np.where(values >= 0.5, rule['threshold'] + 0.5, 0.0)
+    if rule['piecewise']:
+        points = sorted(rule['piecewise'], key=lambda point: point[1])
+        return np.interp(values, [point[1] for point in points], [point[0] for point in points])
+    return ((values * rule['div'] + rule['bias']) / rule['scale']) * rule['prediv'] + rule['offset']
+
+
+# Hardware timed acquisition using the stream mode of the U3.
+# The device clocks the scans of all selected channels at StreamScanFrequency, so the timing does not depend on
+# time.sleep() in this process. The blocks returned by streamData() are averaged down to one row per SamplePeriod.
+# Yields (times, voltages, edges) for the complete rows of each block: the time in seconds since the stream started of
+# the first scan in each row (derived from the scan count, i.e. the device clock), and a rows x channels array of
+# calibrated voltages. Scans missed by the device are counted in stats['MissedScans'] if a stats dict is given;
+# the partial row before a gap is dropped.
+# edgeLines is a list of (name, channel index, threshold) of the lines whose edges are timed at the full scan rate,
+# before the averaging: the analog channel (index into currentChannelPositiveList) above/below the threshold voltage,
+# or with index -1 the TriggerChannel bit of the digital state (stream channel 193, scanned with the analog inputs).
+# The edges are yielded with the rows as a list of (time, name, new state), in the time order.
+def StreamAcquisitionBlocks(param, stats=None, edgeLines=()):
+    device = param.deviceU3
+    nChannels = len(param.currentChannelPositiveList)
+    channelKeys = ['AIN%d' % ch for ch in param.currentChannelPositiveList]
+    scanFrequency = float(param.StreamScanFrequency)
+    scansPerRow = max(1, int(round(param.SamplePeriod * scanFrequency)))
+
+    streamChannels = list(param.currentChannelPositiveList)
+    if len([line for line in edgeLines if line[1] < 0]) > 0:
+        streamChannels.append(193) #FIO/EIO digital state
+        triggerBit = triggerChannelNumber(param)
+    nStreamChannels = len(streamChannels)
+    device.streamConfig(NumChannels=nStreamChannels, PChannels=streamChannels, NChannels=[31] * nStreamChannels,
+                        Resolution=param.StreamResolution, ScanFrequency=scanFrequency)
+    # state of each line at the end of the last block, a trigger pulse at the start counts as an edge
+    edgeStates = [0 if line[1] < 0 else None for line in edgeLines]
+    edges = []
+
+    carry = np.zeros((0, nChannels)) #scans of the row that is not complete yet
+    rowStartIndex = 0 #device clock, in scans since the stream started, of the first scan in carry
+    device.streamStart()
+    if stats is not None:
+        stats['StreamStartTime'] = monotonicTime() #for the scan alignment, the stream clock starts about now
+    try:
+        for block in device.streamData():
+            if block is None:
+                continue #timeout without data, keep waiting
+            if block['errors'] != 0 or block['missed'] != 0:
+                # missed samples were still clocked by the device, so advance the scan count over them.
+                print("Stream errors: " + str(block['errors']) + " missed samples: " + str(block['missed']))
+                missedScans = block['missed'] // nStreamChannels
+                if stats is not None:
+                    stats['MissedScans'] = stats['MissedScans'] + missedScans
+                rowStartIndex = rowStartIndex + len(carry) + missedScans
+                carry = np.zeros((0, nChannels))
+
+            # edges at the scan rate, the scan index of the first scan of the block is after the carry
+            blockStartIndex = rowStartIndex + len(carry)
+            for n in range(len(edgeLines)):
+                name, column, threshold = edgeLines[n]
+                if column < 0:
+                    states = (np.array([state[0] for state in block['AIN193']], dtype=int) >> triggerBit) & 1
+                else:
+                    states = (np.asarray(block[channelKeys[column]]) > threshold).astype(int)
+                if len(states) == 0:
+                    continue
+                if edgeStates[n] is None:
+                    edgeStates[n] = states[0]
+                changes = np.nonzero(np.diff(np.concatenate([[edgeStates[n]], states])))[0]
+                for i in changes:
+                    edges.append(((blockStartIndex + i) / scanFrequency, name, int(states[i])))
+                edgeStates[n] = states[-1]
+
+            data = np.column_stack([block[key] for key in channelKeys])
+            if len(carry) > 0:
+                data = np.vstack([carry, data])
+            nRows = len(data) // scansPerRow
+            carry = data[nRows * scansPerRow:]
+            if nRows > 0:
+                voltages = data[:nRows * scansPerRow].reshape(nRows, scansPerRow, nChannels).mean(axis=1)
+                times = (rowStartIndex + np.arange(nRows) * scansPerRow) / scanFrequency
+                rowStartIndex = rowStartIndex + nRows * scansPerRow
+                edges.sort()
+                yield times, voltages, edges
+                edges = []
+    finally:
+        device.streamStop()
+
+
+# Collects the log rows in memory and writes them to the (unbuffered) file handle in one write when
+# flushBytes are buffered or the oldest row is flushInterval seconds old, instead of one write per row.
+# The age is checked on every write, so rows reach the file within flushInterval plus one sample period.
+# fsyncPolicy: 'None' leaves it to the OS, 'Flush' calls fsync after every write to the file, 'Close' only on close.
+# close() always writes what is left, CaptureAndWriteLog calls it when the recording is stopped.
+class BatchedLogWriter:
+    def __init__(self, fh, flushInterval, flushBytes, fsyncPolicy):
+        self.fh = fh
+        self.name = fh.name
+        self.flushInterval = flushInterval
+        self.flushBytes = flushBytes
+        self.fsyncPolicy = fsyncPolicy
+        self.buffer = []
+        self.bufferBytes = 0
+        self.firstBufferedTime = 0.0
+        self.writeCount = 0 #number of writes to the file, for comparison with the number of rows
+
+    def write(self, data):
+        if len(self.buffer) == 0:
+            self.firstBufferedTime = monotonicTime()
+        self.buffer.append(data)
+        self.bufferBytes = self.bufferBytes + len(data)
+        if self.bufferBytes >= self.flushBytes or (monotonicTime() - self.firstBufferedTime) >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        data = self.buffer[0][0:0].join(self.buffer) #works for both text and binary rows
+        self.buffer = []
+        self.bufferBytes = 0
+        self.fh.write(data)
+        self.writeCount = self.writeCount + 1
+        if self.fsyncPolicy == 'Flush':
+            os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.flush()
+        if self.fsyncPolicy in ('Flush', 'Close'):
+            os.fsync(self.fh.fileno())
+        self.fh.close()
+
+
+# Set by the SIGTERM handler in the capture process; the loop then stops after the current row and flushes the logs.
+CaptureStopRequested = False
+
+def captureTerminateHandler(signum, frame):
+    global CaptureStopRequested
+    CaptureStopRequested = True
+
+
+# True if the parent asked the capture process to stop: ('stop',) on the queue, or terminate().
+def captureStopPending(p2cQ):
+    stopRequested = CaptureStopRequested
+    while True:
+        try:
+            message = p2cQ.get(block=False)
+        except queue.Empty:
+            break
+        if message[0] == 'stop':
+            stopRequested = True
+    return stopRequested
+
+
+# Opens the U3 again after a device error in the capture process (USB error, the device was reset or unplugged).
+# The attempts are ReconnectBackoff seconds apart at first, doubling up to 1 s, for at most ReconnectTimeout seconds.
+# The configuration is restored by openU3Device (from the cache when it is valid).
+# Returns 'ok' when the device is back, 'stop' if a stop was requested meanwhile, or 'timeout'.
+def reconnectU3(param, p2cQ, heartbeat=None):
+    deadline = monotonicTime() + param.ReconnectTimeout
+    delay = param.ReconnectBackoff
+    while True:
+        if heartbeat is not None:
+            heartbeat.setState('Reconnecting')
+        try:
+            param.deviceU3.close()
+        except:
+            pass
+        try:
+            openU3Device(param)
+            return 'ok'
+        except:
+            print("LabJack U3 reconnect failed: " + str(sys.exc_info()[1]))
+        if captureStopPending(p2cQ):
+            return 'stop'
+        if monotonicTime() + delay > deadline:
+            return 'timeout'
+        time.sleep(delay)
+        delay = min(2.0 * delay, 1.0)
+
+
+# Counts of timing measurements (in seconds) in millisecond bins, for the jitter/latency of the sampling.
+# The last bin holds everything above the last edge.
+TimingHistogramEdges = [0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0] #ms
+
+class TimingHistogram:
+    def __init__(self, edges=TimingHistogramEdges):
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000.0
+        self.counts[bisect.bisect_left(self.edges, ms)] += 1
+        self.count = self.count + 1
+        self.total = self.total + ms
+        if ms > self.maximum:
+            self.maximum = ms
+
+    # upper edge (ms) of the bin that holds the p percentile, the maximum for the last bin
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        limit = self.count * p / 100.0
+        cumulative = 0
+        for i in range(len(self.edges)):
+            cumulative = cumulative + self.counts[i]
+            if cumulative >= limit:
+                return self.edges[i]
+        return self.maximum
+
+    # for the trailer of the logs (json in the binary log)
+    def summary(self):
+        return {'EdgesMs': self.edges, 'Counts': self.counts, 'Count': self.count,
+                'MeanMs': round(self.total / max(1, self.count), 4), 'MaxMs': round(self.maximum, 4)}
+
+
+# Text of a histogram summary: percentiles and the maximum, or the counts of all bins with allBins.
+def timingSummaryString(summary, allBins=False):
+    if allBins:
+        labels = ["<" + str(edge) for edge in summary['EdgesMs']] + [">" + str(summary['EdgesMs'][-1])]
+        return ", ".join([labels[i] + ": " + str(summary['Counts'][i]) for i in range(len(labels)) if summary['Counts'][i] > 0])
+    histogram = TimingHistogram(summary['EdgesMs'])
+    histogram.counts = summary['Counts']
+    histogram.count = summary['Count']
+    histogram.maximum = summary['MaxMs']
+    return "p50 <" + str(histogram.percentile(50)) + " p99 <" + str(histogram.percentile(99)) + " max " + \
+           str(round(summary['MaxMs'], 2)) + " ms"
+
+
+# Sampling on absolute deadlines of a monotonic clock: sample n is due at start + n * period, so the timing
+# errors do not add up from sample to sample and changes of the wall clock (ntp) have no effect.
+# When the loop falls behind (the deadline passed before wait() was called) the policy decides:
+#     Burst   the missed samples are taken right away, one after the other, until the loop has caught up
+#     Skip    the missed deadlines are dropped, the next sample is taken now and counted as the next row
+#     Mark    as Skip, but the row count advances over the missed deadlines (Count stays on the sample grid)
+#             and the gap is noted in the log
+# wait() sleeps until the next deadline and returns (sample index, number of deadlines dropped), the sample
+# index is the deadline number (start + index * period). The wake up error is added to the jitter histogram.
+class SampleScheduler:
+    def __init__(self, period, policy='Burst'):
+        self.period = float(period)
+        self.policy = policy
+        self.start = monotonicTime()
+        self.index = 0
+        self.late = 0 #samples that were due before wait() was called
+        self.skipped = 0 #deadlines dropped by the Skip/Mark policies
+        self.jitter = TimingHistogram()
+
+    def deadline(self):
+        return self.start + self.index * self.period
+
+    def wait(self):
+        deadline = self.deadline()
+        now = monotonicTime()
+        dropped = 0
+        if now >= deadline:
+            if self.index > 0:
+                self.late = self.late + 1
+            if self.policy in ('Skip', 'Mark') and now - deadline >= self.period:
+                dropped = int((now - deadline) // self.period)
+                self.index = self.index + dropped
+                self.skipped = self.skipped + dropped
+                deadline = self.deadline()
+        else:
+            # time.sleep() can return early, sleep again until the deadline
+            while now < deadline:
+                time.sleep(deadline - now)
+                now = monotonicTime()
+        self.jitter.add(now - deadline)
+        index = self.index
+        self.index = self.index + 1
+        return index, dropped
+
+    # After an interruption (reconnecting the device) the deadlines that have passed are dropped with any policy.
+    # Returns the number of deadlines dropped.
+    def resync(self):
+        dropped = max(0, int((monotonicTime() - self.deadline()) // self.period))
+        self.index = self.index + dropped
+        return dropped
+
+
+# The edges of the trigger line and of the digital lines (channels with a threshold rule, e.g. the GRASS ControlLine
+# and PumpStat) are written as their own event stream next to the log, PhysioRecordingLog*_events.txt:
+#     TimeSec, Count, Event, Value
+# TimeSec is on the time base of the log rows (TimeMS column), Count the row the event belongs to, Event the name
+# of the line and Value its new state (1/0), or for the trigger counted by the U3 counter the counter value.
+# Only the lines in the recording and the trigger are included.
+# The changes of the scan status and of the custom values are in the same stream, from the first row they apply to,
+# with the names in StatusEventNames and 'Custom.<label>'; the value is the rest of the line and can contain commas.
+# The first row has all of them.
+def edgeEventLines(param, conversion):
+    lines = []
+    if triggerChannelNumber(param) is not None:
+        lines.append(('Trigger', -1, None))
+    for i in range(conversion.nChannels):
+        if conversion.thresholdMask[i]:
+            lines.append((param.currentChannelMetricList[i], i, float(conversion.threshold[i])))
+    return lines
+
+
+StatusEventNames = ['Status', 'ExpStatus', 'Exp']
+
+
+class CaptureEventLog:
+    def __init__(self, path, param):
+        self.path = path
+        self.fh = BatchedLogWriter(open(path, "w", 0), param.FlushInterval, param.FlushBytes, param.FsyncPolicy)
+        self.fh.write("TimeSec, Count, Event, Value\n")
+        self.count = 0
+
+    def write(self, timeSec, rowCount, name, value):
+        self.fh.write("{:.6f}, {}, {}, {}\n".format(timeSec, rowCount, name, value))
+        self.count = self.count + 1
+
+    def close(self):
+        self.fh.close()
+
+
+# FIO number of the scanner trigger input, or None if not used.
+def triggerChannelNumber(param):
+    try:
+        return int(param.TriggerChannel)
+    except ValueError:
+        return None
+
+
+# Scan time and repetition (volume) index of each sample, computed as the samples are taken.
+# The scan start (monotonicTime()) and repetition time come from the parent (PV status, see MonitorPVstatus),
+# the start is only known to within the PV poll period. With a trigger input the rising edges are the
+# repetitions: the first edge is the start of the scan and the repetition index is the number of edges since.
+# The first edges can come before the PV poll has seen the scan, so the edges of the last lookback seconds
+# before the estimated start are kept.
+class ScanAlignment:
+    def __init__(self, lookback=1.0):
+        self.lookback = lookback
+        self.scanStart = 0.0
+        self.repetitionTime = 0.0
+        self.edgeTimes = [] #edges before the scan was seen
+        self.firstEdge = None
+        self.edgeCount = 0
+        self.triggerState = 0
+
+    def setScan(self, scanStart, repetitionTime):
+        if scanStart != self.scanStart:
+            self.scanStart = scanStart
+            self.firstEdge = None
+            self.edgeCount = 0
+            if scanStart > 0.0:
+                for t in self.edgeTimes:
+                    if t >= scanStart - self.lookback:
+                        self.addEdge(t)
+            self.edgeTimes = []
+        self.repetitionTime = repetitionTime
+
+    def addEdge(self, t):
+        if self.firstEdge is None:
+            self.firstEdge = t
+        self.edgeCount = self.edgeCount + 1
+
+    # trigger edge at time t
+    def edge(self, t):
+        if self.scanStart > 0.0:
+            self.addEdge(t)
+        else:
+            self.edgeTimes = [e for e in self.edgeTimes if e >= t - self.lookback] + [t]
+
+    # state of the trigger line at time t, rising edges are counted
+    def trigger(self, state, t):
+        if state and not self.triggerState:
+            self.edge(t)
+        self.triggerState = state
+
+    # (seconds since the scan start, repetition index) at time t, (nan, -1) if not scanning
+    def sample(self, t):
+        if self.scanStart <= 0.0:
+            return float('nan'), -1
+        if self.firstEdge is not None:
+            return t - self.firstEdge, self.edgeCount - 1
+        if self.repetitionTime > 0.0:
+            return t - self.scanStart, int((t - self.scanStart) // self.repetitionTime)
+        return t - self.scanStart, -1
+
+
+"""
+Additional LabJack devices
+"""
+# The parameters of an additional device (an entry of param.ExtraDevices) for openU3Device, with its own cache file.
+def extraDeviceParam(param, device):
+    deviceParam = copy.copy(param)
+    deviceParam.deviceU3 = None
+    deviceParam.DeviceSerial = device['SerialNumber']
+    deviceParam.ChannelConfig = list(device['Positive'])
+    deviceParam.ChannelPositive = list(device['Positive'])
+    deviceParam.currentChannelPositiveList = list(device['Positive'])
+    deviceParam.currentChannelMetricList = list(device['Metrics'])
+    deviceParam.currentChannelSettlingList = ['Long'] * len(device['Positive'])
+    deviceParam.TriggerChannel = 'None'
+    deviceParam.u3cachefile = os.path.splitext(param.u3cachefile)[0] + '_' + device['Name'] + '.json'
+    deviceParam.ExtraDevices = []
+    return deviceParam
+
+
+# Acquisition process of an additional device, started by the capture process. It opens the device itself, samples
+# its channels every SamplePeriod with getFeedback and sends (monotonicTime(), converted values) to outQ.
+# The deadlines are half a period before those of the main device (start is the start of the main scheduler), so
+# each sample has arrived when the row it belongs to is written. A device error closes the device, it is opened
+# again (reconnectU3) until ('stop',) arrives on stopQ.
+def CaptureExtraDevice(deviceParam, outQ, stopQ, start):
+    outQ.cancel_join_thread() #do not wait at the exit for samples nobody reads anymore
+    nChannels = len(deviceParam.currentChannelMetricList)
+    conversion = ChannelConversionTable(deviceParam.currentChannelMetricList, deviceParam.CalibrationRules)
+    ainCommand = [settlingAIN(channel, settling)
+                  for channel, settling in zip(deviceParam.currentChannelPositiveList, deviceParam.currentChannelSettlingList)]
+    voltages = [0.0] * nChannels
+    scheduler = SampleScheduler(deviceParam.SamplePeriod, 'Skip')
+    scheduler.start = start - 0.5 * deviceParam.SamplePeriod
+    connected = False
+    while not captureStopPending(stopQ):
+        if not connected:
+            reconnect = reconnectU3(deviceParam, stopQ)
+            if reconnect == 'stop':
+                break
+            connected = (reconnect == 'ok')
+            continue
+        scheduler.wait()
+        t = monotonicTime()
+        try:
+            results = deviceParam.deviceU3.getFeedback(ainCommand)
+        except:
+            print("LabJack U3 " + deviceParam.DeviceSerial + " error: " + str(sys.exc_info()[1]))
+            connected = False
+            continue
+        for i in range(nChannels):
+            voltages[i] = deviceParam.deviceU3.binaryToCalibratedAnalogVoltage(results[i], isLowVoltage=True,
+                                                                                 channelNumber=deviceParam.currentChannelPositiveList[i])
+        values, warnings = conversion.convertRow(voltages)
+        outQ.put((t, list(values)))
+    try:
+        deviceParam.deviceU3.close()
+    except:
+        pass
+
+
+# Merge stage of the capture process: the samples of the additional devices arrive in time order on their queues,
+# each row of the main device gets, per device, the newest sample taken at or before the row time (all processes
+# use the same monotonic clock). Samples older than staleAfter seconds are not used, the values are nan then
+# (a device that is reconnecting or has stopped).
+class DeviceMerge:
+    def __init__(self, queues, widths, staleAfter):
+        self.queues = queues
+        self.staleAfter = staleAfter
+        self.pending = [collections.deque() for q in queues] #samples received, not used yet
+        self.current = [None] * len(queues) #(time, values) of the sample used for the last row
+        self.missing = [[float('nan')] * width for width in widths]
+
+    def values(self, t):
+        merged = []
+        for n in range(len(self.queues)):
+            pending = self.pending[n]
+            while True:
+                try:
+                    pending.append(self.queues[n].get(block=False))
+                except queue.Empty:
+                    break
+            while len(pending) > 0 and pending[0][0] <= t:
+                self.current[n] = pending.popleft()
+            current = self.current[n]
+            if current is None or t - current[0] > self.staleAfter:
+                merged.extend(self.missing[n])
+            else:
+                merged.extend(current[1])
+        return merged
+
+
+"""
+AIN settling
+"""
+# Conversion modes of the U3 analog inputs, fastest first: (QuickSample, LongSettling) of u3.AIN.
+# Long is the slowest and settles high impedance sources; the low impedance PC-SAM DAC outputs usually do not need it.
+# ChannelSettling in SARecorder.ini selects the profile of each channel, --calibratesettling measures them.
+SettlingProfiles = collections.OrderedDict([('Quick', (True, False)), ('Normal', (False, False)), ('Long', (False, True))])
+
+
+def settlingAIN(positiveChannel, profile='Long'):
+    quickSample, longSettling = SettlingProfiles.get(profile, SettlingProfiles['Long'])
+    return u3.AIN(PositiveChannel=positiveChannel, NegativeChannel=31, QuickSample=quickSample, LongSettling=longSettling)
+
+
+"""
+Per channel sample rates
+"""
+# Channels with a decimation N > 1 (currentChannelDecimateList) are read every Nth sample in feedback mode, the other
+# samples log the last value read (held). Fewer AIN reads per sample make the getFeedback round trip shorter, so
+# the fast channels can be sampled faster. The first sample reads all channels, after that the reads of a channel
+# are at sample index i*N + offset with the offset spread over the channels, so the slow reads do not all fall on the
+# same sample. The commands of each combination of channels are built once.
+class ChannelReadPlan:
+    def __init__(self, decimate, ainCommands, extraCommands):
+        self.decimate = list(decimate)
+        self.ainCommands = ainCommands
+        self.extraCommands = extraCommands #read with every sample, after the channels (trigger)
+        self.offsets = [i % n for i, n in enumerate(self.decimate)]
+        self.allChannels = tuple(range(len(self.decimate)))
+        self.decimated = len([n for n in self.decimate if n > 1]) > 0
+        self.commands = {}
+
+    # (channel indices, getFeedback command list) of the sample with this scheduler index
+    def plan(self, sampleIndex):
+        if not self.decimated or sampleIndex == 0:
+            channels = self.allChannels
+        else:
+            channels = tuple([i for i in self.allChannels if sampleIndex % self.decimate[i] == self.offsets[i]])
+        if channels not in self.commands:
+            self.commands[channels] = [self.ainCommands[i] for i in channels] + self.extraCommands
+        return channels, self.commands[channels]
+
+
+# In stream mode all channels are scanned anyway, so a channel with decimation N is averaged over N rows instead
+# (a boxcar of N sample periods, which also lowers the noise of the slow signals). The average is updated every N rows
+# and held in between; until the first N rows are complete it is the average of the rows so far.
+class StreamRowDecimator:
+    def __init__(self, decimate):
+        self.channels = [(i, n) for i, n in enumerate(decimate) if n > 1]
+        self.sums = dict([(i, 0.0) for i, n in self.channels])
+        self.counts = dict([(i, 0) for i, n in self.channels])
+        self.held = dict([(i, None) for i, n in self.channels])
+
+    def apply(self, voltages):
+        for i, n in self.channels:
+            column = voltages[:, i]
+            for r in range(len(column)):
+                self.sums[i] = self.sums[i] + column[r]
+                self.counts[i] = self.counts[i] + 1
+                if self.counts[i] == n:
+                    self.held[i] = self.sums[i] / n
+                    self.sums[i] = 0.0
+                    self.counts[i] = 0
+                column[r] = self.held[i] if self.held[i] is not None else self.sums[i] / self.counts[i]
+        return voltages
+
+
 # this is the function called as a new thread with  multiprocessing.
 #fd is the log file file handle.
 #param is the static parameters.
-#p2cQ is the paraent->capture messaging queue; custom values get read from here (just a preformatted string)
+#p2cQ is the paraent->capture messaging queue; ('stop',) ends the recording.
 #c2pQ is the capture->parent messaging queue; strings sent to the parent for display in the gui, in addition to  recording to file.
+#   The data rows are sent as ('row', text) at most every param.DisplayPeriod seconds (the newest row), the file gets every row,
+#   with the values for the plots as ('plot', monotonic time, values).
 #c2pHeadQ is the capture->parent messaging queue; strings sent to the parent for display in the gui as a header line.
-def CaptureAndWriteLog(fd, param, p2cQ, c2pQ):
+#statusSlot is the SharedStatusSlot with the scan status and custom values (none if not given).
+#heartbeat is the CaptureHeartbeat updated with every sample (none if not given).
+#segmentNote is written as a comment line after the header when the recording continues in a new segment.
+def CaptureAndWriteLog(fd, param, p2cQ, c2pQ, statusSlot=None, heartbeat=None, segmentNote=None):
     #get recording configuration and setup output lists
 
     nChannels = len(param.currentChannelMetricList)
-    results = [0] * nChannels
-    resultsCalibratedInteger = [0.0] * nChannels
+    resultsZero = [0.0] * nChannels
     resultsCalibratedVoltage = [0.0] * nChannels
-    warningstr = [' ']*nChannels #used for warnings of values outside of plausible ranges
-
-    #Setup the loop and timing values
-    ptime=time.time()
-    starttime=ptime
 
     # Write the header, this is simply csv formatted
     headerString = "Count, TimeMS, "
-    headerString = headerString + ", ".join(param.currentChannelMetricList)
+    headerString = headerString + ", ".join(logChannelMetrics(param))
     
-    if param.AddExpAndStatus == True:
-        headerString = headerString + ", Status, ExpStatus, Exp"
-
-    if param.CustomEnabledFlag == True:
-        headerString = headerString + ", " + param.CustomLabel1.replace(" ", "")
-        if param.CustomEnabled2 == True:
-            headerString = headerString + ", " + param.CustomLabel2.replace(" ", "")
-            if param.CustomEnabled3 == True:
-                headerString = headerString + ", " + param.CustomLabel3.replace(" ", "")
-
-    fd.write(headerString+'\n')
+    if param.AddExpAndStatus == True and param.CompactLog == True:
+        headerString = headerString + ", ScanTime, Rep"
+    elif param.AddExpAndStatus == True:
+        headerString = headerString + ", Status, ExpStatus, Exp, ScanTime, Rep"
+
+    if not param.CompactLog == True:
+        for label in customLabelList(param):
+            headerString = headerString + ", " + label
+
+    # terminate() from the parent only sets a flag, so the rows still in memory are written before exiting
+    signal.signal(signal.SIGTERM, captureTerminateHandler)
+
+    logWriter = BatchedLogWriter(fd, param.FlushInterval, param.FlushBytes, param.FsyncPolicy)
+    logWriter.write(headerString+'\n')
+    if param.CompactLog == True and (param.AddExpAndStatus == True or len(customLabelList(param)) > 0):
+        logWriter.write("# compact log: the status and custom values are in " + os.path.basename(os.path.splitext(fd.name)[0]) + "_events.txt\n")
+    if segmentNote is not None:
+        logWriter.write("# " + segmentNote + "\n")
+    logWriter.flush()
     #print(headerString)
 
+    # Optional binary copy of the log with the same rows, see BinaryLogWriter
+    binaryLog = None
+    if param.BinaryLog == True:
+        try:
+            binaryLog = BinaryLogWriter(os.path.splitext(fd.name)[0] + ".bin", param)
+        except:
+            print("Could not open binary logging file")
+
     # Write the header, this is formatted for easier gui readability
     headerList = ["Count", "TimeMS"]
     if (param.AddExpAndStatus == True):
-        headerList.extend(['ScanStat','ExpStat','Exp'])
-    if param.CustomEnabledFlag == True:
-        headerList.append(param.CustomLabel1.replace(" ", ""))
-        if param.CustomEnabled2 == True:
-            headerList.append(param.CustomLabel2.replace(" ", ""))
-            if param.CustomEnabled3 == True:
-                headerList.append(param.CustomLabel3.replace(" ", "")) 
-    headerList.extend(param.currentChannelMetricList)
+        headerList.extend(['ScanStat','ExpStat','Exp','ScanTime','Rep'])
+    headerList.extend(customLabelList(param))
+    headerList.extend(logChannelMetrics(param))
     headerList.append("Warnings")
     headerOut = FormattedLine(headerList, headerList)
 
@@ -1040,106 +3035,420 @@ def CaptureAndWriteLog(fd, param, p2cQ, c2pQ):
     #param.LogWindow.update(headerString + '\n', append=True)
     #time.sleep(param.SamplePeriod) # do a delay here so the first measurement is at 1 sample period
 
-    # here, the sampling rate is also adjusted to account for delays in processing by estimating the expected and actual delays
-    sleepDelayAdjusted = param.SamplePeriod
-    elapsedTimePredicted = 0
     currIter = 0
-    seperator = ', '
-    currcustomstr = ''
-    while 1:
-
-        # Get the current time
-        ntime=time.time()
-        nowtime=(ntime - starttime)
-        elapsedms=str("%.01f" % nowtime )
-
-        # Setup data to monitor
-        dataList=[str(currIter), elapsedms]
-
-        if param.isU3 == True:
-            #Sample all channels simultaneously in a single command
-            ainCommand = [None] * nChannels
-            for i in range(nChannels):
-                ainCommand[i] = u3.AIN(PositiveChannel=param.currentChannelPositiveList[i] , NegativeChannel=31 , QuickSample=False, LongSettling=True)
-            results =  param.deviceU3.getFeedback(ainCommand)
-            #print(results)
-
-            #print("debug:")
-            for i in range(nChannels):
-                #if (param.isHV) and (param.currentChannelPositiveList[i] < 4):
-                    #localisLowVoltage = True #channels 0-3 are the high voltage channels.
-                #else:
-                    #localisLowVoltage = True #all others are low 0-2.4 V
-                    
-                #print(results[i])
-                resultsCalibratedVoltage[i] = param.deviceU3.binaryToCalibratedAnalogVoltage(results[i], isLowVoltage=True, channelNumber=param.currentChannelPositiveList[i])
-                
-                resultsCalibratedInteger[i], warningstr[i] = convertCalibratedVoltagetoValue(resultsCalibratedVoltage[i], param.currentChannelMetricList[i], param.currentChannelPositiveList[i])
-                #print("")
-                
-                
-            #print(param.currentChannelPositiveList)
-            #print(resultsCalibratedVoltage)
-            #Convert values to appropriate readings for each channel
-            #for i in range(nChannels):
-            #    resultsCalibratedInteger[i], warningstr[i] = convertInttoValue(results[i], param.currentChannelMetricList[i], param.currentChannelPositiveList[i])
-        else:
-            # this is redundant, but do it for clarity
-            resultsCalibratedInteger = [0.0] * nChannels
+    customSequence = -1
+    nCustom = len(customLabelList(param))
+    statusfields = ['', '', '']
+    customfields = [''] * nCustom
+
+    # Seconds since the scan start and repetition index of each sample (with the PV status columns only)
+    alignment = ScanAlignment(param.PVPollPeriod + 0.5)
+    useAlignment = (param.AddExpAndStatus == True)
+    scanTime = float('nan')
+    repetition = -1
+
+    # Counts for the trailer of the log: rows written, rows sampled late (behind the sample period),
+    # scans missed by the device in stream mode, and how the recording ended.
+    # Without the stream, also the samples dropped by the catch-up policy and the jitter (wake up after the deadline)
+    # and latency (deadline to the row written) histograms.
+    # Device errors that were recovered by reconnecting, and the time without samples.
+    captureStats = {'Samples': 0, 'LateSamples': 0, 'MissedScans': 0, 'StopReason': 'stop', 'Reconnects': 0, 'GapSeconds': 0.0}
+
+    # conversion rules of the channels, resolved once for the recording
+    conversion = ChannelConversionTable(param.currentChannelMetricList, param.CalibrationRules)
+
+    # In stream mode the device clock paces the loop and provides the timestamps.
+    # Each block of rows from the device is converted at once, then written row by row.
+    useStream = (param.isU3 == True) and (param.AcquisitionMode == 'Stream')
+
+    # Edges of the trigger and the digital lines, and the status and custom value changes, written to the
+    # event stream (see CaptureEventLog)
+    edgeLines = []
+    eventLog = None
+    if param.isU3 == True:
+        edgeLines = edgeEventLines(param, conversion)
+    statusEvents = []
+    if param.AddExpAndStatus == True:
+        statusEvents = list(StatusEventNames)
+    statusEvents = statusEvents + ['Custom.' + label for label in customLabelList(param)]
+    if len(edgeLines) > 0 or len(statusEvents) > 0:
+        try:
+            eventLog = CaptureEventLog(os.path.splitext(fd.name)[0] + "_events.txt", param)
+        except:
+            print("Could not open the event log")
+            edgeLines = []
+            statusEvents = []
+    # in the compact log the status and custom values are only in the event log (see expandCompactLog)
+    compactLog = (param.CompactLog == True) and len(statusEvents) > 0 and eventLog is not None
+    eventValues = [None] * len(statusEvents) #values last written to the event log
+
+    if useStream:
+        streamBlocks = StreamAcquisitionBlocks(param, captureStats, edgeLines)
+        streamDecimator = StreamRowDecimator(param.currentChannelDecimateList or [1] * nChannels)
+        blockTimes = []
+        blockRow = 0
+        blockEdges = []
+        blockEdge = 0
+        # after a reconnect the stream starts again, the row times continue from the first stream start
+        streamStart = None
+        streamTimeOffset = 0.0
+        deviceGap = None #(error, time of the first missing row) until the stream has started again
+
+    # Everything that does not change from sample to sample is built once here (or when the custom values
+    # are updated), so the loop itself only does the I/O and the arithmetic.
+    if param.isU3 == True and not useStream:
+        #Sample all channels due for this sample in a single command (see ChannelReadPlan)
+        settlingList = param.currentChannelSettlingList or ['Long'] * nChannels
+        ainCommand = [settlingAIN(param.currentChannelPositiveList[i], settlingList[i]) for i in range(nChannels)]
+        extraCommand = []
+        getFeedback = param.deviceU3.getFeedback
+        binaryToCalibratedAnalogVoltage = param.deviceU3.binaryToCalibratedAnalogVoltage
+        positiveList = param.currentChannelPositiveList
+        # the scanner trigger counter (or line) is read in the same command, after the analog inputs
+        useTrigger = triggerChannelNumber(param) is not None
+        if useTrigger:
+            if param.TriggerCounter == True:
+                extraCommand.append(u3.Counter0(Reset=False))
+            else:
+                extraCommand.append(u3.BitStateRead(triggerChannelNumber(param)))
+        triggerCount = None
+        readPlan = ChannelReadPlan(param.currentChannelDecimateList or [1] * nChannels, ainCommand, extraCommand)
+        # the digital lines (threshold rules) change state with the converted values
+        digitalLines = [line for line in edgeLines if line[1] >= 0]
+        digitalStates = [None] * len(digitalLines)
+    noWarnings = [' '] * nChannels
+
+    # Column widths of the display come from the header.
+    # The row templates are filled with (count, time, channel values..., warnings, scan time, repetition),
+    # the channel values of the additional devices follow those of the main device.
+    nColumns = len(logChannelMetrics(param))
+    widths = [len(str(item)) for item in headerList]
+    nStatusColumns = 5 if param.AddExpAndStatus == True else 0
+    displayHead = "{0:<" + str(widths[0]) + "} | {1:<" + str(widths[1]) + ".1f}"
+    displayValues = "".join([" | {" + str(i + 2) + ":<" + str(widths[2 + nStatusColumns + nCustom + i]) + ".1f}" for i in range(nColumns)])
+    displayWarnings = " | {" + str(nColumns + 2) + ":<" + str(widths[-1]) + "}"
+    fileHead = "{0}, {1:.1f}, " + ", ".join(["{" + str(i + 2) + ":.3f}" for i in range(nColumns)])
+    if param.AddExpAndStatus == True:
+        displayScan = " | {" + str(nColumns + 3) + ":<" + str(widths[5]) + ".2f} | {" + str(nColumns + 4) + ":<" + str(widths[6]) + "}"
+        fileScan = ",{" + str(nColumns + 3) + ":.3f},{" + str(nColumns + 4) + "}"
+    useCustom = (param.CustomEnabledFlag == True) or (param.AddExpAndStatus == True)
+    customUpdated = True
+    statusEventPending = False
+
+    # The gui only needs the newest values, so a row is sent for display at most every DisplayPeriod.
+    # displayRow holds the last row written that has not been displayed yet, sent when the recording stops.
+    nextDisplayTime = monotonicTime()
+    displayRow = None
+    nextTimingTime = nextDisplayTime + 1.0 #the timing statistics are sent every second
+
+    # Without the stream the samples are timed by the scheduler, the timestamps are from the same monotonic clock.
+    if not useStream:
+        scheduler = SampleScheduler(param.SamplePeriod, param.CatchUpPolicy)
+        latency = TimingHistogram()
+        starttime = scheduler.start
+    else:
+        starttime = monotonicTime()
+        captureStats['StreamStartTime'] = starttime #updated when the stream has started
+
+    # One acquisition process per additional device, merged into the rows by time (see DeviceMerge)
+    extraWorkers = []
+    merge = None
+    if len(param.ExtraDevices) > 0:
+        extraQueues = []
+        for device in param.ExtraDevices:
+            outQ = Queue()
+            stopQ = Queue()
+            worker = Process(target=CaptureExtraDevice, args=(extraDeviceParam(param, device), outQ, stopQ, starttime))
+            worker.start()
+            extraWorkers.append((worker, stopQ))
+            extraQueues.append(outQ)
+        merge = DeviceMerge(extraQueues, [len(device['Metrics']) for device in param.ExtraDevices], 3.0 * param.SamplePeriod + 0.05)
+
+    try:
+        while not CaptureStopRequested:
+
+            # Messages from the parent: ('stop',) to end the recording.
+            if captureStopPending(p2cQ):
+                break
+
+            # New scan status or custom values from the parent
+            if statusSlot is not None and statusSlot.sequenceNumber() != customSequence:
+                customSequence, slotValues, slotNumbers = statusSlot.read()
+                statusfields = slotValues[0:3]
+                customfields = slotValues[3:3 + nCustom]
+                alignment.setScan(slotNumbers[0], slotNumbers[1])
+                customUpdated = True
+
+            # Templates of the file and display rows with the current custom values filled in
+            if customUpdated:
+                customUpdated = False
+                customstr = "".join(["," + value for value in customfields]).replace("{", "{{").replace("}", "}}")
+                customDisplay = "".join([" | " + customfields[i].ljust(widths[2 + nStatusColumns + i]) for i in range(nCustom)])
+                customDisplay = customDisplay.replace("{", "{{").replace("}", "}}")
+                #Include experiment number and scan status (and the scan timing) if continuous logging
+                if compactLog:
+                    fileTemplate = fileHead + (fileScan if param.AddExpAndStatus == True else "") + "\n"
+                    if param.AddExpAndStatus == True:
+                        statusDisplay = "".join([" | " + statusfields[i].ljust(widths[2 + i]) for i in range(3)]).replace("{", "{{").replace("}", "}}")
+                        displayTemplate = displayHead + statusDisplay + displayScan + customDisplay + displayValues + displayWarnings + "\n"
+                    else:
+                        displayTemplate = displayHead + customDisplay + displayValues + displayWarnings + "\n"
+                elif param.AddExpAndStatus == True:
+                    statusstr = ",".join(statusfields).replace("{", "{{").replace("}", "}}")
+                    statusDisplay = "".join([" | " + statusfields[i].ljust(widths[2 + i]) for i in range(3)])
+                    statusDisplay = statusDisplay.replace("{", "{{").replace("}", "}}")
+                    fileTemplate = fileHead + ", " + statusstr + fileScan + customstr + "\n"
+                    displayTemplate = displayHead + statusDisplay + displayScan + customDisplay + displayValues + displayWarnings + "\n"
+                elif useCustom:
+                    fileTemplate = fileHead + ", " + customstr + "\n" #the custom values start with a comma without the status
+                    displayTemplate = displayHead + customDisplay + displayValues + displayWarnings + "\n"
+                else:
+                    fileTemplate = fileHead + "\n"
+                    displayTemplate = displayHead + displayValues + displayWarnings + "\n"
+                if binaryLog is not None:
+                    binaryLog.setCustom(statusfields, customfields)
+                statusEventPending = True
+
+            # Get the current time
+            if useStream:
+                if blockRow >= len(blockTimes):
+                    try:
+                        blockTimes, blockVoltages, blockEdges = next(streamBlocks)
+                    except:
+                        deviceError = str(sys.exc_info()[1])
+                        reconnect = reconnectU3(param, p2cQ, heartbeat)
+                        if reconnect == 'stop':
+                            break
+                        if reconnect != 'ok':
+                            raise IOError("LabJack U3 lost: " + deviceError)
+                        # the stream starts again, the gap is marked with the first rows of the new stream
+                        if deviceGap is None:
+                            deviceGap = (deviceError, nowtime + param.SamplePeriod if currIter > 0 else 0.0)
+                        streamBlocks = StreamAcquisitionBlocks(param, captureStats, edgeLines)
+                        blockTimes = []
+                        blockRow = 0
+                        continue
+                    if streamStart is None:
+                        streamStart = captureStats['StreamStartTime']
+                    streamTimeOffset = captureStats['StreamStartTime'] - streamStart
+                    blockTimes = blockTimes + streamTimeOffset
+                    if deviceGap is not None:
+                        gap = blockTimes[0] - deviceGap[1]
+                        missed = int(round(gap / param.SamplePeriod))
+                        logWriter.write(deviceGapString(deviceGap[0], deviceGap[1], gap, missed))
+                        captureStats['Reconnects'] = captureStats['Reconnects'] + 1
+                        captureStats['GapSeconds'] = captureStats['GapSeconds'] + gap
+                        currIter = currIter + missed
+                        deviceGap = None
+                    blockValues, blockWarnings = conversion.convert(streamDecimator.apply(blockVoltages))
+                    blockRow = 0
+                    blockEdge = 0
+                nowtime = blockTimes[blockRow]
+                # the edges up to the end of this row, so the repetition index changes on the row of the edge
+                rowEnd = nowtime - streamTimeOffset + param.SamplePeriod
+                while blockEdge < len(blockEdges) and blockEdges[blockEdge][0] < rowEnd:
+                    edgeTime, edgeName, edgeState = blockEdges[blockEdge]
+                    eventLog.write(edgeTime + streamTimeOffset, currIter, edgeName, edgeState)
+                    if edgeName == 'Trigger' and edgeState == 1:
+                        alignment.edge(captureStats['StreamStartTime'] + edgeTime)
+                    blockEdge = blockEdge + 1
+                resultsCalibratedInteger = blockValues[blockRow]
+                warningstr = blockWarnings[blockRow]
+                blockRow = blockRow + 1
+            else:
+                sampleIndex, dropped = scheduler.wait()
+                nowtime = monotonicTime() - starttime
+                if dropped > 0 and param.CatchUpPolicy == 'Mark':
+                    # comment line, skipped by loadtxt/read_csv(comment='#')
+                    logWriter.write("# missed " + str(dropped) + " samples before " + str(currIter + dropped) + "\n")
+                    currIter = currIter + dropped
+
+            if useStream:
+                pass #converted with the block above
+            elif param.isU3 == True:
+                readChannels, readCommand = readPlan.plan(sampleIndex)
+                nRead = len(readChannels)
+                try:
+                    results =  getFeedback(readCommand)
+                except:
+                    deviceError = str(sys.exc_info()[1])
+                    reconnect = reconnectU3(param, p2cQ, heartbeat)
+                    if reconnect == 'stop':
+                        break
+                    if reconnect != 'ok':
+                        raise IOError("LabJack U3 lost: " + deviceError)
+                    getFeedback = param.deviceU3.getFeedback
+                    binaryToCalibratedAnalogVoltage = param.deviceU3.binaryToCalibratedAnalogVoltage
+                    triggerCount = None #the counter starts again from 0
+                    # the samples that were due while reconnecting are not taken
+                    missed = scheduler.resync()
+                    gap = monotonicTime() - starttime - nowtime
+                    logWriter.write(deviceGapString(deviceError, nowtime, gap, missed + 1))
+                    captureStats['Reconnects'] = captureStats['Reconnects'] + 1
+                    captureStats['GapSeconds'] = captureStats['GapSeconds'] + gap
+                    currIter = currIter + missed + 1
+                    continue
+                for n in range(nRead):
+                    i = readChannels[n] #the channels not read keep their last voltage
+                    #if (param.isHV) and (param.currentChannelPositiveList[i] < 4):
+                        #localisLowVoltage = True #channels 0-3 are the high voltage channels.
+                    #else:
+                        #localisLowVoltage = True #all others are low 0-2.4 V
+                    resultsCalibratedVoltage[i] = binaryToCalibratedAnalogVoltage(results[n], isLowVoltage=True, channelNumber=positiveList[i])
+
+                resultsCalibratedInteger, warningstr = conversion.convertRow(resultsCalibratedVoltage)
+                if useTrigger:
+                    # the trigger is still used for the scan alignment if the event log could not be opened
+                    if param.TriggerCounter == True:
+                        # every counted edge since the last sample, timed at this sample
+                        if triggerCount is not None:
+                            for n in range(results[nRead] - triggerCount):
+                                if eventLog is not None:
+                                    eventLog.write(nowtime, currIter, 'Trigger', triggerCount + n + 1)
+                                alignment.edge(starttime + nowtime)
+                        triggerCount = results[nRead]
+                    else:
+                        if results[nRead] != alignment.triggerState and eventLog is not None:
+                            eventLog.write(nowtime, currIter, 'Trigger', results[nRead])
+                        alignment.trigger(results[nRead], starttime + nowtime)
+                for n in range(len(digitalLines)):
+                    state = int(resultsCalibratedInteger[digitalLines[n][1]])
+                    if digitalStates[n] is not None and state != digitalStates[n]:
+                        eventLog.write(nowtime, currIter, digitalLines[n][0], state)
+                    digitalStates[n] = state
+            else:
+                # this is redundant, but do it for clarity
+                resultsCalibratedInteger = resultsZero
+                warningstr = noWarnings
+
+            if merge is not None:
+                resultsCalibratedInteger = list(resultsCalibratedInteger) + merge.values((streamStart if useStream else starttime) + nowtime)
+
+            if useAlignment:
+                if useStream:
+                    scanTime, repetition = alignment.sample(streamStart + nowtime)
+                else:
+                    scanTime, repetition = alignment.sample(starttime + nowtime)
+
+            # The status and custom values that changed, once at the first row with the new values
+            if statusEventPending:
+                statusEventPending = False
+                values = (statusfields if param.AddExpAndStatus == True else []) + customfields
+                for n in range(len(statusEvents)):
+                    if values[n] != eventValues[n]:
+                        eventLog.write(nowtime, currIter, statusEvents[n], values[n])
+                        eventValues[n] = values[n]
+
+            # Write out all data to the file
+            logWriter.write(fileTemplate.format(currIter, nowtime, *(list(resultsCalibratedInteger) + ['', scanTime, repetition]))) #print to file with newline
+            captureStats['Samples'] = captureStats['Samples'] + 1
 
-        # Write out all data to the file 
-        datastring = ['0']  * nChannels
-        for n in range(len(resultsCalibratedInteger)):
-            datastring[n] = '{:.3f}'.format(resultsCalibratedInteger[n])
+            if binaryLog is not None:
+                binaryLog.writeRow(currIter, nowtime, resultsCalibratedInteger, scanTime, repetition)
 
-        
-        rowstring=str(currIter) + ", " + elapsedms + ", " + seperator.join(datastring)
+            if heartbeat is not None:
+                heartbeat.sample(captureStats['Samples'], monotonicTime())
 
-        if (param.CustomEnabledFlag == True) or (param.AddExpAndStatus == True):
+            if not useStream:
+                latency.add(monotonicTime() - scheduler.start - sampleIndex * scheduler.period)
+
+            # Data to monitor
+            #warnings are displayed in the dynamic output, but not saved to the file.
+            displayRow = (displayTemplate, currIter, nowtime, resultsCalibratedInteger, warningstr, scanTime, repetition)
+            if monotonicTime() >= nextDisplayTime:
+                c2pQ.put(('row', displayTemplate.format(currIter, nowtime, *(list(resultsCalibratedInteger) + [' '.join(warningstr), scanTime, repetition]))))
+                c2pQ.put(('plot', (streamStart if useStream else starttime) + nowtime, [float(v) for v in resultsCalibratedInteger]))
+                displayRow = None
+                nextDisplayTime = monotonicTime() + param.DisplayPeriod
+                if nextDisplayTime >= nextTimingTime:
+                    nextTimingTime = nextDisplayTime + 1.0
+                    c2pQ.put(('timing', captureTimingString(captureStats, scheduler if not useStream else None, latency if not useStream else None)))
+
+            #update the number of iterations
+            currIter = currIter + 1
+    except:
+        captureStats['StopReason'] = 'error: ' + str(sys.exc_info()[1])
+        raise
+    finally:
+        if useStream:
+            streamBlocks.close() #stops the U3 stream
+        if eventLog is not None:
+            captureStats['Events'] = eventLog.count
+            eventLog.close()
+        for worker, stopQ in extraWorkers:
+            stopQ.put(('stop',))
+        for worker, stopQ in extraWorkers:
+            worker.join(captureStopTimeout(param))
+            if worker.is_alive():
+                worker.terminate()
+        if CaptureStopRequested:
+            captureStats['StopReason'] = 'terminate'
+        if heartbeat is not None:
+            heartbeat.setState('Error' if captureStats['StopReason'].startswith('error') else 'Stopped')
+        captureStats['Duration'] = round(monotonicTime() - starttime, 3)
+        captureStats['EndTime'] = datetime.datetime.now().isoformat()
+        if not useStream:
+            captureStats['LateSamples'] = scheduler.late
+            captureStats['SkippedSamples'] = scheduler.skipped
+            captureStats['CatchUpPolicy'] = scheduler.policy
+            captureStats['Jitter'] = scheduler.jitter.summary()
+            captureStats['Latency'] = latency.summary()
+        trailer = captureTrailerString(captureStats)
+        if displayRow is not None:
+            template, count, rowtime, rowvalues, rowwarnings, rowscantime, rowrepetition = displayRow
             try:
-                currcustomstr = p2cQ.get(block=False)
-                # print(currcustomstr)
+                c2pQ.put(('row', template.format(count, rowtime, *(list(rowvalues) + [' '.join(rowwarnings), rowscantime, rowrepetition]))))
             except:
                 pass
+        # the trailer is a comment line in the text log, so it is skipped by loadtxt/read_csv(comment='#')
+        logWriter.write("# " + trailer + '\n')
+        for line in captureHistogramLines(captureStats):
+            logWriter.write("# " + line + '\n')
+        logWriter.close()
+        if binaryLog is not None:
+            binaryLog.close(captureStats)
+        try:
+            if 'Jitter' in captureStats:
+                c2pQ.put(('timing', captureTimingString(captureStats, scheduler, latency)))
+            c2pQ.put(trailer + '\n')
+        except:
+            pass
 
-            if (param.AddExpAndStatus == True):
-                expstatlist = currcustomstr.split(",")[0:3]
-                customlist = currcustomstr.split(",")[3:]
-                dataList.extend(expstatlist)
-                dataList.extend(customlist)
-            else:
-                customlist = currcustomstr.split(",")
-                dataList.extend(customlist)
-
-            rowstring = rowstring + ", " + currcustomstr
-        fd.write(rowstring+'\n') #print to file with newline
 
+def captureTrailerString(captureStats):
+    trailer = "Stopped (" + captureStats['StopReason'] + "): " + str(captureStats['Samples']) + " samples in " + str(captureStats['Duration']) + \
+              " s, late samples " + str(captureStats['LateSamples']) + ", missed scans " + str(captureStats['MissedScans'])
+    if 'SkippedSamples' in captureStats:
+        trailer = trailer + ", skipped samples " + str(captureStats['SkippedSamples']) + " (" + captureStats['CatchUpPolicy'] + ")"
+    if captureStats.get('Reconnects', 0) > 0:
+        trailer = trailer + ", reconnects " + str(captureStats['Reconnects']) + " (" + str(round(captureStats['GapSeconds'], 3)) + " s without samples)"
+    if 'Jitter' in captureStats:
+        trailer = trailer + ", jitter " + timingSummaryString(captureStats['Jitter']) + \
+                  ", latency " + timingSummaryString(captureStats['Latency'])
+    return trailer
 
-        # print(dataList)
-        # Data to monitor
-        for n in range(len(resultsCalibratedInteger)):
-            dataList.append('{:.1f}'.format(resultsCalibratedInteger[n]))
 
-        dataList.append(' '.join(warningstr))
-        try:
-            dataOut = FormattedLine(headerList, dataList)
+# Comment line in the log where the samples stop for a device error, from the time (seconds, as the TimeMS column)
+# the device was lost for gap seconds, with the number of sample counts left out.
+def deviceGapString(error, gapStart, gap, missed):
+    return "# device error at {:.3f} s ({}), reconnected after {:.3f} s, missed {} samples\n".format(gapStart, error, gap, missed)
 
-            #warnings are displayed in the dynamic output, but not saved to the file.
-            c2pQ.put(dataOut + '\n')
-        except:
-            print('Formatting Error. Skipping')
 
-        # Adjust the sleep time to account for processing delays to try and maintain the sample period accuracy
-        # basically, adjust the delay based on the expected and actual time of the last recording.
-        elapsedTimePredicted = param.SamplePeriod * currIter
-        sleepDelayAdjusted = param.SamplePeriod - (nowtime - elapsedTimePredicted)
-        if sleepDelayAdjusted < 0:
-            sleepDelayAdjusted = 0
+# The jitter and latency histograms of the trailer, one line each.
+def captureHistogramLines(captureStats):
+    lines = []
+    for name in ['Jitter', 'Latency']:
+        if name in captureStats:
+            lines.append(name + " histogram (ms): " + timingSummaryString(captureStats[name], allBins=True))
+    return lines
 
-        time.sleep(sleepDelayAdjusted)
 
-        #update the number of iterations
-        currIter = currIter + 1
+# Sample Timing line of the gui while recording.
+def captureTimingString(captureStats, scheduler, latency):
+    if scheduler is None:
+        return "Stream (device clock), missed scans " + str(captureStats['MissedScans'])
+    return "Jitter " + timingSummaryString(scheduler.jitter.summary()) + ", latency " + timingSummaryString(latency.summary()) + \
+           ", late " + str(scheduler.late) + ", skipped " + str(scheduler.skipped)
 
 
 #def convertInttoValue(value,metric,channel):
@@ -1221,6 +3530,8 @@ def CaptureAndWriteLog(fd, param, p2cQ, c2pQ):
 
 
 
+# Reference conversion of a single value. The recording uses the same rules compiled into a
+# ChannelConversionTable (see ConversionRules below), which must give identical results to this function.
 def convertCalibratedVoltagetoValue(value,metric,channel):
     #will need to test and build these out for more options.
 
@@ -1264,7 +3575,6 @@ def convertCalibratedVoltagetoValue(value,metric,channel):
         result = value * (4096/5.0/4.0)
         #not tested.
     elif ((metric == "BP2Mean") or (metric == "BP3Mean") or (metric == "BP1Mean") or ('Systol' in metric) or ('Diastol' in metric)):
-        print(value)
 	VOffset = 0.006
         result = (((value-VOffset) * (1024/5.0)) - 90 ) / 3.0
 	#10-bit; 90 counts = 0 mmHg; 3 mmHg/count 
@@ -1313,10 +3623,919 @@ def convertCalibratedVoltagetoValue(value,metric,channel):
 
 
 
+"""
+Conversion rules used during recording.
+Each metric is converted as
+    result = (((voltage - offset) / prediv) * scale - bias) / div
+in the same order of operations as convertCalibratedVoltagetoValue so the results are identical,
+or by linear interpolation of the piecewise (voltage, value) breakpoints if given,
+then, in this order:
+    warnBelow/warnAbove     warning text if the result is below/above the level
+    plausibleMin/Max        'Out of range' warning outside of the plausible range (if no other warning)
+    clampMin                results below this are set to it
+    threshold               digital lines: 1 if the voltage is above the level, otherwise 0 (replaces the result)
+    round                   number of decimals (python round)
+"""
+ConversionRuleDefaults = {'offset': 0.0, 'prediv': 1.0, 'scale': 1.0, 'bias': 0.0, 'div': 1.0, 'piecewise': None,
+                          'warnBelow': None, 'warnAbove': None, 'warning': '', 'plausibleMin': None, 'plausibleMax': None,
+                          'clampMin': None, 'threshold': None, 'round': None}
+
+ConversionRules = {
+    ### SA Instruments Connections from Breakout Box ###
+    'T1Temp':      {'scale': 4096/5.0*4.0, 'div': 180.0, 'clampMin': 0.0, 'round': 1},
+    'PRespRate':   {'offset': 0.006, 'scale': 4096/5.0/4.0, 'clampMin': 0.0, 'round': 0},
+    'ECGRate':     {'offset': 0.006, 'scale': 4096/5.0/4.0, 'warnBelow': 0.0, 'warning': 'Neg ECG Rate'},
+    'PRespPeriod': {'offset': 0.006, 'scale': 4096/5.0*4.0},
+    'BPRate':      {'scale': 4096/5.0/4.0}, #14-bit; 1 BPM/count
+    'BPMean':      {'offset': 0.006, 'scale': 1024/5.0, 'bias': 90.0, 'div': 3.0}, #10-bit; 90 counts = 0 mmHg; 3 mmHg/count
+    ### POET Gas analyzer conditions ###
+    'Iso':         {'prediv': 2.4, 'scale': 8.0, 'warnAbove': 5.0, 'warning': 'High Iso', 'round': 2},
+    'O2':          {'prediv': 1000.0, 'warnBelow': 17.0, 'warning': 'Low O2'},
+    'CO2':         {'prediv': 1000.0, 'warnAbove': 10.0, 'warning': 'High CO2'},
+    ### GRASS stimulator and Harvard Apparatus Syringe Injection Pump, digital lines ###
+    'ControlLine': {'threshold': 0.8},
+    'PumpStat':    {'threshold': 0.8},
+    ### anything else ###
+    'Default':     {'offset': 32768.0},
+}
+
+
+# Reads [Calibration.<Metric>] sections from SARecorder.ini and then from the optional sidecar file
+# SARecorderCalibration.ini (later files override earlier ones) on top of the built-in ConversionRules.
+# This allows recalibrating a metric or adding a new one without changing the sampling code, e.g.
+#     [Calibration.BP4Mean]
+#     rule = BPMean           ; start from an existing rule (optional)
+#     offset = 0.004
+#     plausibleMin = 10       ; 'Out of range' warning outside of these
+#     plausibleMax = 250
+#     list = Rate             ; add the metric to the Rate (PC-SAM), Poet, GRASS or HAPump channel options
+# The keys are the ConversionRules fields, plus
+#     piecewise = 0:0, 1.2:4, 2.4:8     ; voltage:value breakpoints, linear in between (replaces the linear formula)
+# 'None' disables a field of the base rule. The rules are compiled into a ChannelConversionTable when recording starts.
+# An invalid or unknown key is reported (configWarning) and the value of the base rule is kept for it.
+def loadCalibrationRegistry(param):
+    rules = {}
+    for name in ConversionRules:
+        rules[name] = dict(ConversionRules[name])
+
+    optionLists = {'Rate': param.RateOptionsList, 'Poet': param.PoetOptionsList,
+                   'GRASS': param.GRASSOptionsList, 'HAPump': param.HAPumpOptionsList}
+    floatKeys = ['offset', 'prediv', 'scale', 'bias', 'div', 'warnBelow', 'warnAbove', 'clampMin', 'threshold',
+                 'plausibleMin', 'plausibleMax']
+    for filename in [param.configfile, param.calibrationfile]:
+        config = ConfigParser(inline_comment_prefixes=ConfigCommentPrefixes)
+        try:
+            if not os.path.exists(filename):
+                continue
+            config.read(filename)
+        except:
+            configWarning(param, "Could not read calibration from " + filename + ": " + str(sys.exc_info()[1]))
+            continue
+        for section in config.sections():
+            if not section.startswith('Calibration.'):
+                continue
+            metric = section[len('Calibration.'):]
+            options = config[section]
+            where = " in [" + section + "] of " + filename
+            base = options.get('rule', metric)
+            if 'rule' in options and not base in rules:
+                configWarning(param, "Unknown rule " + base + where + ", starting from the rule of " + metric)
+            rule = dict(rules.get(base, rules.get(metric, {})))
+            # each key on its own, an invalid or unknown one is reported and the others are used
+            for key in options:
+                value = options[key].strip()
+                field = [k for k in floatKeys + ['round', 'warning', 'piecewise'] if k.lower() == key.lower()]
+                if len(field) == 0:
+                    if not key.lower() in ('rule', 'list'):
+                        configWarning(param, "Unknown key " + key + where + ", not used")
+                    continue
+                field = field[0]
+                try:
+                    if value == 'None':
+                        rule[field] = None
+                    elif field in floatKeys:
+                        rule[field] = float(value)
+                    elif field == 'round':
+                        rule[field] = int(value)
+                    elif field == 'piecewise':
+                        points = [pair.split(':') for pair in value.split(',')]
+                        rule[field] = [(float(v), float(x)) for v, x in points]
+                    else:
+                        rule[field] = value
+                except ValueError:
+                    configWarning(param, "Invalid " + key + " = " + value + where + " (" + str(sys.exc_info()[1]) + "), using " +
+                                  str(rule.get(field, ConversionRuleDefaults[field])))
+            rules[metric] = rule
+            listName = options.get('list', '')
+            if listName in optionLists and not (metric in optionLists[listName]):
+                optionLists[listName].insert(len(optionLists[listName]) - 1, metric) #before 'None'
+            elif listName != '' and not listName in optionLists:
+                configWarning(param, "Unknown list " + listName + where + ", " + metric + " is not added to the channel options")
+
+    param.CalibrationRules = rules
+    return param
+
+
+# Additional LabJack U3s are configured in SARecorder.ini, one section per device, e.g.
+#     [Device.Cardiac]
+#     SerialNumber = 320012345
+#     Channels = 0:ECGRate, 1:BP1Mean, 2:BP1Rate      ; FIO (or EIO 8-15) line:metric
+# The channels are recorded after the channels of the main device, with the same sample period (see
+# CaptureExtraDevice). Set SerialNumber in [Main] too, otherwise the main device is the first U3 found.
+# An invalid section is reported (configWarning), the device is then not recorded.
+def loadExtraDevices(param):
+    param.ExtraDevices = []
+    config = ConfigParser(inline_comment_prefixes=ConfigCommentPrefixes)
+    try:
+        if not os.path.exists(param.configfile):
+            return param
+        config.read(param.configfile)
+    except:
+        configWarning(param, "Could not read " + param.configfile + ": " + str(sys.exc_info()[1]) + ", no additional devices.")
+        return param
+    for section in config.sections():
+        if not section.startswith('Device.'):
+            continue
+        try:
+            channels = [pair.split(':') for pair in config[section]['Channels'].split(',')]
+            device = {'Name': section[len('Device.'):],
+                      'SerialNumber': config[section]['SerialNumber'].strip(),
+                      'Positive': [int(line) for line, metric in channels],
+                      'Metrics': [metric.strip() for line, metric in channels]}
+        except:
+            configWarning(param, "Invalid device section " + section + " (" + str(sys.exc_info()[1]) + "), not recorded.")
+            continue
+        param.ExtraDevices.append(device)
+    if len(param.ExtraDevices) > 0 and param.DeviceSerial == '':
+        configWarning(param, "Additional LabJack devices are configured without the SerialNumber of the main device.")
+    return param
+
+
+# Name of the conversion rule for a metric (several metrics share the BP rules).
+def conversionRuleName(metric, rules=ConversionRules):
+    if metric in rules:
+        return metric
+    if metric in ('BP1Rate', 'BP2Rate', 'BP3Rate'):
+        return 'BPRate'
+    if metric in ('BP1Mean', 'BP2Mean', 'BP3Mean') or ('Systol' in metric) or ('Diastol' in metric):
+        return 'BPMean'
+    return 'Default'
+
+
+# The conversion rules of the recorded channels, resolved once when the recording starts.
+# convert() converts a block of rows (rows x channels voltages) with numpy operations across all
+# channels and rows; convertRow() does the same for a single row with python floats, which is
+# faster than numpy for the few values of one row (feedback mode) and gives the same results.
+# ruleSet is the calibration registry (param.CalibrationRules), the built-in ConversionRules if not given.
+class ChannelConversionTable:
+    def __init__(self, metricList, ruleSet=None):
+        if not ruleSet:
+            ruleSet = ConversionRules
+        self.metricList = list(metricList)
+        rules = []
+        for metric in self.metricList:
+            rule = dict(ConversionRuleDefaults)
+            rule.update(ruleSet[conversionRuleName(metric, ruleSet)])
+            rules.append(rule)
+        self.nChannels = len(rules)
+        self.offset = np.array([r['offset'] for r in rules], dtype=np.float64)
+        self.prediv = np.array([r['prediv'] for r in rules], dtype=np.float64)
+        self.scale = np.array([r['scale'] for r in rules], dtype=np.float64)
+        self.bias = np.array([r['bias'] for r in rules], dtype=np.float64)
+        self.div = np.array([r['div'] for r in rules], dtype=np.float64)
+        # unused levels are +/-inf so the comparisons are always false
+        self.warnBelow = np.array([r['warnBelow'] if r['warnBelow'] is not None else -np.inf for r in rules])
+        self.warnAbove = np.array([r['warnAbove'] if r['warnAbove'] is not None else np.inf for r in rules])
+        self.warnings = [r['warning'] for r in rules]
+        self.plausibleMin = np.array([r['plausibleMin'] if r['plausibleMin'] is not None else -np.inf for r in rules])
+        self.plausibleMax = np.array([r['plausibleMax'] if r['plausibleMax'] is not None else np.inf for r in rules])
+        self.piecewiseChannels = [(i, np.array([p[0] for p in sorted(rules[i]['piecewise'])]), np.array([p[1] for p in sorted(rules[i]['piecewise'])]))
+                                  for i in range(self.nChannels) if rules[i]['piecewise']]
+        self.clampMin = np.array([r['clampMin'] if r['clampMin'] is not None else -np.inf for r in rules])
+        self.thresholdMask = np.array([r['threshold'] is not None for r in rules], dtype=bool)
+        self.threshold = np.array([r['threshold'] if r['threshold'] is not None else 0.0 for r in rules])
+        self.roundChannels = [(i, rules[i]['round']) for i in range(self.nChannels) if rules[i]['round'] is not None]
+        piecewise = dict([(i, (xs, ys)) for i, xs, ys in self.piecewiseChannels])
+        self.rowRules = [(float(self.offset[i]), float(self.prediv[i]), float(self.scale[i]), float(self.bias[i]), float(self.div[i]),
+                          piecewise.get(i), float(self.warnBelow[i]), float(self.warnAbove[i]), self.warnings[i],
+                          float(self.plausibleMin[i]), float(self.plausibleMax[i]), float(self.clampMin[i]),
+                          rules[i]['threshold'], rules[i]['round']) for i in range(self.nChannels)]
+
+    def convert(self, voltages):
+        voltages = np.asarray(voltages, dtype=np.float64).reshape(-1, self.nChannels)
+        values = (((voltages - self.offset) / self.prediv) * self.scale - self.bias) / self.div
+        for i, xs, ys in self.piecewiseChannels:
+            values[:, i] = np.interp(voltages[:, i], xs, ys)
+        warnRows = (values < self.warnBelow) | (values > self.warnAbove)
+        rangeRows = (values < self.plausibleMin) | (values > self.plausibleMax)
+        values = np.where(values < self.clampMin, self.clampMin, values)
+        values = np.where(self.thresholdMask, np.where(voltages > self.threshold, 1.0, 0.0), values)
+        # python round (not np.round, which rounds halves differently), only for the few rounded channels
+        for i, digits in self.roundChannels:
+            values[:, i] = [round(float(v), digits) for v in values[:, i]]
+        if warnRows.any() or rangeRows.any():
+            warnings = [[self.warnings[i] if warnRow[i] else ('Out of range' if rangeRow[i] else '') for i in range(self.nChannels)]
+                        for warnRow, rangeRow in zip(warnRows, rangeRows)]
+        else:
+            warnings = [[''] * self.nChannels] * len(values)
+        return values, warnings
+
+    def convertRow(self, voltages):
+        values = [0.0] * self.nChannels
+        warnings = [''] * self.nChannels
+        i = 0
+        for (offset, prediv, scale, bias, div, piecewise, warnBelow, warnAbove, warning,
+             plausibleMin, plausibleMax, clampMin, threshold, digits) in self.rowRules:
+            voltage = float(voltages[i])
+            if piecewise is None:
+                value = (((voltage - offset) / prediv) * scale - bias) / div
+            else:
+                value = float(np.interp(voltage, piecewise[0], piecewise[1]))
+            if value < warnBelow or value > warnAbove:
+                warnings[i] = warning
+            elif value < plausibleMin or value > plausibleMax:
+                warnings[i] = 'Out of range'
+            if value < clampMin:
+                value = clampMin
+            if threshold is not None:
+                value = 1.0 if voltage > threshold else 0.0
+            if digits is not None:
+                value = round(value, digits)
+            values[i] = value
+            i = i + 1
+        return values, warnings
+
+
+"""
+Binary log format
+The binary log (PhysioRecordingLog*.bin) holds the same rows as the text log as fixed width records:
+    8 bytes     magic 'PVPHYS01'
+    4 bytes     little endian uint32, length of the json header (padded so the records start on 8 bytes)
+    header      json with the columns (name, numpy dtype, label), channel metrics and positive channels of the
+                main device, the metrics of all logged channels (LogMetrics, with the extra devices), sample period, custom labels, acquisition mode and start time
+    records     packed little endian records, one per sample, until the end of the file
+Count, the scan status columns and Rep are int32, times (ScanTime is nan when not scanning) and channel values
+are float64 and the custom values are 16 byte strings. ScanStat/ExpStat are stored as the index into ScanStatusCodes/ExpStatusCodes in the header (-1 if unknown).
+    trailer     (when the recording was stopped) json with the sample count and dropped sample statistics,
+                then its length as uint32 and the magic 'PVTRAIL1'
+A partially written last record is ignored by the reader.
+"""
+BinaryLogMagic = b'PVPHYS01'
+BinaryLogTrailerMagic = b'PVTRAIL1'
+BinaryLogScanStatusCodes = ['Idle','SCANNING','RECO','ADJUST']
+BinaryLogExpStatusCodes = ['Idle','Scan','Setup']
+BinaryLogTextWidth = 16
+
+
+# Column names, numpy dtypes and labels of the binary records for the current configuration.
+def binaryLogColumns(param):
+    columns = [{'name': 'Count', 'dtype': '<i4', 'label': 'Count'},
+               {'name': 'TimeSec', 'dtype': '<f8', 'label': 'TimeMS'}]
+    if param.AddExpAndStatus == True:
+        columns.append({'name': 'ScanTime', 'dtype': '<f8', 'label': 'ScanTime'})
+        columns.append({'name': 'Rep', 'dtype': '<i4', 'label': 'Rep'})
+        columns.append({'name': 'ScanStat', 'dtype': '<i4', 'label': 'Status'})
+        columns.append({'name': 'ExpStat', 'dtype': '<i4', 'label': 'ExpStatus'})
+        columns.append({'name': 'Exp', 'dtype': '<i4', 'label': 'Exp'})
+    for i, label in enumerate(customLabelList(param)):
+        columns.append({'name': 'Custom' + str(i + 1), 'dtype': 'S' + str(BinaryLogTextWidth), 'label': label})
+    for metric in logChannelMetrics(param):
+        # the same metric can be selected on more than one channel, field names have to be unique
+        name = metric
+        n = 2
+        while name in [c['name'] for c in columns]:
+            name = metric + '_' + str(n)
+            n = n + 1
+        columns.append({'name': name, 'dtype': '<f8', 'label': metric})
+    return columns
+
+
+# Metrics of the channel columns of the log: the main device, then the additional devices.
+def logChannelMetrics(param):
+    metrics = list(param.currentChannelMetricList)
+    for device in param.ExtraDevices:
+        metrics.extend(device['Metrics'])
+    return metrics
+
+
+# Enabled custom labels, in order, without spaces.
+def customLabelList(param):
+    labels = []
+    if param.CustomEnabledFlag == True:
+        labels.append(param.CustomLabel1.replace(" ", ""))
+        if param.CustomEnabled2 == True:
+            labels.append(param.CustomLabel2.replace(" ", ""))
+            if param.CustomEnabled3 == True:
+                labels.append(param.CustomLabel3.replace(" ", ""))
+    return labels
+
+
+def binaryLogStructFormat(columns):
+    formats = {'<i4': 'i', '<f8': 'd'}
+    return '<' + ''.join([formats.get(c['dtype'], str(BinaryLogTextWidth) + 's') for c in columns])
+
+
+class BinaryLogWriter:
+    def __init__(self, path, param):
+        self.path = path
+        self.columns = binaryLogColumns(param)
+        # Count/TimeSec (and ScanTime/Rep), the status/custom columns (packed once per update in setCustom)
+        # and the channel values
+        nHead = 4 if param.AddExpAndStatus == True else 2
+        nStatus = 3 if param.AddExpAndStatus == True else 0
+        self.nCustom = len(customLabelList(param))
+        self.headStruct = struct.Struct(binaryLogStructFormat(self.columns[0:nHead]))
+        self.customStruct = struct.Struct(binaryLogStructFormat(self.columns[nHead:nHead + nStatus + self.nCustom]))
+        self.valueStruct = struct.Struct(binaryLogStructFormat(self.columns[nHead + nStatus + self.nCustom:]))
+        self.addExpAndStatus = param.AddExpAndStatus
+        self.setCustom([], [])
+        header = {'Version': 1,
+                  'Columns': self.columns,
+                  'ChannelMetrics': param.currentChannelMetricList,
+                  'ChannelPositive': param.currentChannelPositiveList,
+                  'LogMetrics': logChannelMetrics(param),
+                  'ExtraDevices': param.ExtraDevices,
+                  'SamplePeriod': param.SamplePeriod,
+                  'AcquisitionMode': param.AcquisitionMode,
+                  'AddExpAndStatus': param.AddExpAndStatus,
+                  'CustomEnabled': param.CustomEnabledFlag,
+                  'CustomLabels': customLabelList(param),
+                  'ScanStatusCodes': BinaryLogScanStatusCodes,
+                  'ExpStatusCodes': BinaryLogExpStatusCodes,
+                  'StartTime': datetime.datetime.now().isoformat()}
+        headerBytes = json.dumps(header).encode('utf-8')
+        pad = (-(len(BinaryLogMagic) + 4 + len(headerBytes))) % 8
+        headerBytes = headerBytes + b' ' * pad
+        self.fh = BatchedLogWriter(open(path, "wb", 0), param.FlushInterval, param.FlushBytes, param.FsyncPolicy)
+        self.fh.write(BinaryLogMagic + struct.pack('<I', len(headerBytes)) + headerBytes)
+        self.fh.flush()
+
+    # statusfields are the scan status, experiment status and experiment number, customfields the custom values.
+    def setCustom(self, statusfields, customfields):
+        fields = []
+        if self.addExpAndStatus == True:
+            statusfields = (list(statusfields) + ['', '', ''])[0:3]
+            fields.append(codeIndex(BinaryLogScanStatusCodes, statusfields[0]))
+            fields.append(codeIndex(BinaryLogExpStatusCodes, statusfields[1]))
+            try:
+                fields.append(int(statusfields[2]))
+            except ValueError:
+                fields.append(-1)
+        customfields = (list(customfields) + [''] * self.nCustom)[0:self.nCustom]
+        fields.extend([c.encode('utf-8')[0:BinaryLogTextWidth] for c in customfields])
+        self.customBytes = self.customStruct.pack(*fields)
+
+    def writeRow(self, count, timeSec, values, scanTime=float('nan'), repetition=-1):
+        if self.addExpAndStatus == True:
+            head = self.headStruct.pack(count, timeSec, scanTime, repetition)
+        else:
+            head = self.headStruct.pack(count, timeSec)
+        self.fh.write(head + self.customBytes + self.valueStruct.pack(*values))
+
+    # The trailer (json of the capture statistics) goes after the last record, followed by its length and BinaryLogTrailerMagic.
+    def close(self, trailer=None):
+        if trailer is not None:
+            trailerBytes = json.dumps(trailer).encode('utf-8')
+            self.fh.write(trailerBytes + struct.pack('<I', len(trailerBytes)) + BinaryLogTrailerMagic)
+        self.fh.close()
+
+
+def codeIndex(codes, value):
+    if value in codes:
+        return codes.index(value)
+    return -1
+
+
+# Memory maps a binary log. Returns the header (dict) and a numpy structured array with one record per
+# sample, e.g. records['T1Temp'] or records['TimeSec']. The records are read from the file on demand
+# (no copy); copy them (np.array(records)) if the file will be removed or overwritten.
+# The trailer, if the recording was stopped properly, is returned as header['Trailer'].
+def readBinaryLog(path):
+    filesize = os.path.getsize(path)
+    with open(path, "rb") as fh:
+        magic = fh.read(len(BinaryLogMagic))
+        if magic != BinaryLogMagic:
+            raise ValueError(path + " is not a physio binary log")
+        headerLength = struct.unpack('<I', fh.read(4))[0]
+        header = json.loads(fh.read(headerLength).decode('utf-8'))
+        offset = len(BinaryLogMagic) + 4 + headerLength
+        dataEnd = filesize
+        header['Trailer'] = None
+        if filesize - offset >= 4 + len(BinaryLogTrailerMagic):
+            fh.seek(filesize - 4 - len(BinaryLogTrailerMagic))
+            trailerLength = struct.unpack('<I', fh.read(4))[0]
+            if fh.read(len(BinaryLogTrailerMagic)) == BinaryLogTrailerMagic:
+                dataEnd = filesize - 4 - len(BinaryLogTrailerMagic) - trailerLength
+                fh.seek(dataEnd)
+                header['Trailer'] = json.loads(fh.read(trailerLength).decode('utf-8'))
+    dtype = np.dtype([(str(c['name']), str(c['dtype'])) for c in header['Columns']])
+    nRecords = (dataEnd - offset) // dtype.itemsize
+    if nRecords <= 0:
+        return header, np.zeros(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(nRecords,))
+    return header, records
+
+
+# Writes a binary log as the text log (PhysioRecordingLog*.txt) that CaptureAndWriteLog writes.
+def binaryLogToCSV(path, csvpath=None):
+    header, records = readBinaryLog(path)
+    if csvpath is None:
+        csvpath = os.path.splitext(path)[0] + ".txt"
+    columns = header['Columns']
+    channelNames = [str(c['name']) for c in columns if c['dtype'] == '<f8' and not c['name'] in ('TimeSec', 'ScanTime')]
+    customNames = [str(c['name']) for c in columns if c['name'].startswith('Custom')]
+
+    # logs written before LogMetrics was added have the metrics of all channels only as column labels
+    metrics = header.get('LogMetrics', [str(c['label']) for c in columns if str(c['name']) in channelNames])
+    if len(metrics) != len(channelNames):
+        raise ValueError(path + ": " + str(len(metrics)) + " channel metrics in the header for " + str(len(channelNames)) + " channel columns")
+    headerString = "Count, TimeMS, " + ", ".join(metrics)
+    if header['AddExpAndStatus'] == True:
+        headerString = headerString + ", Status, ExpStatus, Exp"
+        if 'ScanTime' in [c['name'] for c in columns]:
+            headerString = headerString + ", ScanTime, Rep"
+    for label in header['CustomLabels']:
+        headerString = headerString + ", " + label
+
+    with open(csvpath, "w") as fh:
+        fh.write(headerString + '\n')
+        for record in records:
+            rowstring = str(record['Count']) + ", " + str("%.01f" % record['TimeSec']) + ", " + ", ".join(['{:.3f}'.format(record[name]) for name in channelNames])
+            if header['AddExpAndStatus'] == True or header['CustomEnabled'] == True:
+                customstring = ""
+                if header['AddExpAndStatus'] == True:
+                    scanstat = header['ScanStatusCodes'][record['ScanStat']] if record['ScanStat'] >= 0 else ''
+                    expstat = header['ExpStatusCodes'][record['ExpStat']] if record['ExpStat'] >= 0 else ''
+                    customstring = scanstat + "," + expstat + "," + str(record['Exp'])
+                    if 'ScanTime' in record.dtype.names:
+                        customstring = customstring + ",{:.3f},{}".format(record['ScanTime'], record['Rep'])
+                for name in customNames:
+                    customstring = customstring + "," + record[name].decode('utf-8')
+                rowstring = rowstring + ", " + customstring
+            fh.write(rowstring + '\n')
+        if header['Trailer'] is not None:
+            fh.write("# " + captureTrailerString(header['Trailer']) + '\n')
+            for line in captureHistogramLines(header['Trailer']):
+                fh.write("# " + line + '\n')
+    return csvpath
+
+
+# Writes a compact text log (CompactLog) with the status and custom value columns filled in again from the event log
+# next to it, as the text log is without CompactLog. The comment lines are copied.
+# Started with: python PhysioRecording_v2.py --expand PhysioRecordingLog*.txt
+def expandCompactLog(path, outpath=None):
+    if outpath is None:
+        outpath = os.path.splitext(path)[0] + "_expanded.txt"
+    eventpath = os.path.splitext(path)[0] + "_events.txt"
+
+    # status/custom changes as (row count, column name, value), in the order they were written
+    names = []
+    changes = []
+    with open(eventpath) as fh:
+        fh.readline()
+        for line in fh:
+            fields = line.rstrip('\n').split(', ', 3)
+            if len(fields) < 4:
+                continue
+            name = fields[2]
+            if name in StatusEventNames or name.startswith('Custom.'):
+                if not name in names:
+                    names.append(name)
+                changes.append((int(fields[1]), name, fields[3]))
+    statusNames = [name for name in StatusEventNames if name in names]
+    customNames = [name for name in names if name.startswith('Custom.')]
+    current = dict([(name, '') for name in names])
+
+    with open(path) as fh, open(outpath, "w") as out:
+        header = fh.readline().rstrip('\n').split(', ')
+        nFixed = header.index('ScanTime') if 'ScanTime' in header else len(header)
+        headerString = ", ".join(header[0:nFixed] + statusNames + header[nFixed:] + [name[len('Custom.'):] for name in customNames])
+        out.write(headerString + '\n')
+        nextChange = 0
+        for line in fh:
+            if line.startswith('#'):
+                if not line.startswith('# compact log:'):
+                    out.write(line)
+                continue
+            fields = line.rstrip('\n').split(',')
+            count = int(fields[0])
+            while nextChange < len(changes) and changes[nextChange][0] <= count:
+                current[changes[nextChange][1]] = changes[nextChange][2]
+                nextChange = nextChange + 1
+            # same layout as the rows of CaptureAndWriteLog
+            rowstring = ",".join(fields[0:nFixed])
+            if len(statusNames) > 0 or len(customNames) > 0:
+                customstring = ",".join([current[name] for name in statusNames] + fields[nFixed:])
+                for name in customNames:
+                    customstring = customstring + "," + current[name]
+                rowstring = rowstring + ", " + customstring
+            out.write(rowstring + '\n')
+    return outpath
+
+
+"""
+Benchmark
+"""
+# CPU cost per sample of the capture loop (CaptureAndWriteLog with a SimulatedU3, feedback mode, status and
+# one custom value) at each sample rate. Started with: python PhysioRecording_v2.py --benchmark
+# simulation is the setting of the simulated device (the [Simulation] section with --benchmark), e.g. its latency.
+def benchmarkCaptureLoop(rates=(10, 100, 1000), duration=5.0, simulation=None):
+    import resource
+    import tempfile
+    print("Rate (Hz)   Samples   CPU/sample (us)   CPU load (%)")
+    for rate in rates:
+        param = ConfigParam()
+        param.isU3 = True
+        param.SamplePeriod = 1.0 / rate
+        param.SelectedChannelMetrics = ['T1Temp','PRespRate','ECGRate','BP1Mean','Iso','ControlLine','PumpStat']
+        param.currentChannelMetricList = list(param.SelectedChannelMetrics)
+        param.currentChannelPositiveList = list(param.ChannelPositive)
+        if simulation is not None:
+            param.Simulation = simulation
+        param.deviceU3 = openSimulatedU3(param)
+        param.AddExpAndStatus = True
+        param.CustomEnabledFlag = True
+        param.CustomEnabled1 = True
+        param.CustomLabel1 = 'Iso Set'
+        logfile = tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False)
+        p2cQ = Queue()
+        c2pQ = Queue()
+        statusSlot = SharedStatusSlot()
+        statusSlot.write(['SCANNING', 'Scan', '1', '2.0', '', ''], [monotonicTime(), 2.0])
+
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        p = Process(target=CaptureAndWriteLog, args=(logfile, param, p2cQ, c2pQ, statusSlot))
+        p.start()
+        stopTime = monotonicTime() + duration
+        while p.is_alive():
+            if monotonicTime() > stopTime:
+                p2cQ.put(('stop',))
+                stopTime = stopTime + 3600
+            try:
+                c2pQ.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        p.join()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        logfile.close()
+
+        with open(logfile.name) as fh:
+            samples = len([line for line in fh if line[0].isdigit()])
+        os.remove(logfile.name)
+        cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        print("%9d %9d %17.1f %14.1f" % (rate, samples, 1e6 * cpu / max(1, samples), 100.0 * cpu / duration))
+
+
+# Measures each SettlingProfiles profile on the recorded channels of the connected U3: the time of a getFeedback
+# with one AIN, and the noise of the readings (rms of the differences of successive readings / sqrt(2), which
+# ignores the slow changes of the signal itself). The fastest profile with a noise below param.SettlingNoiseLimit
+# is recommended for each channel; Long if none is. Returns the recommended ChannelSettling (all 7 channels, the
+# ones not recorded are unchanged). Started with: python PhysioRecording_v2.py --calibratesettling [--save]
+def calibrateChannelSettling(param, reads=200):
+    device = param.deviceU3
+    settling = list(param.ChannelSettling)
+    print("Channel      Metric        Profile   Time/read (us)   Noise (mV rms)")
+    for i in range(len(param.SelectedChannelMetrics)):
+        if param.SelectedChannelMetrics[i] == 'None':
+            continue
+        recommended = None
+        for profile in SettlingProfiles:
+            command = [settlingAIN(param.ChannelPositive[i], profile)]
+            device.getFeedback(command) #the first conversion after switching the channel is not used
+            voltages = np.zeros(reads)
+            start = monotonicTime()
+            for n in range(reads):
+                voltages[n] = device.binaryToCalibratedAnalogVoltage(device.getFeedback(command)[0], isLowVoltage=True,
+                                                                     channelNumber=param.ChannelPositive[i])
+            readTime = (monotonicTime() - start) / reads
+            noise = np.sqrt(np.mean(np.diff(voltages) ** 2) / 2.0)
+            print("%-12s %-13s %-9s %14.1f %16.3f" % (param.ChannelNameList[i], param.SelectedChannelMetrics[i], profile,
+                                                     1e6 * readTime, 1e3 * noise))
+            if recommended is None and noise < param.SettlingNoiseLimit:
+                recommended = profile
+        settling[i] = recommended or 'Long'
+        print("%-12s recommended: %s" % (param.ChannelNameList[i], settling[i]))
+    print("ChannelSettling = " + ",".join(settling))
+    return settling
+
+
+# Writes ChannelSettling into the Main section of SARecorder.ini, the rest of the file is kept.
+def saveChannelSettling(param):
+    parser = ConfigParser()
+    if os.path.exists(param.configfile):
+        parser.read(param.configfile)
+    if not parser.has_section('Main'):
+        parser['Main'] = {}
+    parser['Main']['ChannelSettling'] = ",".join(param.ChannelSettling)
+    with open(param.configfile, "w") as fp:
+        parser.write(fp)
+
+
+"""
+Self test
+"""
+# Checks of the recording code that run without the LabJack or Paravision. Each check raises an AssertionError
+# with what was wrong. Started with: python PhysioRecording_v2.py --selftest
+def selfTest():
+    for check in [selfTestConversion, selfTestCalibrationExample, selfTestSimulationExample, selfTestDeviceExample,
+                  selfTestReconnect, selfTestFakePV, selfTestEventLog]:
+        print(check.__name__)
+        check()
+    print("Self test passed")
+
+
+# ChannelConversionTable, row by row (feedback) and as a block (stream), gives the same values and warnings as
+# convertCalibratedVoltagetoValue for every metric of the channel options, over the input range and beyond it.
+def selfTestConversion(nVoltages=1000):
+    param = ConfigParam()
+    voltages = list(np.linspace(-0.5, 2.5, nVoltages)) + [0.0, 0.006, 0.8, 1.5, 2.4, 2.44]
+    for metric in param.RateOptionsList + param.PoetOptionsList + param.GRASSOptionsList + param.HAPumpOptionsList:
+        if metric == 'None':
+            continue
+        table = ChannelConversionTable([metric])
+        blockValues, blockWarnings = table.convert(np.array(voltages).reshape(-1, 1))
+        for n in range(len(voltages)):
+            expected = convertCalibratedVoltagetoValue(voltages[n], metric, 0)
+            values, warnings = table.convertRow([voltages[n]])
+            assert (values[0], warnings[0]) == expected, \
+                "%s at %r V: convertRow gives %r, expected %r" % (metric, voltages[n], (values[0], warnings[0]), expected)
+            assert (blockValues[n][0], blockWarnings[n][0]) == expected, \
+                "%s at %r V: convert gives %r, expected %r" % (metric, voltages[n], (blockValues[n][0], blockWarnings[n][0]), expected)
+
+
+# The [Calibration.<Metric>] example of loadCalibrationRegistry, as it is in the comment, adds the metric with its
+# rule to the Rate options; an invalid or unknown key is reported and the rest of its section is used.
+def selfTestCalibrationExample():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        param = ConfigParam()
+        param.configfile = os.path.join(directory, 'SARecorder.ini')
+        param.calibrationfile = os.path.join(directory, 'SARecorderCalibration.ini')
+        with open(param.configfile, "w") as fh:
+            fh.write("[Calibration.BP4Mean]\n"
+                     "rule = BPMean           ; start from an existing rule (optional)\n"
+                     "offset = 0.004\n"
+                     "plausibleMin = 10       ; 'Out of range' warning outside of these\n"
+                     "plausibleMax = 250\n"
+                     "list = Rate             ; add the metric to the Rate (PC-SAM), Poet, GRASS or HAPump channel options\n")
+        with open(param.calibrationfile, "w") as fh:
+            fh.write("[Calibration.Iso]\n"
+                     "piecewise = 0:0, 1.2:4, 2.4:8     ; voltage:value breakpoints, linear in between (replaces the linear formula)\n"
+                     "[Calibration.O2]\n"
+                     "scale = high\n"
+                     "ofset = 0.1\n"
+                     "warnBelow = 18\n")
+        param = loadCalibrationRegistry(param)
+        expected = dict(ConversionRules['BPMean'], offset=0.004, plausibleMin=10.0, plausibleMax=250.0)
+        assert param.CalibrationRules.get('BP4Mean') == expected, "BP4Mean rule %r" % param.CalibrationRules.get('BP4Mean')
+        assert param.RateOptionsList[-2:] == ['BP4Mean', 'None'], "Rate options %r" % param.RateOptionsList
+        assert param.CalibrationRules['Iso']['piecewise'] == [(0.0, 0.0), (1.2, 4.0), (2.4, 8.0)], "Iso rule %r" % param.CalibrationRules['Iso']
+        assert param.CalibrationRules['O2'] == dict(ConversionRules['O2'], warnBelow=18.0), "O2 rule %r" % param.CalibrationRules['O2']
+        assert len(param.ConfigWarnings) == 2 and 'scale = high' in param.ConfigWarnings[0] and 'ofset' in param.ConfigWarnings[1], \
+            "warnings %r" % param.ConfigWarnings
+    finally:
+        shutil.rmtree(directory)
+
+
+# The [Simulation] example of loadSimulationSettings, as it is in the comment, sets the simulated device; an invalid
+# setting is reported and only that setting keeps its default.
+def selfTestSimulationExample():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        param = ConfigParam()
+        param.configfile = os.path.join(directory, 'SARecorder.ini')
+        with open(param.configfile, "w") as fh:
+            fh.write("[Simulation]\n"
+                     "Latency = 0.0015               ; seconds per getFeedback call\n"
+                     "LatencyPerCommand = 0.0002     ; seconds more for each command in the call\n"
+                     "NoiseScale = 2.0               ; times the noise of each settling profile\n"
+                     "FaultPeriod = 20               ; fail every 20 s for FaultDuration seconds (0: never)\n"
+                     "FaultDuration = 0.5\n"
+                     "Waveform.Iso = steps, 30, 1.0, 3.0     ; waveform, arguments (see simulatedWaveformValue)\n")
+        settings = loadSimulationSettings(param).Simulation
+        result = [settings[key] for key in ['Latency', 'LatencyPerCommand', 'NoiseScale', 'FaultPeriod', 'FaultDuration']]
+        assert result == [0.0015, 0.0002, 2.0, 20.0, 0.5], "simulation settings %r" % result
+        assert settings['Waveforms']['Iso'] == ('steps', [30.0, 1.0, 3.0]), "Iso waveform %r" % (settings['Waveforms']['Iso'],)
+        assert len(param.ConfigWarnings) == 0, "warnings %r" % param.ConfigWarnings
+
+        with open(param.configfile, "w") as fh:
+            fh.write("[Simulation]\nLatency = fast\nNoiseScale = 3\nWaveform.O2 = square, 1\n")
+        settings = loadSimulationSettings(param).Simulation
+        assert settings['Latency'] == SimulationDefaults['Latency'] and settings['NoiseScale'] == 3.0, "simulation settings %r" % settings
+        assert settings['Waveforms']['O2'] == SimulationDefaults['Waveforms']['O2'], "O2 waveform %r" % (settings['Waveforms']['O2'],)
+        assert len(param.ConfigWarnings) == 2, "warnings %r" % param.ConfigWarnings
+    finally:
+        shutil.rmtree(directory)
+
+
+# The [Device.<name>] example of loadExtraDevices, as it is in the comment, adds the device; an invalid section is
+# reported.
+def selfTestDeviceExample():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        param = ConfigParam()
+        param.DeviceSerial = '320000001'
+        param.configfile = os.path.join(directory, 'SARecorder.ini')
+        with open(param.configfile, "w") as fh:
+            fh.write("[Device.Cardiac]\n"
+                     "SerialNumber = 320012345\n"
+                     "Channels = 0:ECGRate, 1:BP1Mean, 2:BP1Rate      ; FIO (or EIO 8-15) line:metric\n"
+                     "[Device.Pump]\n"
+                     "SerialNumber = 320012346\n"
+                     "Channels = 0-PumpStat\n")
+        param = loadExtraDevices(param)
+        expected = [{'Name': 'Cardiac', 'SerialNumber': '320012345', 'Positive': [0, 1, 2], 'Metrics': ['ECGRate', 'BP1Mean', 'BP1Rate']}]
+        assert param.ExtraDevices == expected, "devices %r" % param.ExtraDevices
+        assert len(param.ConfigWarnings) == 1 and 'Device.Pump' in param.ConfigWarnings[0], "warnings %r" % param.ConfigWarnings
+    finally:
+        shutil.rmtree(directory)
+
+
+# Records duration seconds with CaptureAndWriteLog from a simulated U3 (opened with the channels of param) in its own
+# process, as the gui does. statusChanges are (seconds, status slot values) written to the status slot on the way.
+# Returns the lines of the log and of the event log next to it (empty if there is none); the files are removed.
+def selfTestRecording(param, duration, statusChanges=()):
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        param.u3cachefile = os.path.join(directory, 'SARecorderU3.json')
+        param.DeviceBackend = 'Simulated'
+        param = openU3Device(param)
+        param.isU3 = True
+        logfile = open(os.path.join(directory, 'PhysioRecordingLog.txt'), "w")
+        p2cQ = Queue()
+        c2pQ = Queue()
+        statusSlot = SharedStatusSlot()
+        changes = list(statusChanges)
+        p = Process(target=CaptureAndWriteLog, args=(logfile, param, p2cQ, c2pQ, statusSlot))
+        p.start()
+        start = monotonicTime()
+        while p.is_alive():
+            elapsed = monotonicTime() - start
+            while len(changes) > 0 and changes[0][0] <= elapsed:
+                statusSlot.write(changes.pop(0)[1])
+            if elapsed > duration:
+                p2cQ.put(('stop',))
+                duration = duration + 3600
+            try:
+                c2pQ.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        p.join()
+        logfile.close()
+        with open(logfile.name) as fh:
+            lines = fh.read().splitlines()
+        events = []
+        if os.path.exists(os.path.join(directory, 'PhysioRecordingLog_events.txt')):
+            with open(os.path.join(directory, 'PhysioRecordingLog_events.txt')) as fh:
+                events = fh.read().splitlines()
+    finally:
+        shutil.rmtree(directory)
+    return lines, events
+
+
+# The capture process reconnects after device errors (the simulated U3 fails for FaultDuration seconds every
+# FaultPeriod seconds, as with --simulatefaults) in feedback and stream mode: each gap is a '# device error ...
+# missed N samples' line, the Count continues N samples on, and the trailer has the number of reconnects.
+def selfTestReconnect():
+    for mode in ['Feedback', 'Stream']:
+        param = ConfigParam()
+        param.AddExpAndStatus = False
+        param.AcquisitionMode = mode
+        param.StreamScanFrequency = 1000.0
+        param.SamplePeriod = 0.01
+        param.currentChannelMetricList = ['T1Temp', 'Iso']
+        param.currentChannelPositiveList = [0, 4]
+        param.Simulation = dict(SimulationDefaults)
+        param.Simulation['FaultPeriod'] = 1.5
+        param.Simulation['FaultDuration'] = 0.3
+        SimulatedU3.faultEpoch = time.time() #the first fault 1.2 s from now, the next at 2.7 s
+        lines, events = selfTestRecording(param, 3.6)
+        reconnects = 0
+        for i in range(1, len(lines) - 1):
+            if lines[i].startswith('# device error'):
+                missed = int(lines[i].split('missed ')[1].split()[0])
+                before = int(lines[i - 1].split(',')[0])
+                after = int(lines[i + 1].split(',')[0])
+                assert missed > 0 and after == before + missed + 1, \
+                    "%s: count %d, %r, then count %d" % (mode, before, lines[i], after)
+                reconnects = reconnects + 1
+        trailer = [line for line in lines if line.startswith('# Stopped')]
+        assert reconnects == 2, "%s: %d device error lines instead of 2" % (mode, reconnects)
+        assert len(trailer) == 1 and (", reconnects %d (" % reconnects) in trailer[0], "%s: trailer %r" % (mode, trailer)
+
+
+# FakePVcmd (--fakepv) through PVStatusService: the status at points of the default script (idle, the setup, the
+# same scan running and in reconstruction, idle, and the setup of the next cycle) with the script running speed times
+# faster than real time, and a script read by loadFakePVScript.
+def selfTestFakePV(speed=50.0):
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        studypath = os.path.join(directory, '20260101_Fake.1')
+        fake = FakePVcmd(studypath=studypath, speed=speed)
+        service = PVStatusService(fake)
+        # seconds into the script: scan status, experiment status, EXPNO
+        expected = [(5.0, 'Idle', 'Idle', '0'), (12.0, 'ADJUST', 'Setup', '2'), (20.0, 'SCANNING', 'Scan', '2'),
+                    (47.0, 'RECO', 'Scan', '2'), (55.0, 'Idle', 'Idle', '0'), (72.0, 'ADJUST', 'Setup', '7')]
+        for scriptTime, scanstatus, experimentstatus, expno in expected:
+            fake.startTime = time.time() - scriptTime / speed
+            status = service.poll(directory)
+            result = (status['scanstatus'], status['experimentstatus'], status['expno'])
+            assert result == (scanstatus, experimentstatus, expno), \
+                "%.0f s into the script: %r, expected %r" % (scriptTime, result, (scanstatus, experimentstatus, expno))
+            if expno != '0':
+                assert status['datapath'] == studypath, "%.0f s into the script: datapath %r" % (scriptTime, status['datapath'])
+                assert abs(status['reptime'] - 2.0 / speed) < 1e-9, "repetition time %r at speed %r" % (status['reptime'], speed)
+
+        scriptfile = os.path.join(directory, 'script.txt')
+        with open(scriptfile, "w") as fh:
+            fh.write("# seconds, scan type, scan status\n1, None, Idle\n\n2.5, Scan_Experiment, SCANNING\n")
+        script = loadFakePVScript(scriptfile)
+        assert script == [(1.0, None, 'Idle'), (2.5, 'Scan_Experiment', 'SCANNING')], "script %r" % script
+    finally:
+        shutil.rmtree(directory)
+
+
+# The event log of a feedback recording with the trigger counter (a simulated trigger pulse every 0.3 s), the PV status
+# and a custom value: all status and custom events on the first row, every counted trigger edge in order, the status
+# and custom change on the first row that has the new values, and each event at the time of its row.
+def selfTestEventLog():
+    param = ConfigParam()
+    param.AddExpAndStatus = True
+    param.CustomEnabledFlag = True
+    param.CustomEnabled1 = True
+    param.CustomLabel1 = 'Iso Set'
+    param.TriggerChannel = '5'
+    param.SamplePeriod = 0.01
+    param.currentChannelMetricList = ['T1Temp', 'Iso']
+    param.currentChannelPositiveList = [0, 4]
+    triggerPeriod = SimulatedU3.triggerPeriod
+    SimulatedU3.triggerPeriod = 0.3
+    try:
+        lines, events = selfTestRecording(param, 2.0, [(0.0, ['', '', '', '1.5', '', '']),
+                                                       (1.0, ['SCANNING', 'Scan', '3', '2.0', '', ''])])
+    finally:
+        SimulatedU3.triggerPeriod = triggerPeriod
+    assert len(events) > 0 and events[0] == "TimeSec, Count, Event, Value", "event log header %r" % events[0:1]
+    rows = dict([(int(line.split(',')[0]), line) for line in lines if line[0].isdigit()])
+    triggers = []
+    changes = {}
+    for line in events[1:]:
+        timeSec, count, name, value = line.split(', ', 3)
+        count = int(count)
+        assert count in rows and abs(float(rows[count].split(',')[1]) - float(timeSec)) <= 0.051, "event %r, row %r" % (line, rows.get(count))
+        if name == 'Trigger':
+            triggers.append(int(value))
+        else:
+            changes.setdefault(name, []).append((count, value))
+    firstRow = min(rows)
+    for name in StatusEventNames + ['Custom.IsoSet']:
+        assert name in changes and changes[name][0][0] == firstRow, "%s not on the first row: %r" % (name, changes.get(name))
+    assert changes['Custom.IsoSet'][0][1] == '1.5', "first custom value %r" % changes['Custom.IsoSet']
+    assert len(triggers) >= 5 and triggers == list(range(triggers[0], triggers[0] + len(triggers))), "trigger counts %r" % triggers
+    for name, value in [('Status', 'SCANNING'), ('ExpStatus', 'Scan'), ('Exp', '3'), ('Custom.IsoSet', '2.0')]:
+        assert len(changes[name]) == 2 and changes[name][1][1] == value, "%s changes %r" % (name, changes[name])
+        count = changes[name][1][0]
+        fields = [field.strip() for field in rows[count].split(',')]
+        previousFields = [field.strip() for field in rows[count - 1].split(',')]
+        assert value in fields and not (value in previousFields), "%s changed on row %r after %r" % (name, rows[count], rows[count - 1])
+
+
 """
 Start of Main function
 """
 
 
 if __name__ == "__main__":
-    main()
+    if '--tocsv' in sys.argv:
+        # python PhysioRecording_v2.py --tocsv PhysioRecordingLog*.bin
+        print(binaryLogToCSV(sys.argv[sys.argv.index('--tocsv') + 1]))
+    elif '--expand' in sys.argv:
+        # python PhysioRecording_v2.py --expand PhysioRecordingLog*.txt
+        print(expandCompactLog(sys.argv[sys.argv.index('--expand') + 1]))
+    elif '--selftest' in sys.argv:
+        selfTest()
+    elif '--benchmark' in sys.argv:
+        benchmarkCaptureLoop(simulation=loadSimulationSettings(ConfigParam()).Simulation)
+    elif '--calibratesettling' in sys.argv:
+        # python PhysioRecording_v2.py --calibratesettling [--save] [--simulate]
+        param = ConfigParam()
+        if '--simulate' in sys.argv:
+            param.DeviceBackend = 'Simulated'
+        param = getSARecorderConfig(param)
+        param = openU3Device(param)
+        param.ChannelSettling = calibrateChannelSettling(param)
+        if '--save' in sys.argv:
+            saveChannelSettling(param)
+            print("Saved to " + param.configfile)
+    else:
+        main()